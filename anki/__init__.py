@@ -48,11 +48,16 @@ Save & close:
 """
 __docformat__ = 'restructuredtext'
 
-try:
-    __import__('pkg_resources').declare_namespace(__name__)
-except ImportError:
-    pass
+# pkgutil is much quicker to import than pkg_resources
+__path__ = __import__('pkgutil').extend_path(__path__, __name__)
 
 version = "1.2.7"
 
-from anki.deck import DeckStorage
+class _DeckStorage(object):
+    "Imports anki.deck, and with it sqlalchemy, when a deck is first opened."
+
+    def __getattr__(self, name):
+        from anki.deck import DeckStorage
+        return getattr(DeckStorage, name)
+
+DeckStorage = _DeckStorage()
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+# Copyright: Damien Elmes <anki@ichi2.net>
+# License: GNU GPL, version 3 or later; http://www.gnu.org/copyleft/gpl.html
+
+"""\
+Deck backups
+====================
+
+A backup is a small manifest listing the checksum of each fixed-size chunk of
+the deck file. Chunks are stored compressed under chunks/ in the backup
+folder, named by their checksum, so they are shared between backups and a new
+backup only adds the chunks which changed. Chunks no longer referenced by any
+manifest are removed when old backups are pruned. As the folder is shared by
+all decks, writing a backup and removing chunks are done under a lock file.
+
+Older versions stored full copies of the deck (.backup-N.anki). These are
+listed, pruned and restored alongside the manifests.
+"""
+__docformat__ = 'restructuredtext'
+
+import os, re, time, zlib, shutil, simplejson
+from anki.utils import checksum
+from anki.errors import DeckAccessError
+from anki.lang import _
+
+# a multiple of any sqlite page size, so changes stay within a chunk
+chunkSize = 65536
+# seconds between full integrity checks of a deck
+integrityInterval = 86400
+# seconds after which another process's lock on the backups is ignored
+lockTimeout = 600
+
+def escapePath(path):
+    path = os.path.abspath(path)
+    path = path.replace("\\", "!")
+    path = path.replace("/", "!")
+    path = path.replace(":", "")
+    return path
+
+def listBackups(path, backupDir):
+    "Return [(num, backupPath)] for PATH, oldest first."
+    gen = re.sub("\.anki$", ".backup-(\d+).(anki|manifest)",
+                 re.escape(escapePath(path))) + "$"
+    backups = []
+    try:
+        files = os.listdir(backupDir)
+    except (OSError, IOError):
+        return backups
+    for file in files:
+        m = re.match(gen, file)
+        if m:
+            backups.append((int(m.group(1)), os.path.join(backupDir, file)))
+    backups.sort()
+    return backups
+
+def backupDeck(deck, path, backupDir, numBackups):
+    "Back up the file at PATH, which DECK has open. Path must not be unicode."
+    try:
+        os.makedirs(os.path.join(backupDir, "chunks"))
+    except (OSError, IOError):
+        pass
+    backups = listBackups(path, backupDir)
+    checked = 0
+    if backups:
+        latest = backups[-1][1]
+        # check if last backup is the same
+        if int(deck.modified) == int(os.stat(latest).st_mtime):
+            return
+        if latest.endswith(".manifest"):
+            checked = _readManifest(latest)['checked']
+    # check integrity, at most once per interval
+    if time.time() - checked > integrityInterval:
+        if not deck.s.scalar("pragma integrity_check") == "ok":
+            raise DeckAccessError(_("Deck is corrupt."), type="corrupt")
+        checked = time.time()
+    # new chunks aren't referenced by a manifest until the backup is done,
+    # so chunk collection has to wait for it
+    lock = _lock(backupDir)
+    try:
+        # store changed chunks
+        chunks = []
+        file = open(path, "rb")
+        while 1:
+            data = file.read(chunkSize)
+            if not data:
+                break
+            sum = checksum(data)
+            chunk = _chunkPath(backupDir, sum)
+            if not os.path.exists(chunk):
+                _writeAtomic(chunk, zlib.compress(data))
+            chunks.append(sum)
+        file.close()
+        # write manifest, with identical mtime
+        if backups:
+            n = backups[-1][0] + 1
+        else:
+            n = 1
+        newpath = os.path.join(backupDir, os.path.basename(
+            re.sub("\.anki$", ".backup-%s.manifest" % n, escapePath(path))))
+        _writeAtomic(newpath, simplejson.dumps({
+            'modified': deck.modified,
+            'checked': checked,
+            'chunkSize': chunkSize,
+            'chunks': chunks}))
+        if deck.modified:
+            os.utime(newpath, (deck.modified, deck.modified))
+        # remove if over
+        if len(backups) + 1 > numBackups:
+            delete = len(backups) + 1 - numBackups
+            for (n, file) in backups[:delete]:
+                os.unlink(file)
+            _collectChunks(backupDir)
+    finally:
+        _unlock(lock)
+
+def restoreBackup(backup, newPath):
+    "Write the deck stored in BACKUP to NEWPATH."
+    if backup.endswith(".anki"):
+        shutil.copy2(backup, newPath)
+        return
+    manifest = _readManifest(backup)
+    tmp = newPath + ".tmp"
+    file = open(tmp, "wb")
+    try:
+        for sum in manifest['chunks']:
+            try:
+                data = zlib.decompress(open(
+                    _chunkPath(os.path.dirname(backup), sum), "rb").read())
+            except (OSError, IOError, zlib.error):
+                data = None
+            if data is None or checksum(data) != sum:
+                raise DeckAccessError(_("Backup is damaged."),
+                                      type="corrupt")
+            file.write(data)
+        file.close()
+    except:
+        file.close()
+        os.unlink(tmp)
+        raise
+    if os.path.exists(newPath):
+        os.unlink(newPath)
+    os.rename(tmp, newPath)
+    if manifest['modified']:
+        os.utime(newPath, (manifest['modified'], manifest['modified']))
+
+# Tools
+##########################################################################
+
+def _chunkPath(backupDir, sum):
+    return os.path.join(backupDir, "chunks", sum)
+
+def _readManifest(path):
+    return simplejson.loads(open(path, "rb").read())
+
+def _writeAtomic(path, data):
+    tmp = path + ".tmp"
+    file = open(tmp, "wb")
+    file.write(data)
+    file.close()
+    if os.path.exists(path):
+        os.unlink(path)
+    os.rename(tmp, path)
+
+def _lock(backupDir):
+    """Wait for the lock on BACKUPDIR, and return its path. Locks held for
+more than lockTimeout are assumed left over from a crash."""
+    path = os.path.join(backupDir, "lock")
+    while 1:
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return path
+        except OSError:
+            pass
+        try:
+            if time.time() - os.stat(path).st_mtime > lockTimeout:
+                os.unlink(path)
+                continue
+        except OSError:
+            continue
+        time.sleep(0.1)
+
+def _unlock(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+def _collectChunks(backupDir):
+    """Remove chunks not referenced by any deck's manifests. The caller must
+hold the lock."""
+    used = set()
+    for file in os.listdir(backupDir):
+        if file.endswith(".manifest"):
+            used.update(_readManifest(
+                os.path.join(backupDir, file))['chunks'])
+    chunkDir = os.path.join(backupDir, "chunks")
+    for file in os.listdir(chunkDir):
+        if file not in used:
+            os.unlink(os.path.join(chunkDir, file))
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+# Copyright: Damien Elmes <anki@ichi2.net>
+# License: GNU GPL, version 3 or later; http://www.gnu.org/copyleft/gpl.html
+
+"""\
+Scheduler benchmarks
+==============================
+
+Builds a synthetic deck of a given size, then replays a stream of answers
+through getCard() and answerCard() with each scheduler, timing every call.
+The answers are either generated, or taken from the reviewHistory of an
+existing deck, with their eases and thinking times.
+
+Queries are counted with the dbFinished hook, so changes sqlalchemy flushes
+from mapped objects are not included.
+
+Run with python -m anki.benchmark --help.
+"""
+__docformat__ = 'restructuredtext'
+
+import os, sys, time, random, shutil, tempfile
+from anki import DeckStorage
+from anki.stdmodels import BasicModel
+from anki.hooks import addHook, removeHook
+from anki.utils import ids2str
+
+schedulers = ("standard", "cram", "reviewEarly")
+# chance of each ease when generating answers
+easeWeights = ((1, 0.1), (2, 0.1), (3, 0.6), (4, 0.2))
+
+def buildDeck(path, facts=1000, models=1, tags=10, media=0, reviewed=0.5,
+              seed=0):
+    """Create a deck at PATH with FACTS facts spread over MODELS models, each
+fact with up to three of TAGS tags. The first MEDIA facts refer to an
+image. REVIEWED is the fraction of cards which have been learnt; about half
+of those are due. The deck is saved and returned."""
+    rand = random.Random(seed)
+    deck = DeckStorage.Deck(path)
+    ms = []
+    for i in range(models):
+        m = BasicModel()
+        m.name = u"Model %d" % i
+        deck.addModel(m)
+        ms.append(m)
+    tagNames = [u"tag%d" % i for i in range(tags)]
+    for i in range(facts):
+        f = deck.newFact(ms[i % models])
+        f['Front'] = u"front %d" % i
+        if i < media:
+            f['Back'] = u'back <img src="bench%d.jpg">' % i
+        else:
+            f['Back'] = u"back %d" % i
+        if tagNames:
+            f.tags = u" ".join(rand.sample(tagNames,
+                                           rand.randint(0, min(3, tags))))
+        deck.addFact(f, reset=False)
+    ids = deck.s.column0("select id from cards")
+    learnt = rand.sample(ids, int(len(ids) * reviewed))
+    if learnt:
+        deck.rescheduleCards(learnt, 1, 60)
+        # move half of them into the past
+        deck.s.statement("""
+update cards set combinedDue = combinedDue - interval * 86400,
+due = due - interval * 86400 where id in %s""" % ids2str(
+            learnt[:len(learnt) // 2]))
+    deck.reset()
+    deck.save()
+    return deck
+
+def generateAnswers(count, seed=0):
+    "Return COUNT random (ease, thinkingTime) pairs."
+    rand = random.Random(seed)
+    answers = []
+    for i in range(count):
+        r = rand.random()
+        for (ease, weight) in easeWeights:
+            r -= weight
+            if r < 0:
+                break
+        answers.append((ease, rand.uniform(2, 15)))
+    return answers
+
+def recordedAnswers(path, limit=None):
+    "Return the (ease, thinkingTime) pairs in the review history of PATH."
+    deck = DeckStorage.Deck(path, backup=False)
+    try:
+        sql = "select ease, thinkingTime from reviewHistory order by time"
+        if limit:
+            sql += " limit %d" % limit
+        return [tuple(r) for r in deck.s.all(sql)]
+    finally:
+        deck.close()
+
+def setupScheduler(deck, scheduler):
+    if scheduler == "standard":
+        deck.setupStandardScheduler()
+    elif scheduler == "cram":
+        deck.setupCramScheduler("", "random()")
+    elif scheduler == "reviewEarly":
+        deck.setupReviewEarlyScheduler()
+    else:
+        raise ValueError(scheduler)
+
+def replay(deck, answers, scheduler="standard"):
+    """Answer cards in DECK with the (ease, thinkingTime) pairs in ANSWERS,
+stopping early if no cards remain. Return a dict of results."""
+    setupScheduler(deck, scheduler)
+    queries = [0]
+    def count():
+        queries[0] += 1
+    addHook("dbFinished", count)
+    try:
+        t = time.time()
+        deck.reset()
+        resetTime = time.time() - t
+        resetQueries = queries[0]
+        get = []
+        answer = []
+        start = time.time()
+        for (ease, thinking) in answers:
+            t = time.time()
+            card = deck.getCard()
+            get.append(time.time() - t)
+            if not card:
+                break
+            card.timerStarted = time.time() - thinking
+            t = time.time()
+            deck.answerCard(card, ease)
+            answer.append(time.time() - t)
+        total = time.time() - start
+    finally:
+        removeHook("dbFinished", count)
+    n = len(answer)
+    return {
+        'scheduler': scheduler,
+        'answers': n,
+        'reset': resetTime,
+        'getCard': _summary(get),
+        'answerCard': _summary(answer),
+        'queriesPerAnswer': (
+            float(queries[0] - resetQueries) / n if n else 0),
+        'answersPerSecond': total and n / total or 0,
+        }
+
+def run(facts=1000, models=1, tags=10, media=0, reviews=500,
+        history=None, schedulers=schedulers, seed=0):
+    """Build a deck and replay REVIEWS answers with each of SCHEDULERS, each
+on a fresh copy of the deck. Answers come from the deck at HISTORY if
+given. Return a list of results."""
+    dir = tempfile.mkdtemp(prefix="anki")
+    try:
+        path = os.path.join(dir, "bench.anki")
+        buildDeck(path, facts, models, tags, media, seed=seed).close()
+        if history:
+            answers = recordedAnswers(history, reviews)
+        else:
+            answers = generateAnswers(reviews, seed)
+        results = []
+        for scheduler in schedulers:
+            copy = os.path.join(dir, "%s.anki" % scheduler)
+            shutil.copy(path, copy)
+            deck = DeckStorage.Deck(copy, backup=False)
+            try:
+                results.append(replay(deck, answers, scheduler))
+            finally:
+                deck.close()
+        return results
+    finally:
+        shutil.rmtree(dir, ignore_errors=True)
+
+def report(results):
+    "Return RESULTS as a text table, with times in milliseconds."
+    lines = ["%-12s %7s %8s %8s %8s %8s %8s %8s %9s" % (
+        "scheduler", "answers", "reset", "get p50", "get p99",
+        "ans p50", "ans p99", "queries", "answers/s")]
+    for r in results:
+        lines.append("%-12s %7d %8.1f %8.2f %8.2f %8.2f %8.2f %8.1f %9.1f" % (
+            r['scheduler'], r['answers'], r['reset'] * 1000,
+            r['getCard']['p50'] * 1000, r['getCard']['p99'] * 1000,
+            r['answerCard']['p50'] * 1000, r['answerCard']['p99'] * 1000,
+            r['queriesPerAnswer'], r['answersPerSecond']))
+    return "\n".join(lines)
+
+def _summary(times):
+    times = sorted(times)
+    if not times:
+        return {'p50': 0, 'p99': 0, 'mean': 0, 'max': 0}
+    def pct(p):
+        return times[int(round(p * (len(times) - 1)))]
+    return {'p50': pct(0.5), 'p99': pct(0.99),
+            'mean': sum(times) / len(times), 'max': times[-1]}
+
+def main(args=None):
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--facts", type="int", default=1000)
+    parser.add_option("--models", type="int", default=1)
+    parser.add_option("--tags", type="int", default=10)
+    parser.add_option("--media", type="int", default=0,
+                      help="facts referring to an image")
+    parser.add_option("--reviews", type="int", default=500)
+    parser.add_option("--history", metavar="DECK",
+                      help="replay the review history of DECK")
+    parser.add_option("--scheduler", action="append",
+                      help="one of %s; may be repeated" % ", ".join(
+        schedulers))
+    parser.add_option("--seed", type="int", default=0)
+    (opts, args) = parser.parse_args(args)
+    results = run(opts.facts, opts.models, opts.tags, opts.media,
+                  opts.reviews, opts.history,
+                  opts.scheduler or schedulers, opts.seed)
+    print report(results)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
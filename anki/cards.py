@@ -204,7 +204,7 @@ class Card(object):
         return findTag(tag, parseTags(self.allTags()))
 
     def fromDB(self, s, id):
-        r = s.first("""select
+        r = s.rawFirst("""select
 id, factId, cardModelId, created, modified, tags, ordinal, question, answer,
 priority, interval, lastInterval, due, lastDue, factor,
 lastFactor, firstAnswered, reps, successive, averageTime, reviewTime,
@@ -289,6 +289,116 @@ relativeDelay = :relativeDelay,
 priority = :priority
 where id=:id""", self.__dict__)
 
+# Card records
+##########################################################################
+# The scheduler only needs a card's numbers, so cardFromId() without the orm
+# returns a CardRecord: a plain object which reads the scheduling columns,
+# fetches the cached question and answer only when they're used, and writes
+# back only the columns which changed.
+
+def _lazyColumn(name):
+    def get(self):
+        if not self._lazy:
+            self._loadLazy()
+        return self._lazy[name]
+    def set(self, value):
+        if not self._lazy:
+            self._loadLazy()
+        self._lazy[name] = value
+    return property(get, set)
+
+class CardRecord(object):
+    "A card loaded for scheduling, without sqlalchemy."
+
+    columns = (
+        "id", "factId", "cardModelId", "created", "modified", "ordinal",
+        "priority", "interval", "lastInterval", "due", "lastDue", "factor",
+        "lastFactor", "firstAnswered", "reps", "successive", "averageTime",
+        "reviewTime", "youngEase0", "youngEase1", "youngEase2", "youngEase3",
+        "youngEase4", "matureEase0", "matureEase1", "matureEase2",
+        "matureEase3", "matureEase4", "yesCount", "noCount", "spaceUntil",
+        "relativeDelay", "isDue", "type", "combinedDue")
+    lazyColumns = ("question", "answer", "tags")
+    __slots__ = columns + (
+        "deck", "fuzz", "timerStarted", "timerStopped",
+        "_s", "_loaded", "_lazy", "_lazyLoaded", "_cardModel", "_fact")
+
+    def __init__(self):
+        self.timerStarted = False
+        self.timerStopped = False
+        self._lazy = None
+        self._cardModel = None
+        self._fact = None
+
+    def fromDB(self, s, id):
+        r = s.rawFirst("select %s from cards where id = :id" %
+                       ", ".join(self.columns), id=id)
+        if not r:
+            return
+        self.fromRow(s, r)
+        return True
+
+    def fromRow(self, s, r):
+        "Set the card from R, a row of COLUMNS read from session S."
+        self._s = s
+        self._loaded = tuple(r)
+        for (k, v) in zip(self.columns, r):
+            setattr(self, k, v)
+
+    def toDB(self, s):
+        "Write changed columns to DB."
+        vals = {}
+        for (k, v) in zip(self.columns, self._loaded):
+            if getattr(self, k) != v:
+                vals[k] = getattr(self, k)
+        if self._lazy:
+            for k in self.lazyColumns:
+                if self._lazy[k] != self._lazyLoaded[k]:
+                    vals[k] = self._lazy[k]
+            self._lazyLoaded = self._lazy.copy()
+        if not vals:
+            return
+        s.statement("update cards set %s where id = :id" % ", ".join(
+            ["%s = :%s" % (k, k) for k in vals]), id=self.id, **vals)
+        self._loaded = tuple([getattr(self, k) for k in self.columns])
+
+    def _loadLazy(self):
+        r = self._s.rawFirst("select %s from cards where id = :id" %
+                             ", ".join(self.lazyColumns), id=self.id)
+        self._lazyLoaded = dict(zip(self.lazyColumns, r))
+        self._lazy = self._lazyLoaded.copy()
+
+    question = _lazyColumn("question")
+    answer = _lazyColumn("answer")
+    tags = _lazyColumn("tags")
+
+    def _getCardModel(self):
+        if not self._cardModel:
+            self._cardModel = self._s.query(CardModel).get(self.cardModelId)
+        return self._cardModel
+    cardModel = property(_getCardModel)
+
+    def _getFact(self):
+        if not self._fact:
+            self._fact = self._s.query(Fact).get(self.factId)
+        return self._fact
+    fact = property(_getFact)
+
+    # the rest is shared with Card
+    rebuildQA = Card.rebuildQA.im_func
+    setModified = Card.setModified.im_func
+    startTimer = Card.startTimer.im_func
+    stopTimer = Card.stopTimer.im_func
+    thinkingTime = Card.thinkingTime.im_func
+    totalTime = Card.totalTime.im_func
+    genFuzz = Card.genFuzz.im_func
+    htmlQuestion = Card.htmlQuestion.im_func
+    htmlAnswer = Card.htmlAnswer.im_func
+    updateStats = Card.updateStats.im_func
+    splitTags = Card.splitTags.im_func
+    allTags = Card.allTags.im_func
+    hasTag = Card.hasTag.im_func
+
 mapper(Card, cardsTable, properties={
     'cardModel': relation(CardModel),
     'fact': relation(Fact, backref="cards", primaryjoin=
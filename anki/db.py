@@ -7,11 +7,21 @@ DB tools
 ====================
 
 SessionHelper is a wrapper for the standard sqlalchemy session, which provides
-some convenience routines, and manages transactions itself.
+some convenience routines, and manages transactions itself. scalar(),
+column0() and statement(s)() run directly on the DB-API connection unless
+rawQueries is off. all() and first() return sqlalchemy rows, which can be
+read by index, key or attribute; rawAll() and rawFirst() return plain tuples
+from the DB-API connection, for hot paths which read rows by index.
 
 object_session() is a replacement for the standard object_session(), which
 provides the features of SessionHelper, and avoids taking out another
 transaction.
+
+Long lists of ids should be passed to queries with SessionHelper.idSet()
+rather than ids2str(), which stores them in an indexed temporary table.
+
+Set SessionHelper.profiler to an anki.profiler.Profiler to record the
+queries run through the session.
 """
 __docformat__ = 'restructuredtext'
 
@@ -31,8 +41,10 @@ from sqlalchemy.orm import mapper, sessionmaker as _sessionmaker, relation, back
      object_session as _object_session, class_mapper
 from sqlalchemy.sql import select, text, and_
 from sqlalchemy.exceptions import DBAPIError, OperationalError
-from sqlalchemy.pool import NullPool
+from sqlalchemy.pool import NullPool, QueuePool
+from sqlalchemy.interfaces import PoolListener
 import sqlalchemy
+import time
 
 # some users are still on 0.4.x..
 import warnings
@@ -52,15 +64,50 @@ from anki.hooks import runHook
 metadata = MetaData()
 
 # this class assumes the provided session is called with transactional=False
+def _profiled(func):
+    "Record calls to a query routine with the session's profiler, if any."
+    def wrapper(self, sql, *args, **kwargs):
+        if not self.profiler or self._profiling:
+            return func(self, sql, *args, **kwargs)
+        self._profiling = True
+        try:
+            t = time.time()
+            res = func(self, sql, *args, **kwargs)
+            elapsed = time.time() - t
+        finally:
+            self._profiling = False
+        if isinstance(res, list):
+            rows = len(res)
+        elif hasattr(res, 'rowcount'):
+            rows = max(0, res.rowcount)
+        else:
+            rows = int(res is not None)
+        self.profiler.record(unicode(sql), args and args[0] or kwargs,
+                             elapsed, rows)
+        return res
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
 class SessionHelper(object):
     "Add some convenience routines to a session."
 
+    # id lists longer than this are staged in a table instead of inlined
+    idSetInline = 100
+    # run the query routines directly on the DB-API connection, which
+    # caches prepared statements. turn off to compare with the sqlalchemy
+    # path
+    rawQueries = True
+    profiler = None
+    _profiling = False
+
     def __init__(self, session, lock=False, transaction=True):
         self._session = session
         self._lock = lock
         self._transaction = transaction
         if self._transaction:
             self._session.begin()
+            self._createIdSets()
         if self._lock:
             self._lockDB()
         self._seen = True
@@ -86,6 +133,7 @@ class SessionHelper(object):
         else:
             self._session.add(obj)
 
+    @_profiled
     def execute(self, *a, **ka):
         x = self._session.execute(*a, **ka)
         runHook("dbFinished")
@@ -94,29 +142,115 @@ class SessionHelper(object):
     def __getattr__(self, k):
         return getattr(self.__dict__['_session'], k)
 
+    def _useRaw(self):
+        # outside a transaction sqlalchemy commits for us
+        return self.rawQueries and self._session.transaction is not None
+
+    def rawExecute(self, sql, args={}, many=False):
+        """Execute SQL with :named ARGS on the session's DB-API connection,
+bypassing sqlalchemy. Return the cursor."""
+        cur = self._session.connection().connection.cursor()
+        try:
+            if many:
+                cur.executemany(sql, args)
+            else:
+                cur.execute(sql, args)
+        except sqlite.Error, e:
+            # raise the same errors as the sqlalchemy path
+            raise DBAPIError.instance(sql, args, e)
+        runHook("dbFinished")
+        return cur
+
+    @_profiled
     def scalar(self, sql, **args):
+        if self._useRaw():
+            r = self.rawExecute(sql, args).fetchone()
+            if r:
+                return r[0]
+            return None
         return self.execute(text(sql), args).scalar()
 
+    @_profiled
     def all(self, sql, **args):
         return self.execute(text(sql), args).fetchall()
 
+    @_profiled
     def first(self, sql, **args):
         c = self.execute(text(sql), args)
         r = c.fetchone()
         c.close()
         return r
 
+    @_profiled
+    def rawAll(self, sql, **args):
+        "Like all(), but return plain tuples, which can only be indexed."
+        if self._useRaw():
+            return self.rawExecute(sql, args).fetchall()
+        return [tuple(r) for r in self.execute(text(sql), args).fetchall()]
+
+    @_profiled
+    def rawFirst(self, sql, **args):
+        "Like first(), but return a plain tuple."
+        if not self._useRaw():
+            r = self.first(sql, **args)
+            return r and tuple(r)
+        c = self.rawExecute(sql, args)
+        r = c.fetchone()
+        c.close()
+        return r
+
+    @_profiled
     def column0(self, sql, **args):
+        if self._useRaw():
+            return [x[0] for x in self.rawExecute(sql, args).fetchall()]
         return [x[0] for x in self.execute(text(sql), args).fetchall()]
 
+    @_profiled
     def statement(self, sql, **kwargs):
         "Execute a statement without returning any results. Flush first."
+        if self._useRaw():
+            return self.rawExecute(sql, kwargs)
         return self.execute(text(sql), kwargs)
 
+    @_profiled
     def statements(self, sql, data):
         "Execute a statement across data. Flush first."
+        if self._useRaw():
+            return self.rawExecute(sql, data, many=True)
         return self.execute(text(sql), data)
 
+    def idSet(self, name, ids):
+        """Return SQL for use after 'in', matching IDS: a list of ids, or a
+query returning them. Large sets are stored under NAME in the idSets table,
+which should be cleared with dropIdSet() when finished. Names must be unique
+among the sets in use at once. Staged ids have a 'value' column, free for
+the caller to fill in and join against."""
+        if not isinstance(ids, basestring):
+            ids = list(ids)
+            if len(ids) <= self.idSetInline:
+                return "(%s)" % ",".join([str(i) for i in ids])
+        self.dropIdSet(name)
+        if isinstance(ids, basestring):
+            self.statement("insert or ignore into idSets (name, id) "
+                           "select :n, * from (%s)" % ids, n=name)
+        else:
+            self.statements("insert or ignore into idSets (name, id) "
+                            "values (:n, :id)",
+                            [{'n': name, 'id': id} for id in ids])
+        return "(select id from idSets where name = '%s')" % name
+
+    def dropIdSet(self, *names):
+        "Remove the id sets NAMES."
+        for name in names:
+            self.statement("delete from idSets where name = :n", n=name)
+
+    def _createIdSets(self):
+        # only when no changes are pending, as sqlite commits on DDL. without
+        # a connection pool, each transaction may be on a new connection
+        self._session.execute(text("""
+create temporary table if not exists idSets (name text not null,
+id integer not null, value numeric, primary key (name, id))"""))
+
     def __repr__(self):
         return repr(self._session)
 
@@ -124,6 +258,10 @@ class SessionHelper(object):
         self._session.commit()
         if self._transaction:
             self._session.begin()
+            self._createIdSets()
+        if self.profiler:
+            # nothing is pending, so explain won't commit
+            self.profiler.explain(self._session.connection().connection)
         if self._lock:
             self._lockDB()
 
@@ -131,6 +269,55 @@ class SessionHelper(object):
         "Take out a write lock."
         self._session.execute(text("update decks set modified=modified"))
 
+class ReadOnlyListener(PoolListener):
+    "Refuse changes on connections from the pool."
+
+    def connect(self, con, record):
+        con.execute("pragma query_only = 1")
+
+def copyDB(src, path, progress=None, chunk=1000):
+    """Copy the database on DB-API connection SRC into a new file at PATH.
+
+Changes in SRC's open transaction are included and left uncommitted. The
+schema is recreated from sqlite_master, rows are moved in chunks with bound
+parameters, and indices are built once the data is in place. PROGRESS is
+called after each chunk."""
+    new = sqlite.connect(path)
+    new.execute("pragma page_size = 4096")
+    new.execute("pragma legacy_file_format = off")
+    new.execute("pragma default_cache_size= 20000")
+    # only selects on src - anything else would commit its transaction
+    cur = src.cursor()
+    schema = cur.execute("""
+select type, name, sql from sqlite_master
+where sql not null and name not like 'sqlite_%'""").fetchall()
+    def copyRows(name):
+        cur.execute('select * from "%s"' % name)
+        ins = 'insert into "%s" values (%s)' % (
+            name, ",".join("?" * len(cur.description)))
+        while 1:
+            rows = cur.fetchmany(chunk)
+            if not rows:
+                break
+            new.executemany(ins, rows)
+            if progress:
+                progress()
+    for (type, name, sql) in schema:
+        if type == "table":
+            new.execute(sql)
+            copyRows(name)
+    # carry over the planner statistics rather than analyzing again
+    if cur.execute("select 1 from sqlite_master where "
+                   "name = 'sqlite_stat1'").fetchone():
+        new.execute("analyze sqlite_master")
+        copyRows("sqlite_stat1")
+    for (type, name, sql) in schema:
+        if type != "table":
+            new.execute(sql)
+    cur.close()
+    new.commit()
+    new.close()
+
 def object_session(*args):
     s = _object_session(*args)
     if s:
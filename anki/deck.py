@@ -9,7 +9,7 @@ The Deck
 __docformat__ = 'restructuredtext'
 
 import tempfile, time, os, random, sys, re, stat, shutil
-import types, traceback, simplejson, datetime
+import types, traceback, simplejson, datetime, threading
 
 from anki.db import *
 from anki.lang import _, ngettext
@@ -24,16 +24,27 @@ from anki.fonts import toPlatformFont
 from anki.tags import initTagTables, tagIds
 from operator import itemgetter
 from itertools import groupby
-from anki.hooks import runHook, hookEmpty
+from anki.hooks import runHook, hookEmpty, addHook
 from anki.template import render
 from anki.media import updateMediaCount, mediaFiles, \
      rebuildMediaDir
-import anki.latex # sets up hook
+from anki.backup import backupDeck
+from anki.jobs import Job
+from anki.profiler import Profiler
 
 # ensure all the DB metadata in other files is loaded before proceeding
 import anki.models, anki.facts, anki.cards, anki.stats
 import anki.history, anki.media
 
+def _formatLatex(html, *args):
+    "Render latex in HTML, only importing anki.latex if it's used."
+    if "[$" not in html and "[latex]" not in html.lower():
+        return html
+    from anki.latex import formatQA
+    return formatQA(html, *args)
+
+addHook("formatQA", _formatLatex)
+
 # the current code set type -= 3 for manually suspended cards, and += 3*n
 # for temporary suspends, (where n=1 for bury, n=2 for review/cram).
 # This way we don't need to recalculate priorities when enabling the cards
@@ -74,6 +85,38 @@ SEARCH_QA = 8
 SEARCH_PHRASE_WB = 9
 DECK_VERSION = 65
 
+# the maturity band of a card row, kept in the cardCounts table
+cardBandSQL = """(case when %%(r)s.interval >= %d then 2
+when %%(r)s.reps != 0 then 1 else 0 end)""" % MATURE_THRESHOLD
+
+# integrity checks, each an anti-join on a primary key or indexed column
+integrityChecks = (
+    ('fieldsMissingFieldModel', """
+select id from fields where not exists (
+select 1 from fieldModels where fieldModels.id = fields.fieldModelId)"""),
+    ('factsMissingFields', """
+select distinct facts.id from facts, fieldModels where
+facts.modelId = fieldModels.modelId and not exists (
+select 1 from fields where fields.factId = facts.id and
+fields.fieldModelId = fieldModels.id)"""),
+    ('cardsMissingFact', """
+select id from cards where not exists (
+select 1 from facts where facts.id = cards.factId)"""),
+    ('cardsMissingCardModel', """
+select id from cards where not exists (
+select 1 from cardModels where cardModels.id = cards.cardModelId)"""),
+    ('cardsWrongCardModel', """
+select cards.id from cards, facts where facts.id = cards.factId and
+not exists (select 1 from cardModels where
+cardModels.id = cards.cardModelId and cardModels.modelId = facts.modelId)"""),
+    ('factsMissingCards', """
+select id from facts where not exists (
+select 1 from cards where cards.factId = facts.id)"""),
+    ('danglingFields', """
+select id from fields where not exists (
+select 1 from facts where facts.id = fields.factId)"""),
+    )
+
 deckVarsTable = Table(
     'deckVars', metadata,
     Column('key', UnicodeText, nullable=False, primary_key=True),
@@ -144,6 +187,16 @@ class Deck(object):
     initialFactor = 2.5
     minimumAverage = 1.7
     maxScheduleTime = 36500
+    # rows kept in the undo log before the oldest steps are dropped
+    undoLimit = 100000
+    # changes to more rows than this are snapshotted instead of logged
+    undoBulkRows = 1000
+    # answers buffered before their history and stats are written
+    pendingReviewLimit = 50
+    # connections available to readSession() at once
+    readerPoolSize = 2
+    # set by startProfiling()
+    profiler = None
 
     def __init__(self, path=None):
         "Create a new deck."
@@ -163,6 +216,12 @@ class Deck(object):
         self.sessionStartTime = 0
         self.lastSessionStart = 0
         self.queueLimit = 200
+        self._averageFactor = None
+        self._pendingReviews = []
+        self._dailyStats = None
+        self.cardCountsReady = bool(self.s.scalar(
+            "select 1 from sqlite_master where name = 'cardCounts'"))
+        self._jobs = []
         # if most recent deck var not defined, make sure defaults are set
         if not self.s.scalar("select 1 from deckVars where key = 'revSpacing'"):
             self.setVarDefault("suspendLeeches", True)
@@ -188,6 +247,19 @@ class Deck(object):
         self.updateCutoff()
         self.setupStandardScheduler()
 
+    def _getAverageFactor(self):
+        "Starting factor for new cards, determined on first use."
+        if self._averageFactor is None:
+            self._averageFactor = max(
+                self.s.scalar("select avg(factor) from cards where type = 1")
+                or Deck.initialFactor, Deck.minimumAverage)
+        return self._averageFactor
+
+    def _setAverageFactor(self, factor):
+        self._averageFactor = factor
+
+    averageFactor = property(_getAverageFactor, _setAverageFactor)
+
     def modifiedSinceSave(self):
         return self.modified > self.lastLoaded
 
@@ -226,7 +298,7 @@ class Deck(object):
 
     def rebuildCounts(self):
         # global counts
-        self.cardCount = self.s.scalar("select count(*) from cards")
+        self.cardCount = self._countCards("1")
         self.factCount = self.s.scalar("select count(*) from facts")
         # due counts
         self.rebuildFailedCount()
@@ -288,7 +360,7 @@ class Deck(object):
 
     def _fillFailedQueue(self):
         if self.failedSoonCount and not self.failedQueue:
-            self.failedQueue = self.s.all(
+            self.failedQueue = self.s.rawAll(
                 self.cardLimit(
                 "revActive", "revInactive", """
 select c.id, factId, combinedDue from cards c where
@@ -298,7 +370,7 @@ limit %d""" % self.queueLimit), lim=self.failedCutoff)
 
     def _fillRevQueue(self):
         if self.revCount and not self.revQueue:
-            self.revQueue = self.s.all(
+            self.revQueue = self.s.rawAll(
                 self.cardLimit(
                 "revActive", "revInactive", """
 select c.id, factId from cards c where
@@ -308,7 +380,7 @@ limit %d""" % (self.revOrder(), self.queueLimit)), lim=self.dueCutoff)
 
     def _fillNewQueue(self):
         if self.newCountToday and not self.newQueue and not self.spacedCards:
-            self.newQueue = self.s.all(
+            self.newQueue = self.s.rawAll(
                 self.cardLimit(
                 "newActive", "newInactive", """
 select c.id, factId from cards c where
@@ -439,9 +511,11 @@ when type >= 0 then relativeDelay else relativeDelay - 3 end)
             self.dueCutoff = time.time()
 
     def reset(self):
-        # setup global/daily stats
-        self._globalStats = globalStats(self)
-        self._dailyStats = dailyStats(self)
+        # global/daily stats are kept up to date in memory, and only reread
+        # on a new day
+        self.flushReviews()
+        if not self._dailyStats or genToday(self) != self._dailyStats.day:
+            self.loadStats()
         # recheck counts
         self.rebuildCounts()
         # empty queues; will be refilled by getCard()
@@ -468,6 +542,11 @@ when type >= 0 then relativeDelay else relativeDelay - 3 end)
         self.newSpacing = self.getFloat('newSpacing')
         self.revSpacing = self.getFloat('revSpacing')
 
+    def loadStats(self):
+        "Read the global and daily stats, after they were changed in the DB."
+        self._globalStats = globalStats(self)
+        self._dailyStats = dailyStats(self)
+
     def checkDay(self):
         # check if the day has rolled over
         if genToday(self) != self._dailyStats.day:
@@ -516,7 +595,7 @@ select count() from cards c where type = 1 and combinedDue > :now
 
     def _fillRevEarlyQueue(self):
         if self.revCount and not self.revQueue:
-            self.revQueue = self.s.all(
+            self.revQueue = self.s.rawAll(
                 self.cardLimit(
                 "revActive", "revInactive", """
 select id, factId from cards c where type = 1 and combinedDue > :lim
@@ -634,7 +713,7 @@ order by combinedDue limit %d""" % self.queueLimit), lim=self.dueCutoff)
 
     def _fillCramQueue(self):
         if self.revCount and not self.revQueue:
-            self.revQueue = self.s.all(self.cardLimit(
+            self.revQueue = self.s.rawAll(self.cardLimit(
                 self.activeCramTags, "", """
 select id, factId from cards c
 where type between 0 and 2
@@ -752,14 +831,15 @@ limit %s""" % (self.cramOrder, self.queueLimit)))
         return self.collapseTime or not self.delay0
 
     def cardFromId(self, id, orm=False):
-        "Given a card ID, return a card, and start the card timer."
+        """Given a card ID, return a card, and start the card timer. Without
+ORM, the card is a CardRecord, which is cheaper to load and save."""
         if orm:
             card = self.s.query(anki.cards.Card).get(id)
             if not card:
                 return
             card.timerStopped = False
         else:
-            card = anki.cards.Card()
+            card = anki.cards.CardRecord()
             if not card.fromDB(self.s, id):
                 return
         card.deck = self
@@ -767,12 +847,54 @@ limit %s""" % (self.cramOrder, self.queueLimit)))
         card.startTimer()
         return card
 
+    def getCards(self, n):
+        """Return up to N of the next cards due as CardRecords: due failed
+cards first, then reviews, then new cards up to today's limit, taken from
+the queues, so at most queueLimit of each are returned per call. Unlike
+getCard(), siblings are not spaced apart, and cards are returned without
+being answered, so they can be passed to answerCards() in one go."""
+        self.checkDay()
+        self.fillQueues()
+        self.updateNewCountToday()
+        now = time.time()
+        ids = [q[0] for q in reversed(self.failedQueue)
+               if q[2] + self.delay0 < now]
+        ids += [q[0] for q in reversed(self.revQueue)]
+        ids += [q[0] for q in reversed(self.newQueue)][:self.newCountToday]
+        seen = set()
+        ids = [id for id in ids if not (id in seen or seen.add(id))][:n]
+        cards = self._cardRecords(ids)
+        return [cards[id] for id in ids if id in cards]
+
+    def _cardRecords(self, ids):
+        "Return {id: CardRecord} for IDS, read in one query."
+        sids = self.s.idSet("cardRecords", ids)
+        cards = {}
+        now = time.time()
+        for r in self.s.rawAll("select %s from cards where id in %s" % (
+            ", ".join(anki.cards.CardRecord.columns), sids)):
+            card = anki.cards.CardRecord()
+            card.fromRow(self.s, r)
+            card.deck = self
+            card.genFuzz()
+            card.timerStarted = now
+            cards[card.id] = card
+        self.s.dropIdSet("cardRecords")
+        return cards
+
     # Answering a card
     ##########################################################################
 
     def _answerCard(self, card, ease):
         undoName = _("Answer Card")
-        self.setUndoStart(undoName)
+        if len(self._pendingReviews) >= self.pendingReviewLimit:
+            # before the step opens, so the rows aren't logged in its range
+            self.flushReviews()
+        self.setUndoStart(undoName, flush=False)
+        if self.undoEnabled:
+            step = self.undoStack[-1]
+        else:
+            step = None
         now = time.time()
         # old state
         oldState = self.cardState(card)
@@ -807,7 +929,7 @@ limit %s""" % (self.cramOrder, self.queueLimit)))
         else:
             self.newCount -= 1
         # card stats
-        anki.cards.Card.updateStats(card, ease, oldState)
+        card.updateStats(ease, oldState)
         # update type & ensure past cutoff
         card.type = self.cardType(card)
         card.relativeDelay = card.type
@@ -819,12 +941,12 @@ limit %s""" % (self.cramOrder, self.queueLimit)))
         # save
         card.combinedDue = card.due
         card.toDB(self.s)
-        # global/daily stats
-        anki.stats.updateAllStats(self.s, self._globalStats, self._dailyStats,
-                                  card, ease, oldState)
-        # review history
+        # global/daily stats and review history are written in batches
+        deltas = anki.stats.updateAllStats(
+            self.s, self._globalStats, self._dailyStats, card, ease,
+            oldState, write=False)
         entry = CardHistoryEntry(card, ease, lastDelay)
-        entry.writeSQL(self.s)
+        self._pendingReviews.append((step, entry.toDict(), deltas))
         self.modified = now
         # remove from queue
         self.requeueCard(card, oldSuc)
@@ -836,6 +958,115 @@ limit %s""" % (self.cramOrder, self.queueLimit)))
         runHook("cardAnswered", card.id, isLeech)
         self.setUndoEnd(undoName)
 
+    def answerCards(self, answers):
+        """Answer many cards at once. ANSWERS is a list of (cardId, ease,
+thinkingTime, time) in the order they were answered, where thinkingTime and
+time may be None or left off for the current time and no thinking time. A
+card may be answered more than once.
+
+Cards are scheduled as answerCard() would, with delays and due times
+measured from each answer's time, but the cards, review history and stats
+are written in grouped statements, siblings are spaced once at the end,
+the queues are rebuilt once, and the batch is a single undo step. Daily
+stats for all the answers go to today's row. Cramming is not supported."""
+        if self.scheduler == "cram":
+            raise Exception("answerCards() can't be used while cramming")
+        undoName = _("Answer Cards")
+        self.flushReviews()
+        # checked before the undo step opens, so an error can't leave it open
+        cards = self._cardRecords([a[0] for a in answers])
+        missing = [a[0] for a in answers if a[0] not in cards]
+        if missing:
+            raise Exception("answerCards(): no cards with ids %s" %
+                            ids2str(missing))
+        self.setUndoStart(undoName)
+        history = []
+        deltas = []
+        leeches = []
+        last = 0
+        for a in answers:
+            (id, ease, thinking, t) = (tuple(a) + (None, None))[:4]
+            card = cards[id]
+            now = time.time()
+            if t:
+                cutoff = t
+            else:
+                (t, cutoff) = (now, self.dueCutoff)
+            last = max(last, t)
+            card.timerStarted = now - (thinking or 0)
+            card.timerStopped = now
+            oldState = self.cardState(card)
+            lastDelay = (t - card.combinedDue) / 86400.0
+            delay = self._adjustedDelay(card, ease, cutoff)
+            prev = card.interval
+            card.interval = self._nextInterval(card, delay, ease)
+            card.lastInterval = prev
+            if card.reps:
+                card.lastDue = card.due
+            card.due = self.nextDue(card, ease, oldState) - now + t
+            card.isDue = 0
+            card.lastFactor = card.factor
+            card.spaceUntil = 0
+            if not self.finishScheduler:
+                self.updateFactor(card, ease)
+            firstAnswered = card.firstAnswered
+            card.updateStats(ease, oldState)
+            if not firstAnswered:
+                card.firstAnswered = t
+            card.type = self.cardType(card)
+            card.relativeDelay = card.type
+            if ease != 1:
+                card.due = max(card.due, cutoff+1)
+            if self.answerPreSave:
+                self.answerPreSave(card, ease)
+            card.combinedDue = card.due
+            deltas.extend(anki.stats.updateAllStats(
+                self.s, self._globalStats, self._dailyStats, card, ease,
+                oldState, write=False))
+            entry = CardHistoryEntry(card, ease, lastDelay).toDict()
+            entry['time'] = t
+            history.append(entry)
+            if self.isLeech(card):
+                leeches.append(card)
+        # write everything in grouped statements
+        cols = [c for c in anki.cards.CardRecord.columns if c not in (
+            "id", "factId", "cardModelId", "created", "ordinal")]
+        self.s.statements("update cards set %s where id = :id" % ", ".join(
+            ["%s = :%s" % (c, c) for c in cols]),
+                          [dict([(c, getattr(card, c)) for c in cols],
+                                id=card.id) for card in cards.values()])
+        self.s.statements(CardHistoryEntry.insertSQL, history)
+        self.s.statements(anki.stats.Stats.deltaSQL,
+                          anki.stats.mergeDeltas(deltas))
+        self._spaceFacts(cards.keys(), last)
+        self.modified = time.time()
+        for card in leeches:
+            self.handleLeech(card)
+        for a in answers:
+            runHook("cardAnswered", a[0], cards[a[0]] in leeches)
+        self.setUndoEnd(undoName)
+        self.reset()
+
+    def _spaceFacts(self, ids, t):
+        "Space the siblings of cards IDS, answered by time T."
+        sids = self.s.idSet("spaceCards", ids)
+        self.s.statement("""
+update cards set
+combinedDue = (case
+when type = 1 then combinedDue + 86400 * (case
+  when interval*:rev < 1 then 0
+  else interval*:rev
+  end)
+when type = 2 then :new
+end),
+modified = :now, isDue = 0
+where id not in %s and factId in (select factId from cards where id in %s)
+and combinedDue < :cut
+and type between 1 and 2""" % (sids, sids),
+                         now=time.time(), cut=self.dueCutoff,
+                         new=t + self.newSpacing, rev=self.revSpacing)
+        self.s.dropIdSet("spaceCards")
+
     def _spaceCards(self, card):
         new = time.time() + self.newSpacing
         self.s.statement("""
@@ -975,51 +1206,57 @@ and type between 1 and 2""",
             card.factor += 0.10
         card.factor = max(1.3, card.factor)
 
-    def _adjustedDelay(self, card, ease):
-        "Return an adjusted delay value for CARD based on EASE."
+    def _adjustedDelay(self, card, ease, cutoff=None):
+        """Return an adjusted delay value for CARD based on EASE, measured
+from CUTOFF, by default the deck's."""
+        if cutoff is None:
+            cutoff = self.dueCutoff
         if self.cardIsNew(card):
             return 0
         if card.reps and not card.successive:
             return 0
-        if card.combinedDue <= self.dueCutoff:
-            return (self.dueCutoff - card.due) / 86400.0
+        if card.combinedDue <= cutoff:
+            return (cutoff - card.due) / 86400.0
         else:
-            return (self.dueCutoff - card.combinedDue) / 86400.0
+            return (cutoff - card.combinedDue) / 86400.0
 
     def resetCards(self, ids):
         "Reset progress on cards in IDS."
+        sids = self.s.idSet("resetCards", ids)
         self.s.statement("""
-update cards set interval = :new, lastInterval = 0, lastDue = 0,
-factor = 2.5, reps = 0, successive = 0, averageTime = 0, reviewTime = 0,
-youngEase0 = 0, youngEase1 = 0, youngEase2 = 0, youngEase3 = 0,
-youngEase4 = 0, matureEase0 = 0, matureEase1 = 0, matureEase2 = 0,
-matureEase3 = 0,matureEase4 = 0, yesCount = 0, noCount = 0,
-spaceUntil = 0, type = 2, relativeDelay = 2,
-combinedDue = created, modified = :now, due = created, isDue = 0
-where id in %s""" % ids2str(ids), now=time.time(), new=0)
+update cards set %s, modified = :now, type = 2, relativeDelay = 2,
+combinedDue = created, due = created, isDue = 0
+where id in %s""" % (self._resetCardsSQL, sids), now=time.time())
         if self.newCardOrder == NEW_CARDS_RANDOM:
             # we need to re-randomize now
-            self.randomizeNewCards(ids)
+            self.randomizeNewCards(sids)
+        self.s.dropIdSet("resetCards")
         self.flushMod()
         self.refreshSession()
 
     def randomizeNewCards(self, cardIds=None):
-        "Randomize 'due' on all new cards."
-        now = time.time()
+        """Randomize 'due' on all new cards. CARDIDS may be a list or SQL for
+use after 'in'. Cards of the same fact stay together."""
         query = "select distinct factId from cards where reps = 0"
         if cardIds:
-            query += " and id in %s" % ids2str(cardIds)
-        fids = self.s.column0(query)
-        data = [{'fid': fid,
-                 'rand': random.uniform(0, now),
-                 'now': now} for fid in fids]
-        self.s.statements("""
-update cards
-set due = :rand + ordinal,
-combinedDue = :rand + ordinal,
+            if not isinstance(cardIds, basestring):
+                cardIds = ids2str(cardIds)
+            query += " and id in %s" % cardIds
+        # pick a random time for each fact, and apply it in one pass
+        fids = self.s.idSet("randomizeFacts", query)
+        now = time.time()
+        self.s.statement("""
+update idSets set value = abs(random() % :max)
+where name = 'randomizeFacts'""", max=int(now) + 1)
+        value = self._setValueSQL("randomizeFacts", "cards.factId")
+        self.s.statement("""
+update cards set
+due = (%s) + ordinal,
+combinedDue = (%s) + ordinal,
 modified = :now
-where factId = :fid
-and relativeDelay = 2""", data)
+where factId in %s
+and relativeDelay = 2""" % (value, value, fids), now=now)
+        self.s.dropIdSet("randomizeFacts")
 
     def orderNewCards(self):
         "Set 'due' to card creation time."
@@ -1030,32 +1267,115 @@ combinedDue = created,
 modified = :now
 where relativeDelay = 2""", now=time.time())
 
-    def rescheduleCards(self, ids, min, max):
-        "Reset cards and schedule with new interval in days (min, max)."
-        self.resetCards(ids)
-        vals = []
-        for id in ids:
-            r = random.uniform(min*86400, max*86400)
-            vals.append({
-                'id': id,
-                'due': r + time.time(),
-                'int': r / 86400.0,
-                't': time.time(),
-                })
-        self.s.statements("""
-update cards set
-interval = :int,
-due = :due,
-combinedDue = :due,
+    def rescheduleCards(self, ids, min, max, balance=False):
+        """Reset cards and schedule with new interval in days (min, max). If
+BALANCE, spread the cards so the number of reviews due each day in the range
+is as even as possible, counting the reviews already due."""
+        now = time.time()
+        lo = int(min * 86400)
+        hi = int(max * 86400)
+        # stage the cards in a random order with a random delay
+        sids = self.s.idSet("rescheduleIds", ids)
+        self.s.dropIdSet("reschedule")
+        self.s.statement("""
+insert into idSets (name, id, value)
+select 'reschedule', id, :lo + abs(random() %% :span) from cards
+where id in %s order by random()""" % sids, lo=lo, span=hi - lo + 1)
+        self.s.dropIdSet("rescheduleIds")
+        if balance:
+            self._balanceDelays("reschedule", now, lo, hi)
+        value = self._setValueSQL("reschedule", "cards.id")
+        self.s.statement("""
+update cards set %s, modified = :now,
+interval = (%s) / 86400.0,
+due = :now + (%s),
+combinedDue = :now + (%s),
 reps = 1,
 successive = 1,
 yesCount = 1,
-firstAnswered = :t,
+firstAnswered = :now,
 type = 1,
 relativeDelay = 1,
 isDue = 0
-where id = :id""", vals)
+where id in (select id from idSets where name = 'reschedule')""" % (
+            self._resetCardsSQL, value, value, value), now=now)
+        self.s.dropIdSet("reschedule")
         self.flushMod()
+        self.refreshSession()
+
+    # Bulk scheduling
+    ##########################################################################
+    # Cards to reschedule are staged in the idSets table, with their new
+    # delay in seconds in the value column, and updated in a single
+    # statement. Random values come from sqlite's random(), so nothing is
+    # built per card in Python.
+
+    _resetCardsSQL = """\
+interval = 0, lastInterval = 0, lastDue = 0,
+factor = 2.5, reps = 0, successive = 0, averageTime = 0, reviewTime = 0,
+youngEase0 = 0, youngEase1 = 0, youngEase2 = 0, youngEase3 = 0,
+youngEase4 = 0, matureEase0 = 0, matureEase1 = 0, matureEase2 = 0,
+matureEase3 = 0, matureEase4 = 0, yesCount = 0, noCount = 0,
+spaceUntil = 0"""
+
+    def _setValueSQL(self, name, col):
+        "SQL for the value stored alongside COL in the id set NAME."
+        return ("select value from idSets where name = '%s' and id = %s" %
+                (name, col))
+
+    def _balanceDelays(self, name, now, lo, hi):
+        """Replace the delays of the cards staged under NAME with whole days
+between LO and HI seconds, filling the days with the fewest reviews due
+first. Cards are assigned in staging order, which should be random."""
+        days = (hi - lo) // 86400 + 1
+        load = [0] * days
+        for (day, cnt) in self.s.rawAll("""
+select cast((combinedDue - :start) / 86400 as int) as day, count() from cards
+where type = 1 and combinedDue >= :start and combinedDue < :end
+and id not in (select id from idSets where name = '%s')
+group by day""" % name, start=now + lo, end=now + lo + days * 86400):
+            load[day] = cnt
+        counts = self._fillDays(load, self.s.scalar(
+            "select count() from idSets where name = :n", n=name))
+        # rowids are consecutive in the order the cards were staged
+        rowid = self.s.scalar(
+            "select min(rowid) from idSets where name = :n", n=name)
+        data = []
+        for (day, cnt) in enumerate(counts):
+            if cnt:
+                data.append({'n': name, 'a': rowid, 'b': rowid + cnt - 1,
+                             'v': lo + day * 86400})
+                rowid += cnt
+        self.s.statements("""
+update idSets set value = :v + abs(random() % 86400)
+where name = :n and rowid between :a and :b""", data)
+        self.s.statement("""
+update idSets set value = :hi where name = :n and value > :hi""",
+                         n=name, hi=hi)
+
+    def _fillDays(self, load, total):
+        """Return how many of TOTAL cards to add to each day, given the LOAD
+already on each day, leaving the busiest days as level as possible."""
+        level = 0
+        if total:
+            s = sorted(load)
+            below = 0
+            for i in range(len(s)):
+                below += s[i]
+                # raise the quietest i+1 days to a common level
+                level = -(-(total + below) // (i + 1))
+                if i + 1 == len(s) or level <= s[i + 1]:
+                    break
+        counts = [level > l and level - l or 0 for l in load]
+        # the level is rounded up, so take the extras off the last days
+        extra = sum(counts) - total
+        for day in reversed(range(len(counts))):
+            if not extra:
+                break
+            if counts[day]:
+                counts[day] -= 1
+                extra -= 1
+        return counts
 
     # Times
     ##########################################################################
@@ -1160,26 +1480,51 @@ limit 1""" % self.delay0))
 
     def updateAllPriorities(self, partial=False, dirty=True):
         "Update all card priorities if changed. Caller must .reset()"
-        new = self.updateTagPriorities()
+        tids = [x['id'] for x in self.updateTagPriorities()]
         if not partial:
-            new = self.s.all("select id, priority as pri from tags")
+            tids = self.s.column0("select id from tags")
         cids = self.s.column0(
             "select distinct cardId from cardTags where tagId in %s" %
-                              ids2str([x['id'] for x in new]))
+                              ids2str(tids))
         self.updatePriorities(cids, dirty=dirty)
 
+    def updateAllPrioritiesJob(self, dirty=True):
+        """Run updateAllPriorities() as a background job, which works out the
+priority of every card in its own thread. See startJob()."""
+        # deck attributes can only be read on the deck's thread
+        levels = self._priorityLevels()
+        def work(job, s):
+            job.update(0, 0, _("Updating priorities..."))
+            return self._cardPriorities(s, "", self._tagPriorities(s, levels))
+        def apply(cards):
+            self.updateTagPriorities()
+            self._writePriorities(cards, dirty)
+        return self.startJob(_("Update Priorities"), work, apply)
+
     def updateTagPriorities(self):
         "Update priority setting on tags table."
         # make sure all priority tags exist
         for s in (self.lowPriority, self.medPriority,
                   self.highPriority):
             tagIds(self.s, parseTags(s))
-        tags = self.s.all("select tag, id, priority from tags")
+        new = self._tagPriorities(self.s, self._priorityLevels())
+        self.s.statements(
+           "update tags set priority = :pri where id = :id",
+           new)
+        return new
+
+    def _priorityLevels(self):
+        return ((self.lowPriority, 1),
+                (self.medPriority, 3),
+                (self.highPriority, 4))
+
+    def _tagPriorities(self, s, levels):
+        """Return the tags in S whose priority doesn't match LEVELS from
+_priorityLevels(), as {id, pri}."""
+        tags = s.all("select tag, id, priority from tags")
         tags = [(x[0].lower(), x[1], x[2]) for x in tags]
         up = {}
-        for (type, pri) in ((self.lowPriority, 1),
-                            (self.medPriority, 3),
-                            (self.highPriority, 4)):
+        for (type, pri) in levels:
             for tag in parseTags(type.lower()):
                 up[tag] = pri
         new = []
@@ -1188,9 +1533,6 @@ limit 1""" % self.delay0))
                 new.append({'id': id, 'pri': up[tag]})
             elif tag not in up and pri != 2:
                 new.append({'id': id, 'pri': 2})
-        self.s.statements(
-           "update tags set priority = :pri where id = :id",
-           new)
         return new
 
     def updatePriorities(self, cardIds, suspend=[], dirty=True):
@@ -1201,20 +1543,31 @@ limit 1""" % self.delay0))
             self.s.statement(
                 "update tags set priority = 0 where id in %s" %
                 ids2str(ids.values()))
-        if len(cardIds) > 1000:
-            limit = ""
-        else:
-            limit = "and cardTags.cardId in %s" % ids2str(cardIds)
-        cards = self.s.all("""
+        limit = "and cardTags.cardId in %s" % self.s.idSet(
+            "updatePriorities", cardIds)
+        cards = self._cardPriorities(self.s, limit)
+        self.s.dropIdSet("updatePriorities")
+        self._writePriorities(cards, dirty)
+
+    def _cardPriorities(self, s, limit, tags=()):
+        """Return (cardId, priority) for the cards in S matching LIMIT, taking
+the priority of TAGS from updateTagPriorities() rather than the tags table."""
+        pri = "tags.priority"
+        if tags:
+            pri = "(case tags.id %s else tags.priority end)" % " ".join([
+                "when %d then %d" % (t['id'], t['pri']) for t in tags])
+        return s.rawAll("""
 select cardTags.cardId,
 case
-when max(tags.priority) > 2 then max(tags.priority)
-when min(tags.priority) = 1 then 1
+when max(%(p)s) > 2 then max(%(p)s)
+when min(%(p)s) = 1 then 1
 else 2 end
 from cardTags, tags
 where cardTags.tagId = tags.id
-%s
-group by cardTags.cardId""" % limit)
+%(l)s
+group by cardTags.cardId""" % {'p': pri, 'l': limit})
+
+    def _writePriorities(self, cards, dirty):
         if dirty:
             extra = ", modified = :m "
         else:
@@ -1226,7 +1579,9 @@ group by cardTags.cardId""" % limit)
                 self.s.statement((
                     "update cards set priority = :pri %s where id in %s "
                     "and priority != :pri and priority >= -2") % (
-                    extra, ids2str(cs)), pri=pri, m=time.time())
+                    extra, self.s.idSet("updatePriorities", cs)),
+                                 pri=pri, m=time.time())
+                self.s.dropIdSet("updatePriorities")
 
     def updatePriority(self, card):
         "Update priority on a single card."
@@ -1246,7 +1601,9 @@ group by cardTags.cardId""" % limit)
 update cards
 set type = relativeDelay - 3,
 priority = -3, modified = :t, isDue=0
-where type >= 0 and id in %s""" % ids2str(ids), t=time.time())
+where type >= 0 and id in %s""" % self.s.idSet("suspendCards", ids),
+                         t=time.time())
+        self.s.dropIdSet("suspendCards")
         self.flushMod()
         self.finishProgress()
 
@@ -1256,7 +1613,8 @@ where type >= 0 and id in %s""" % ids2str(ids), t=time.time())
         self.s.statement("""
 update cards set type = relativeDelay, priority=0, modified=:t
 where type < 0 and id in %s""" %
-            ids2str(ids), t=time.time())
+            self.s.idSet("unsuspendCards", ids), t=time.time())
+        self.s.dropIdSet("unsuspendCards")
         self.updatePriorities(ids)
         self.flushMod()
         self.finishProgress()
@@ -1296,23 +1654,61 @@ combinedDue > :now and due < :now""", now=time.time())
         return not self.cardCount
 
     def matureCardCount(self):
-        return self.s.scalar(
-            "select count(id) from cards where interval >= :t ",
-            t=MATURE_THRESHOLD)
+        return self._countCards("band = 2")
 
     def youngCardCount(self):
-        return self.s.scalar(
-            "select count(id) from cards where interval < :t "
-            "and reps != 0", t=MATURE_THRESHOLD)
+        return self._countCards("band = 1")
 
     def newCountAll(self):
         "All new cards, including spaced."
-        return self.s.scalar(
-            "select count(id) from cards where relativeDelay = 2")
+        return self._countCards("relativeDelay = 2")
 
     def seenCardCount(self):
+        return self._countCards("relativeDelay between 0 and 1")
+
+    # Card counts
+    ##########################################################################
+    # The cardCounts table holds the number of cards for each combination of
+    # type, relativeDelay, priority and maturity band (0 unseen, 1 young, 2
+    # mature). It's kept up to date by triggers on the cards table, so the
+    # counts above don't need to scan the cards.
+
+    def _countCards(self, where):
+        "Return the number of cards matching WHERE on cardCounts' columns."
+        if not self.cardCountsReady:
+            # while upgrading an old deck
+            return self.s.scalar("select coalesce(sum(count), 0) from (%s) "
+                                 "where %s" % (self._cardCountsSQL(), where))
         return self.s.scalar(
-            "select count(id) from cards where relativeDelay between 0 and 1")
+            "select coalesce(sum(count), 0) from cardCounts where " + where)
+
+    def _cardCountsSQL(self):
+        return """
+select type, relativeDelay, priority, %s as band, count() as count from cards
+group by type, relativeDelay, priority, band""" % (
+            cardBandSQL % {'r': "cards"})
+
+    def rebuildCardCounts(self):
+        "Recount the cards into cardCounts."
+        self.s.statement("delete from cardCounts")
+        self.s.statement("insert into cardCounts " + self._cardCountsSQL())
+
+    def checkCardCounts(self, s=None):
+        """Recount the cards on session S if provided, and return {(type,
+relativeDelay, priority, band): (stored count, actual count)} for the
+counts which are wrong."""
+        if not self.cardCountsReady:
+            return {}
+        s = s or self.s
+        stored = dict([(tuple(r[:4]), r[4]) for r in s.rawAll(
+            "select * from cardCounts where count != 0")])
+        actual = dict([(tuple(r[:4]), r[4])
+                       for r in s.rawAll(self._cardCountsSQL())])
+        drift = {}
+        for k in set(stored) | set(actual):
+            if stored.get(k, 0) != actual.get(k, 0):
+                drift[k] = (stored.get(k, 0), actual.get(k, 0))
+        return drift
 
     # Card predicates
     ##########################################################################
@@ -1512,18 +1908,18 @@ where factId = :fid and cardModelId = :cmid""",
             return
         self.s.flush()
         now = time.time()
-        strids = ids2str(ids)
-        self.s.statement("delete from facts where id in %s" % strids)
-        self.s.statement("delete from fields where factId in %s" % strids)
-        data = [{'id': id, 'time': now} for id in ids]
-        self.s.statements("insert into factsDeleted values (:id, :time)", data)
+        fids = self.s.idSet("deleteFacts", ids)
+        self.s.statement(
+            "insert into factsDeleted select id, :t from facts "
+            "where id in %s" % fids, t=now)
+        self.s.statement("delete from facts where id in %s" % fids)
+        self.s.statement("delete from fields where factId in %s" % fids)
+        self.s.dropIdSet("deleteFacts")
         self.setModified()
 
     def deleteDanglingFacts(self):
         "Delete any facts without cards. Return deleted ids."
-        ids = self.s.column0("""
-select facts.id from facts
-where facts.id not in (select distinct factId from cards)""")
+        ids = self.s.column0(dict(integrityChecks)['factsMissingCards'])
         self.deleteFacts(ids)
         return ids
 
@@ -1564,34 +1960,41 @@ where facts.id not in (select distinct factId from cards)""")
         if not ids:
             return
         self.s.flush()
-        now = time.time()
-        strids = ids2str(ids)
-        self.startProgress()
-        # grab fact ids
-        factIds = self.s.column0("select factId from cards where id in %s"
-                                 % strids)
-        # drop from cards
-        self.s.statement("delete from cards where id in %s" % strids)
-        # note deleted
-        data = [{'id': id, 'time': now} for id in ids]
-        self.s.statements("insert into cardsDeleted values (:id, :time)", data)
-        # gather affected tags
-        tags = self.s.column0(
-            "select tagId from cardTags where cardId in %s" %
-            strids)
-        # delete
-        self.s.statement("delete from cardTags where cardId in %s" % strids)
-        # find out if they're used by anything else
-        unused = []
-        for tag in tags:
-            if not self.s.scalar(
-                "select 1 from cardTags where tagId = :d limit 1", d=tag):
-                unused.append(tag)
-        # delete unused
-        self.s.statement("delete from tags where id in %s and priority = 2" %
-                         ids2str(unused))
-        # remove any dangling facts
-        self.deleteDanglingFacts()
+        cids = self.s.idSet("deleteCards", ids)
+        self.suspendUndo({'cards': "id in %(cards)s",
+                          'cardsDeleted': "cardId in %(cards)s",
+                          'cardTags': "cardId in %(cards)s",
+                          'facts': "id in %(facts)s",
+                          'factsDeleted': "factId in %(facts)s",
+                          'fields': "factId in %(facts)s"}, len(ids),
+                         {'cards': ids, 'facts':
+                          "select factId from cards where id in %s" % cids})
+        try:
+            now = time.time()
+            self.startProgress()
+            # grab fact and tag ids
+            fids = self.s.idSet("deleteCardFacts", """
+select factId from cards where id in %s""" % cids)
+            tids = self.s.idSet("deleteCardTags", """
+select tagId from cardTags where cardId in %s""" % cids)
+            # drop from cards, noting deleted
+            self.s.statement(
+                "insert into cardsDeleted select id, :t from cards "
+                "where id in %s" % cids, t=now)
+            self.s.statement("delete from cards where id in %s" % cids)
+            self.s.statement("delete from cardTags where cardId in %s" % cids)
+            # delete tags no longer used by anything
+            self.s.statement("""
+delete from tags where priority = 2 and id in %s and not exists (
+select 1 from cardTags where tagId = tags.id)""" % tids)
+            # remove any facts left without cards
+            self.deleteFacts(self.s.column0("""
+select id from facts where id in %s and not exists (
+select 1 from cards where factId = facts.id)""" % fids))
+            self.s.dropIdSet(
+                "deleteCards", "deleteCardFacts", "deleteCardTags")
+        finally:
+            self.resumeUndo()
         self.refreshSession()
         self.flushMod()
         self.finishProgress()
@@ -1700,86 +2103,101 @@ select id from models""")
     def changeModel(self, factIds, newModel, fieldMap, cardMap):
         "Caller must .reset()"
         self.s.flush()
-        fids = ids2str(factIds)
-        changed = False
-        # field remapping
-        if fieldMap:
-            changed = True
-            self.startProgress(len(fieldMap)+2)
-            seen = {}
-            for (old, new) in fieldMap.items():
+        self.suspendUndo({'cards': "factId in %(facts)s",
+                          'cardTags': "cardId in (select id from cards "
+                                      "where factId in %(facts)s)",
+                          'facts': "id in %(facts)s",
+                          'fields': "factId in %(facts)s"},
+                         len(factIds), {'facts': factIds})
+        try:
+            # stage the facts, so each step below is a single statement
+            fids = self.s.idSet("changeFacts", factIds)
+            def remap(col, mapping):
+                # map old ids to new values in one pass, so x->y and y->x work
+                return "case %s %s end" % (col, " ".join([
+                    "when %d then %d" % (old, new)
+                    for (old, new) in mapping]))
+            # field remapping
+            if fieldMap:
+                self.startProgress(4)
                 self.updateProgress(_("Changing fields..."))
-                seen[new] = 1
-                if new:
-                    # can rename
+                renamed = [(old, new) for (old, new) in fieldMap.items()
+                           if new]
+                if renamed:
                     self.s.statement("""
-update fields set
-fieldModelId = :new,
-ordinal = :ord
-where fieldModelId = :old
-and factId in %s""" % fids, new=new.id, ord=new.ordinal, old=old.id)
-                else:
-                    # no longer used
-                    self.s.statement("""
-delete from fields where factId in %s
-and fieldModelId = :id""" % fids, id=old.id)
-            # new
-            for field in newModel.fieldModels:
+update fields set fieldModelId = %s, ordinal = %s
+where factId in %s and fieldModelId in %s""" % (
+                        remap("fieldModelId",
+                              [(old.id, new.id) for (old, new) in renamed]),
+                        remap("fieldModelId",
+                              [(old.id, new.ordinal)
+                               for (old, new) in renamed]),
+                        fids, ids2str([old.id for (old, new) in renamed])))
+                # no longer used
+                self.s.statement("""
+delete from fields where factId in %s and fieldModelId in %s""" % (
+                    fids, ids2str([old.id for (old, new) in fieldMap.items()
+                                   if not new])))
+                # new
                 self.updateProgress()
-                if field not in seen:
-                    d = [{'id': genID(),
-                          'fid': f,
-                          'fmid': field.id,
-                          'ord': field.ordinal}
-                         for f in factIds]
+                seen = fieldMap.values()
+                d = [{'id': genID(),
+                      'fid': f,
+                      'fmid': field.id,
+                      'ord': field.ordinal}
+                     for field in newModel.fieldModels if field not in seen
+                     for f in factIds]
+                if d:
                     self.s.statements('''
 insert into fields
 (id, factId, fieldModelId, ordinal, value)
 values
 (:id, :fid, :fmid, :ord, "")''', d)
-            # fact modtime
-            self.updateProgress()
-            self.s.statement("""
+                # fact modtime
+                self.updateProgress()
+                self.s.statement("""
 update facts set
 modified = :t,
 modelId = :id
 where id in %s""" % fids, t=time.time(), id=newModel.id)
-            self.finishProgress()
-        # template remapping
-        self.startProgress(len(cardMap)+4)
-        toChange = []
-        self.updateProgress(_("Changing cards..."))
-        for (old, new) in cardMap.items():
-            if not new:
-                # delete
+                self.finishProgress()
+            # template remapping
+            self.startProgress(5)
+            self.updateProgress(_("Changing cards..."))
+            self.s.statement("""
+delete from cards where factId in %s and cardModelId in %s""" % (
+                fids, ids2str([old.id for (old, new) in cardMap.items()
+                               if not new])))
+            renamed = [(old, new) for (old, new) in cardMap.items()
+                       if new and old != new]
+            if renamed:
                 self.s.statement("""
-delete from cards
-where cardModelId = :cid and
-factId in %s""" % fids, cid=old.id)
-            elif old != new:
-                # gather ids so we can rename x->y and y->x
-                ids = self.s.column0("""
-select id from cards where
-cardModelId = :id and factId in %s""" % fids, id=old.id)
-                toChange.append((new, ids))
-        for (new, ids) in toChange:
+update cards set cardModelId = %s, ordinal = %s
+where factId in %s and cardModelId in %s""" % (
+                    remap("cardModelId",
+                          [(old.id, new.id) for (old, new) in renamed]),
+                    remap("cardModelId",
+                          [(old.id, new.ordinal) for (old, new) in renamed]),
+                    fids, ids2str([old.id for (old, new) in renamed])))
+            # rebuild caches for the affected cards. these stay three
+            # passes: q/a is rendered in python from the fields, while
+            # priorities are aggregated in sql from the cardTags rows the
+            # tag pass writes, so each reads different rows
+            cards = self.s.rawAll("""
+select id, cardModelId, factId, :mid from cards
+where factId in %s""" % fids, mid=newModel.id)
+            cardIds = [c[0] for c in cards]
+            self.s.dropIdSet("changeFacts")
             self.updateProgress()
-            self.s.statement("""
-update cards set
-cardModelId = :new,
-ordinal = :ord
-where id in %s""" % ids2str(ids), new=new.id, ord=new.ordinal)
-        self.updateProgress()
-        self.updateCardQACacheFromIds(factIds, type="facts")
-        self.flushMod()
-        self.updateProgress()
-        cardIds = self.s.column0(
-            "select id from cards where factId in %s" %
-            ids2str(factIds))
-        self.updateCardTags(cardIds)
-        self.updateProgress()
-        self.updatePriorities(cardIds)
-        self.updateProgress()
+            self.updateCardQACache(cards)
+            self.flushMod()
+            self.updateProgress()
+            self.updateCardTags(cardIds)
+            self.updateProgress()
+            self.updatePriorities(cardIds)
+            self.updateProgress()
+        finally:
+            self.resumeUndo()
         self.refreshSession()
         self.finishProgress()
 
@@ -1897,7 +2315,13 @@ cards.factId = facts.id and
 facts.modelId = :id""", id=model.id)
         if not ids:
             return
-        self.updateCardQACache(ids, dirty,  build=build)
+        self.suspendUndo({'cards': """id in (select cards.id from cards, facts
+where cards.factId = facts.id and facts.modelId = %d)""" % model.id},
+                         len(ids))
+        try:
+            self.updateCardQACache(ids, dirty,  build=build)
+        finally:
+            self.resumeUndo()
 
     def updateCardsFromFactIds(self, ids, dirty=True):
         "Update all card question/answer when model changes."
@@ -1905,7 +2329,8 @@ facts.modelId = :id""", id=model.id)
 select cards.id, cards.cardModelId, cards.factId, facts.modelId from
 cards, facts where
 cards.factId = facts.id and
-facts.id in %s""" % ids2str(ids))
+facts.id in %s""" % self.s.idSet("updateFacts", ids))
+        self.s.dropIdSet("updateFacts")
         if not ids:
             return
         self.updateCardQACache(ids, dirty)
@@ -1915,12 +2340,14 @@ facts.id in %s""" % ids2str(ids))
         if type == "facts":
             # convert to card ids
             ids = self.s.column0(
-                "select id from cards where factId in %s" % ids2str(ids))
+                "select id from cards where factId in %s" %
+                self.s.idSet("updateCards", ids))
         rows = self.s.all("""
 select c.id, c.cardModelId, f.id, f.modelId
 from cards as c, facts as f
 where c.factId = f.id
-and c.id in %s""" % ids2str(ids))
+and c.id in %s""" % self.s.idSet("updateCards", ids))
+        self.s.dropIdSet("updateCards")
         self.updateCardQACache(rows,  build=build)
 
     def updateCardQACache(self, ids, dirty=True, build=True):
@@ -1930,18 +2357,18 @@ and c.id in %s""" % ids2str(ids))
         else:
             mod = ""
         # tags
-        cids = ids2str([x[0] for x in ids])
+        cids = self.s.idSet("cacheCards", [x[0] for x in ids])
         tags = dict([(x[0], x[1:]) for x in
                      self.splitTagsList(
             where="and cards.id in %s" % cids)])
         facts = {}
         # fields
-        for k, g in groupby(self.s.all("""
+        for k, g in groupby(self.s.rawAll("""
 select fields.factId, fieldModels.name, fieldModels.id, fields.value
 from fields, fieldModels where fields.factId in %s and
 fields.fieldModelId = fieldModels.id
-order by fields.factId""" % ids2str([x[2] for x in ids])),
-                            itemgetter(0)):
+order by fields.factId""" % self.s.idSet(
+            "cacheFacts", [x[2] for x in ids])), itemgetter(0)):
             facts[k] = dict([(r[1], (r[2], r[3])) for r in g])
         # card models
         cms = {}
@@ -1974,23 +2401,27 @@ order by fields.factId""" % ids2str([x[2] for x in ids])),
                 if not cnt:
                     continue
                 updateMediaCount(self, f, cnt)
-            # update q/a
+            # update q/a, skipping cards which haven't changed
             self.s.execute("""
     update cards set
     question = :question, answer = :answer
     %s
-    where id = :id""" % mod, pend)
+    where id = :id and (question != :question or answer != :answer)""" % mod,
+                           pend)
             # update fields cache
             self.updateFieldCache(facts.keys())
+        self.s.dropIdSet("cacheCards", "cacheFacts")
         if dirty:
             self.flushMod()
 
     def updateFieldCache(self, fids):
         "Add stripped HTML cache for sorting/searching."
         try:
-            all = self.s.all(
+            all = self.s.rawAll(
                 ("select factId, group_concat(value, ' ') from fields "
-                 "where factId in %s group by factId") % ids2str(fids))
+                 "where factId in %s group by factId") %
+                self.s.idSet("fieldCache", fids))
+            self.s.dropIdSet("fieldCache")
         except:
             # older sqlite doesn't support group_concat. this code taken from
             # the wm port
@@ -2007,7 +2438,8 @@ order by fields.factId""" % ids2str([x[2] for x in ids])),
         for a in all:
             r.append({'id':a[0], 'v':stripHTMLMedia(a[1])})
         self.s.statements(
-            "update facts set spaceUntil=:v where id=:id", r)
+            "update facts set spaceUntil=:v where id=:id and spaceUntil is not :v",
+            r)
 
     def rebuildCardOrdinals(self, ids):
         "Update all card models in IDS. Caller must update model modtime."
@@ -2444,17 +2876,20 @@ where id = :id""", pending)
                 query += " where "
                 hasWhere = True
             else: query += " and "
-            query += " factId IN %s" % ids2str(factIdList)
+            query += " factId IN %s" % self.s.idSet(
+                "findFacts", factIdList)
         if cardIdList is not None:
             if hasWhere is False:
                 query += " where "
                 hasWhere = True
             else: query += " and "
-            query += " id IN %s" % ids2str(cardIdList)
+            query += " id IN %s" % self.s.idSet("findCards", cardIdList)
         if showdistinct:
             query += " group by factId"
         #print query, args
-        return self.s.column0(query, **args)
+        ids = self.s.column0(query, **args)
+        self.s.dropIdSet("findFacts", "findCards")
+        return ids
 
     def findCardsWhere(self, query):
         (tquery, fquery, qquery, fidquery, cmquery, sfquery, qaquery,
@@ -3071,25 +3506,38 @@ Return new path, relative to media dir."""
 
     def save(self):
         "Commit any pending changes to disk."
+        self.flushReviews()
         if self.lastLoaded == self.modified:
             return
         self.lastLoaded = self.modified
         self.s.commit()
 
     def close(self):
+        self.cancelJobs()
         if self.s:
             self.s.rollback()
             self.s.clear()
             self.s.close()
+        if self._readEngine:
+            self._readEngine.dispose()
+            self._readEngine = None
+        if self.walMode:
+            # leave the file readable by older sqlite versions
+            try:
+                self.engine.execute("pragma journal_mode = delete")
+            except OperationalError:
+                pass
         self.engine.dispose()
         runHook("deckClosed")
 
     def rollback(self):
         "Roll back the current transaction and reset session state."
+        self._pendingReviews = []
         self.s.rollback()
         self.s.clear()
         self.s.update(self)
         self.s.refresh(self)
+        self.loadStats()
 
     def refreshSession(self):
         "Flush and expire all items from the session."
@@ -3099,6 +3547,7 @@ Return new path, relative to media dir."""
     def openSession(self):
         "Open a new session. Assumes old session is already closed."
         self.s = SessionHelper(self.Session(), lock=self.needLock)
+        self.s.profiler = self.profiler
         self.s.update(self)
         self.refreshSession()
 
@@ -3126,6 +3575,7 @@ Return new path, relative to media dir."""
     def saveAs(self, newPath):
         "Returns new deck. Old connection is closed without saving."
         oldMediaDir = self.mediaDir()
+        self.flushReviews()
         self.s.flush()
         # remove new deck if it exists
         try:
@@ -3134,28 +3584,7 @@ Return new path, relative to media dir."""
             pass
         self.startProgress()
         # copy tables, avoiding implicit commit on current db
-        DeckStorage.Deck(newPath, backup=False).close()
-        new = sqlite.connect(newPath)
-        for table in self.s.column0(
-            "select name from sqlite_master where type = 'table'"):
-            if table.startswith("sqlite_"):
-                continue
-            new.execute("delete from %s" % table)
-            cols = [str(x[1]) for x in new.execute(
-                "pragma table_info('%s')" % table).fetchall()]
-            q = "select 'insert into %(table)s values("
-            q += ",".join(["'||quote(\"" + col + "\")||'" for col in cols])
-            q += ")' from %(table)s"
-            q = q % {'table': table}
-            c = 0
-            for row in self.s.execute(q):
-                new.execute(row[0])
-                if c % 1000:
-                    self.updateProgress()
-                c += 1
-        # save new, close both
-        new.commit()
-        new.close()
+        copyDB(self.s.connection().connection, newPath, self.updateProgress)
         self.close()
         # open again in orm
         newDeck = DeckStorage.Deck(newPath, backup=False)
@@ -3169,6 +3598,100 @@ Return new path, relative to media dir."""
         self.finishProgress()
         return newDeck
 
+    # Read-only connections
+    ##########################################################################
+    # Decks opened with wal=True can be read from other connections while
+    # the main session holds its write lock. Readers see the deck as of the
+    # last save().
+
+    def readSession(self, fresh=False):
+        """Return a read-only session on a pooled connection of its own, which
+may be used from another thread. Close it with closeReadSession(). If the
+deck wasn't opened in WAL mode, return the main session. If FRESH, the caller
+needs unsaved changes too, and gets the main session while there are any."""
+        if not self.walMode:
+            return self.s
+        if fresh and self.modifiedSinceSave():
+            return self.s
+        if not self._readEngine:
+            self._readEngine = create_engine(
+                "sqlite:///" + self.path.encode("utf-8"),
+                poolclass=QueuePool,
+                pool_size=self.readerPoolSize,
+                max_overflow=0,
+                listeners=[ReadOnlyListener()],
+                connect_args={'timeout': 60,
+                              'check_same_thread': False})
+            self._ReadSession = sessionmaker(bind=self._readEngine,
+                                             autoflush=False,
+                                             autocommit=True)
+        return SessionHelper(self._ReadSession(), transaction=False)
+
+    def closeReadSession(self, s):
+        "Return a session from readSession() to the pool."
+        if s is not self.s:
+            s.close()
+
+    # Background jobs
+    ##########################################################################
+    # Long-running maintenance is split into work which only reads, done in
+    # a thread, and the changes, made on the deck's thread. See anki.jobs.
+
+    def startJob(self, name, work, apply=None):
+        """Start a job calling WORK(job, s) with a session from readSession(),
+and APPLY(result) from the next finishJobs() after it's done. Return the
+job. Without WAL mode, the work is done before returning."""
+        job = Job(name, work, apply)
+        self._jobs.append(job)
+        s = self.readSession()
+        if s is self.s:
+            job.run(s)
+        else:
+            job.thread = threading.Thread(target=self._runJob, args=(job, s))
+            job.thread.setDaemon(True)
+            job.thread.start()
+        return job
+
+    def _runJob(self, job, s):
+        try:
+            job.run(s)
+        finally:
+            self.closeReadSession(s)
+
+    def finishJobs(self, wait=False):
+        """Apply the changes of jobs whose work is done, in the order they
+were started. If WAIT, wait for all jobs. Return the number left."""
+        while self._jobs:
+            job = self._jobs[0]
+            if not job.ready() and not wait:
+                break
+            self._jobs.pop(0)
+            job.finish()
+        return len(self._jobs)
+
+    def cancelJobs(self):
+        "Cancel all jobs and wait for their threads to stop."
+        for job in self._jobs:
+            job.cancel()
+        self.finishJobs(wait=True)
+
+    # Profiling
+    ##########################################################################
+
+    def startProfiling(self, profiler=None):
+        "Record queries on the main session, and return the profiler."
+        self.profiler = profiler or Profiler()
+        self.s.profiler = self.profiler
+        return self.profiler
+
+    def stopProfiling(self):
+        "Stop recording queries, and return the profiler."
+        p = self.profiler
+        self.profiler = None
+        if self.s:
+            self.s.profiler = None
+        return p
+
     # Syncing
     ##########################################################################
     # toggling does not bump deck mod time, since it may happen on upgrade,
@@ -3231,12 +3754,41 @@ where id = :id""", fid=f.id, cmid=m.cardModels[0].id, id=id)
         # restore old model
         self.currentModel = last
 
+    def integrityReport(self, s=None):
+        """Run the integrity checks without changing anything, on session S
+if provided. Return a dict of check name -> number of problems found."""
+        s = s or self.s
+        report = dict([(name, len(s.column0(sql)))
+                       for (name, sql) in integrityChecks])
+        report['cardCounts'] = len(self.checkCardCounts(s))
+        return report
+
+    def checkIntegrityJob(self):
+        """Run the integrity checks as a background job, calling
+fixIntegrity() from finishJobs() if they found anything. The job's result
+is that of fixIntegrity(). See startJob()."""
+        def work(job, s):
+            job.update(0, len(integrityChecks) + 1,
+                       _("Checking integrity..."))
+            # a pragma would commit the main session
+            if s is not self.s and s.scalar("pragma quick_check") != "ok":
+                return False
+            for (n, (name, sql)) in enumerate(integrityChecks):
+                job.update(n + 1)
+                if s.first(sql):
+                    return False
+            return True
+        def apply(clean):
+            if clean:
+                return "ok"
+            return self.fixIntegrity()
+        return self.startJob(_("Check Database"), work, apply)
+
     def fixIntegrity(self, quick=False):
         "Fix some problems and rebuild caches. Caller must .reset()"
         self.s.commit()
         self.resetUndo()
         problems = []
-        recover = False
         if quick:
             num = 4
         else:
@@ -3247,6 +3799,32 @@ where id = :id""", fid=f.id, cmid=m.cardModels[0].id, id=id)
             self.finishProgress()
             return _("Database file is damaged.\n"
                      "Please restore from automatic backup (see FAQ).")
+        # undo has been reset, so there's no need to log our changes
+        self.suspendUndo()
+        try:
+            recover = self._repairDeck(problems, quick)
+        finally:
+            self.resumeUndo()
+        # update deck and save
+        if not quick:
+            self.flushMod()
+            self.save()
+        self.refreshSession()
+        self.finishProgress()
+        if problems:
+            if recover:
+                problems.append("\n" + _("""\
+Cards with corrupt or missing facts have been placed into new facts. \
+Your scheduling info and card content has been preserved, but the \
+original layout of the facts has been lost."""))
+            return "\n".join(problems)
+        return "ok"
+
+    def _repairDeck(self, problems, quick):
+        """Repair the deck for fixIntegrity(), adding a line to PROBLEMS for
+each problem fixed. Return True if any cards were recovered."""
+        recover = False
+        checks = dict(integrityChecks)
         # ensure correct views and indexes are available
         self.updateProgress()
         DeckStorage._addViews(self)
@@ -3263,9 +3841,7 @@ decks.currentModelId = models.id"""):
             self.currentModelId = self.models[0].id
             problems.append(_("The current model didn't exist"))
         # fields missing a field model
-        ids = self.s.column0("""
-select id from fields where fieldModelId not in (
-select distinct id from fieldModels)""")
+        ids = self.s.column0(checks['fieldsMissingFieldModel'])
         if ids:
             self.s.statement("delete from fields where id in %s" %
                              ids2str(ids))
@@ -3273,18 +3849,14 @@ select distinct id from fieldModels)""")
                             "Deleted %d fields with missing field model", len(ids)) %
                             len(ids))
         # facts missing a field?
-        ids = self.s.column0("""
-select distinct facts.id from facts, fieldModels where
-facts.modelId = fieldModels.modelId and fieldModels.id not in
-(select fieldModelId from fields where factId = facts.id)""")
+        ids = self.s.column0(checks['factsMissingFields'])
         if ids:
             self.deleteFacts(ids)
             problems.append(ngettext("Deleted %d fact with missing fields",
                             "Deleted %d facts with missing fields", len(ids)) %
                             len(ids))
         # cards missing a fact?
-        ids = self.s.column0("""
-select id from cards where factId not in (select id from facts)""")
+        ids = self.s.column0(checks['cardsMissingFact'])
         if ids:
             recover = True
             self.recoverCards(ids)
@@ -3292,9 +3864,7 @@ select id from cards where factId not in (select id from facts)""")
                             "Recovered %d cards with missing fact", len(ids)) %
                             len(ids))
         # cards missing a card model?
-        ids = self.s.column0("""
-select id from cards where cardModelId not in
-(select id from cardModels)""")
+        ids = self.s.column0(checks['cardsMissingCardModel'])
         if ids:
             recover = True
             self.recoverCards(ids)
@@ -3302,10 +3872,7 @@ select id from cards where cardModelId not in
                             "Recovered %d cards with no card template", len(ids)) %
                             len(ids))
         # cards with a card model from the wrong model
-        ids = self.s.column0("""
-select id from cards where cardModelId not in (select cm.id from
-cardModels cm, facts f where cm.modelId = f.modelId and
-f.id = cards.factId)""")
+        ids = self.s.column0(checks['cardsWrongCardModel'])
         if ids:
             recover = True
             self.recoverCards(ids)
@@ -3319,8 +3886,7 @@ f.id = cards.factId)""")
                             "Deleted %d facts with no cards", len(ids)) %
                             len(ids))
         # dangling fields?
-        ids = self.s.column0("""
-select id from fields where factId not in (select id from facts)""")
+        ids = self.s.column0(checks['danglingFields'])
         if ids:
             self.s.statement(
                 "delete from fields where id in %s" % ids2str(ids))
@@ -3345,42 +3911,49 @@ select id from fields where factId not in (select id from facts)""")
             self.updateProgress(_("Updating ordinals..."))
             self.s.statement("""
 update fields set ordinal = (select ordinal from fieldModels
+where id = fieldModelId) where ordinal != (select ordinal from fieldModels
 where id = fieldModelId)""")
-            # fix problems with stripping html
+            # fix problems with stripping html. only fields containing
+            # something tidyHTML() would change are read back
             self.updateProgress(_("Rebuilding QA cache..."))
-            fields = self.s.all("select id, value from fields")
+            fields = self.s.all("""
+select id, factId, value from fields where value like '%<p%' or
+value like '%<br>' or value like '%style=%' or value like '%<body%' or
+value like '%<table>%' or value like '%-qt-%' or value like :nl""",
+                                nl="%\n%")
             newFields = []
-            for (id, value) in fields:
-                newFields.append({'id': id, 'value': tidyHTML(value)})
-            self.s.statements(
-                "update fields set value=:value where id=:id",
-                newFields)
-            # regenerate question/answer cache
+            fids = set()
+            for (id, fid, value) in fields:
+                new = tidyHTML(value)
+                if new != value:
+                    newFields.append({'id': id, 'value': new})
+                    fids.add(fid)
+            if newFields:
+                self.s.statements(
+                    "update fields set value=:value where id=:id",
+                    newFields)
+                self.s.statement(
+                    "update facts set modified = :t where id in %s" %
+                    ids2str(fids), t=time.time())
+            # regenerate question/answer cache. only cards whose text
+            # changed are written, and marked modified
             for m in self.models:
-                self.updateCardsFromModel(m, dirty=False)
-            # force a full sync
-            self.s.flush()
-            self.s.statement("update cards set modified = :t", t=time.time())
-            self.s.statement("update facts set modified = :t", t=time.time())
-            self.s.statement("update models set modified = :t", t=time.time())
-            self.lastSync = 0
+                self.updateCardsFromModel(m)
+            # if anything was repaired, force a full sync
+            if problems:
+                self.s.flush()
+                self.s.statement("update cards set modified = :t", t=time.time())
+                self.s.statement("update facts set modified = :t", t=time.time())
+                self.s.statement("update models set modified = :t", t=time.time())
+                self.lastSync = 0
+            # card counts aren't synced, so they don't need a full sync
+            if self.checkCardCounts():
+                self.rebuildCardCounts()
+                problems.append(_("Rebuilt card counts"))
             # rebuild
             self.updateProgress(_("Rebuilding types..."))
             self.rebuildTypes()
-        # update deck and save
-        if not quick:
-            self.flushMod()
-            self.save()
-        self.refreshSession()
-        self.finishProgress()
-        if problems:
-            if recover:
-                problems.append("\n" + _("""\
-Cards with corrupt or missing facts have been placed into new facts. \
-Your scheduling info and card content has been preserved, but the \
-original layout of the facts has been lost."""))
-            return "\n".join(problems)
-        return "ok"
+        return recover
 
     def optimize(self):
         oldSize = os.stat(self.path)[stat.ST_SIZE]
@@ -3390,48 +3963,92 @@ original layout of the facts has been lost."""))
         newSize = os.stat(self.path)[stat.ST_SIZE]
         return oldSize - newSize
 
+    # Review journal
+    ##########################################################################
+    # Answering a card only updates the card. The review history and
+    # changes to the statistics are kept in _pendingReviews and written
+    # every pendingReviewLimit answers, and before anything which reads them
+    # or commits. Nothing is lost by this, as changes only reach the disk on
+    # save(). The GUI may also call flushReviews() when idle.
+
+    def flushReviews(self):
+        "Write any buffered review history and statistics."
+        if not self._pendingReviews:
+            return
+        pending = self._pendingReviews
+        self._pendingReviews = []
+        if not self.undoEnabled:
+            self.s.statements(CardHistoryEntry.insertSQL,
+                              [p[1] for p in pending])
+            self.s.statements(anki.stats.Stats.deltaSQL,
+                              [st for p in pending for st in p[2]])
+            return
+        # each answer's rows are written separately, and their range of the
+        # undo log added to the answer's step, so they're undone with it
+        for (step, entry, deltas) in pending:
+            start = self._latestUndoRow()
+            self.s.statement(CardHistoryEntry.insertSQL, **entry)
+            self.s.statements(anki.stats.Stats.deltaSQL, deltas)
+            if step:
+                step[4].append((start, self._latestUndoRow()))
+
     # Undo/redo
     ##########################################################################
 
     def initUndo(self):
-        # note this code ignores 'unique', as it's an sqlite reserved word
         self.undoStack = []
         self.redoStack = []
         self.undoEnabled = True
-        self.s.statement(
-            "create temporary table undoLog (seq integer primary key not null, sql text)")
-        tables = self.s.column0(
-            "select name from sqlite_master where type = 'table'")
-        for table in tables:
-            if table in ("undoLog", "sqlite_stat1"):
-                continue
-            columns = [r[1] for r in
-                       self.s.all("pragma table_info(%s)" % table)]
+        self.undoOpen = False
+        self.undoSuspended = []
+        self.undoSnapshots = 0
+        # inserts are logged as a bare rowid (sql is null), so they can be
+        # undone as one delete per table
+        self.s.statement("""
+create temporary table undoLog (seq integer primary key not null,
+tbl text, rid integer, sql text)""")
+        # tables whose changes aren't currently being logged
+        self.s.statement("""
+create temporary table undoSuspended (tbl text primary key)""")
+        # ids of the rows a bulk change touches, for snapshot conditions
+        self.s.statement("""
+create temporary table undoIds (undoStep integer not null,
+id integer not null, primary key (undoStep, id))""")
+        self._initUndoTriggers()
+
+    def _initUndoTriggers(self):
+        # note this code ignores 'unique', as it's an sqlite reserved word
+        for table in self._undoTables():
+            columns = self.s.execute(
+                "select * from %s limit 0" % table).keys()
+            updatable = [c for c in columns if c != "unique"]
+            active = ("not exists (select 1 from undoSuspended "
+                      "where tbl = '%s')" % table)
             # insert
             self.s.statement("""
 create temp trigger _undo_%(t)s_it
-after insert on %(t)s begin
-insert into undoLog values
-(null, 'delete from %(t)s where rowid = ' || new.rowid); end""" % {'t': table})
-            # update
-            sql = """
+after insert on %(t)s when %(a)s begin
+insert into undoLog values (null, '%(t)s', new.rowid, null); end""" % {
+                't': table, 'a': active})
+            # update - only the changed columns are logged
+            self.s.statement("""
 create temp trigger _undo_%(t)s_ut
-after update on %(t)s begin
-insert into undoLog values (null, 'update %(t)s """ % {'t': table}
-            sep = "set "
-            for c in columns:
-                if c == "unique":
-                    continue
-                sql += "%(s)s%(c)s=' || quote(old.%(c)s) || '" % {
-                    's': sep, 'c': c}
-                sep = ","
-            sql += " where rowid = ' || old.rowid); end"
-            self.s.statement(sql)
+after update on %(t)s when (%(w)s) and %(a)s begin
+insert into undoLog values (null, '%(t)s', old.rowid, 'update %(t)s set ' ||
+substr(%(c)s, 2) || ' where rowid = ' || old.rowid); end""" % {
+                't': table, 'a': active,
+                'w': " or ".join(["old.%s is not new.%s" % (c, c)
+                                  for c in updatable]),
+                'c': " || ".join([
+                "(case when old.%(c)s is not new.%(c)s then "
+                "',%(c)s=' || quote(old.%(c)s) else '' end)" % {'c': c}
+                for c in updatable])})
             # delete
             sql = """
 create temp trigger _undo_%(t)s_dt
-before delete on %(t)s begin
-insert into undoLog values (null, 'insert into %(t)s (rowid""" % {'t': table}
+before delete on %(t)s when %(a)s begin
+insert into undoLog values (null, '%(t)s', old.rowid,
+'insert into %(t)s (rowid""" % {'t': table, 'a': active}
             for c in columns:
                 sql += ",\"%s\"" % c
             sql += ") values (' || old.rowid ||'"
@@ -3442,6 +4059,17 @@ insert into undoLog values (null, 'insert into %(t)s (rowid""" % {'t': table}
                 sql += ",' || quote(old.%s) ||'" % c
             sql += ")'); end"
             self.s.statement(sql)
+            # storage for bulk change snapshots
+            self.s.statement("""
+create temporary table undoSnapshot_%s as
+select 0 as undoStep, rowid as undoRowid, * from %s where 0""" % (
+                table, table))
+
+    def _undoTables(self):
+        # cardCounts is kept by triggers, which also fire on undo
+        return [t for t in self.s.column0(
+            "select name from sqlite_master where type = 'table'")
+                if t not in ("undoLog", "sqlite_stat1", "cardCounts")]
 
     def undoName(self):
         for n in reversed(self.undoStack):
@@ -3466,6 +4094,8 @@ insert into undoLog values (null, 'insert into %(t)s (rowid""" % {'t': table}
             self.s.statement("delete from undoLog")
         except:
             pass
+        if self.undoEnabled:
+            self._dropSnapshots(self.undoStack + self.redoStack)
         self.undoStack = []
         self.redoStack = []
 
@@ -3473,35 +4103,178 @@ insert into undoLog values (null, 'insert into %(t)s (rowid""" % {'t': table}
         if not self.undoStack or self.undoStack[-1] is not None:
             self.undoStack.append(None)
 
-    def setUndoStart(self, name, merge=False):
+    def setUndoStart(self, name, merge=False, flush=True):
+        """Open an undo step called NAME. Buffered reviews are written first
+unless FLUSH is false, so they aren't logged as part of the step."""
         if not self.undoEnabled:
             return
+        if flush:
+            self.flushReviews()
         self.s.flush()
+        self.undoOpen = True
         if merge and self.undoStack:
             if self.undoStack[-1] and self.undoStack[-1][0] == name:
                 # merge with last entry?
                 return
         start = self._latestUndoRow()
-        self.undoStack.append([name, start, None])
+        self.undoStack.append([name, start, None, [], []])
 
     def setUndoEnd(self, name):
         if not self.undoEnabled:
             return
         self.s.flush()
+        self.undoOpen = False
         end = self._latestUndoRow()
         while self.undoStack[-1] is None:
             # strip off barrier
             self.undoStack.pop()
         self.undoStack[-1][2] = end
-        if self.undoStack[-1][1] == self.undoStack[-1][2]:
+        if (self.undoStack[-1][1] == self.undoStack[-1][2] and
+            not self.undoStack[-1][3]):
             self.undoStack.pop()
         else:
+            self._dropSnapshots(self.redoStack)
             self.redoStack = []
+            self._trimUndo()
         runHook("undoEnd")
 
+    def _trimUndo(self):
+        """Forget the oldest undo steps while the log and snapshots hold over
+undoLimit rows."""
+        if self._undoSize() <= self.undoLimit:
+            return
+        # always keep the most recent step
+        while (self._undoSize() > self.undoLimit and
+               len([u for u in self.undoStack if u]) > 1):
+            self._dropSnapshots([self.undoStack.pop(0)])
+        self.s.statement("delete from undoLog where seq <= :s",
+                         s=self._firstUndoRow())
+
+    def _firstUndoRow(self):
+        return min([u[1] for u in self.undoStack + self.redoStack if u])
+
+    def _undoSize(self):
+        return (self._latestUndoRow() - self._firstUndoRow() +
+                sum([snap[3] for u in self.undoStack + self.redoStack if u
+                     for snap in u[3]]))
+
     def _latestUndoRow(self):
         return self.s.scalar("select max(rowid) from undoLog") or 0
 
+    # Bulk changes
+    ##########################################################################
+    # Logging every row of a large change through the triggers roughly
+    # doubles the work. While suspended, changes to the given tables aren't
+    # logged; instead, if an undo step is open, the rows about to change are
+    # copied as they were, and undoing the step puts the copies back.
+    # Everything here is plain DML, as the sqlite module commits before any
+    # DDL.
+
+    def suspendUndo(self, tables=None, count=None, ids=None):
+        """Stop logging changes to TABLES (default all) until resumeUndo().
+TABLES may be a dict mapping each table to a condition selecting the rows
+which will change; only those are snapshotted. The condition should only
+use columns the change leaves alone, so it matches the same rows afterwards.
+IDS maps names to lists of ids or queries returning them. These are stored
+with the step, and the conditions can refer to them as %(name)s.
+If COUNT is provided and smaller than undoBulkRows, nothing is suspended."""
+        if not self.undoEnabled:
+            return
+        if count is not None and count < self.undoBulkRows:
+            self.undoSuspended.append([])
+            return
+        self.s.flush()
+        if isinstance(tables, dict):
+            where = tables
+        else:
+            where = {}
+        suspended = [t for s in self.undoSuspended for t in s]
+        tables = [t for t in (tables or self._undoTables())
+                  if t not in suspended]
+        if self.undoOpen:
+            step = self.undoStack[-1]
+            seq = self._latestUndoRow()
+            keys = []
+            sets = {}
+            for (name, l) in (ids or {}).items():
+                self.undoSnapshots += 1
+                keys.append(self.undoSnapshots)
+                sets[name] = self._storeUndoIds(self.undoSnapshots, l)
+            for table in tables:
+                cond = where.get(table) or "1"
+                if sets:
+                    cond = cond % sets
+                step[3].append(
+                    (seq, table) + self._snapshotTable(table, cond) + (
+                    cond, keys))
+        self._setUndoSuspended(tables, True)
+        self.undoSuspended.append(tables)
+
+    def resumeUndo(self):
+        if not self.undoEnabled:
+            return
+        self.s.flush()
+        self._setUndoSuspended(self.undoSuspended.pop(), False)
+
+    def _setUndoSuspended(self, tables, suspended):
+        for table in tables:
+            if suspended:
+                self.s.statement(
+                    "insert into undoSuspended values (:t)", t=table)
+            else:
+                self.s.statement(
+                    "delete from undoSuspended where tbl = :t", t=table)
+
+    def _storeUndoIds(self, key, ids):
+        "Store IDS under KEY in undoIds. Return SQL for use after 'in'."
+        if isinstance(ids, basestring):
+            self.s.statement("insert or ignore into undoIds "
+                             "select :k, * from (%s)" % ids, k=key)
+        else:
+            self.s.statements("insert or ignore into undoIds "
+                              "values (:k, :id)",
+                              [{'k': key, 'id': id} for id in ids])
+        return "(select id from undoIds where undoStep = %d)" % key
+
+    def _snapshotTable(self, table, cond):
+        "Copy the rows matching COND. Return (snapshot id, row count)."
+        self.undoSnapshots += 1
+        self.s.statement("""
+insert into undoSnapshot_%s select :n, rowid, * from %s where %s""" % (
+            table, table, cond), n=self.undoSnapshots)
+        return (self.undoSnapshots, self.s.scalar(
+            "select count() from undoSnapshot_%s where undoStep = :n" %
+            table, n=self.undoSnapshots))
+
+    def _restoreTable(self, table, snap, cond):
+        columns = ",".join(['"%s"' % c for c in self.s.execute(
+            "select * from %s limit 0" % table).keys()])
+        self._setUndoSuspended([table], True)
+        # only the snapshotted rows and any added since are replaced, so
+        # triggers on the table don't fire for the rest of it
+        self.s.statement("""
+delete from %(t)s where (%(w)s) or rowid in (
+select undoRowid from undoSnapshot_%(t)s where undoStep = :n)""" % {
+            't': table, 'w': cond}, n=snap)
+        self.s.statement("""
+insert into %(t)s (rowid, %(c)s) select undoRowid, %(c)s
+from undoSnapshot_%(t)s where undoStep = :n""" % {
+            't': table, 'c': columns}, n=snap)
+        self.s.statement(
+            "delete from undoSnapshot_%s where undoStep = :n" % table, n=snap)
+        self._setUndoSuspended([table], False)
+
+    def _dropSnapshots(self, steps):
+        for step in steps:
+            if step:
+                for (seq, table, snap, rows, cond, keys) in step[3]:
+                    self.s.statement(
+                        "delete from undoSnapshot_%s where undoStep = :n" %
+                        table, n=snap)
+                    for key in keys:
+                        self.s.statement(
+                            "delete from undoIds where undoStep = :k", k=key)
+
     def _undoredo(self, src, dst):
         self.s.flush()
         while 1:
@@ -3511,33 +4284,76 @@ insert into undoLog values (null, 'insert into %(t)s (rowid""" % {'t': table}
         (start, end) = (u[1], u[2])
         if end is None:
             end = self._latestUndoRow()
-        sql = self.s.column0("""
-select sql from undoLog where
-seq > :s and seq <= :e order by seq desc""", s=start, e=end)
-        mod = len(sql) / 35
+        # the step's own rows, and those flushed for it later, less any
+        # flushed for other steps while it was open
+        ranges = [(start, end)] + u[4]
+        others = [r for o in self.undoStack + self.redoStack if o
+                  for r in o[4] if r[0] < end and r[1] > start]
+        rows = [r for r in self.s.rawAll("""
+select seq, tbl, rid, sql from undoLog where %s
+order by seq desc""" % " or ".join([
+            "(seq > %d and seq <= %d)" % rng for rng in ranges]))
+                if not [o for o in others if o[0] < r[0] <= o[1]]]
+        mod = len(rows) / 35
         if mod:
             self.startProgress(36)
             self.updateProgress(_("Processing..."))
         newstart = self._latestUndoRow()
-        for c, s in enumerate(sql):
-            if mod and not c % mod:
-                self.updateProgress()
-            self.engine.execute(s)
+        snaps = []
+        # replay the log, putting snapshotted tables back at the point they
+        # were taken
+        bounds = sorted(u[3], reverse=True)
+        while rows or bounds:
+            if bounds:
+                seq = bounds[0][0]
+                n = len([r for r in rows if r[0] > seq])
+            else:
+                n = len(rows)
+            self._replayUndo(rows[:n], mod)
+            rows = rows[n:]
+            if bounds:
+                # the ids stay stored under the same key for the new step
+                (seq, table, snap, count, cond, keys) = bounds.pop(0)
+                snaps.append((self._latestUndoRow(), table) +
+                             self._snapshotTable(table, cond) + (cond, keys))
+                self._restoreTable(table, snap, cond)
         newend = self._latestUndoRow()
-        dst.append([u[0], newstart, newend])
+        dst.append([u[0], newstart, newend, snaps, []])
         if mod:
             self.finishProgress()
 
+    def _replayUndo(self, rows, mod):
+        cur = self.s.connection().connection.cursor()
+        # undo runs of inserts into the same table with a single delete
+        for ((tbl, insert), group) in groupby(
+            rows, key=lambda r: (r[1], r[3] is None)):
+            group = list(group)
+            if insert:
+                for i in range(0, len(group), 500):
+                    cur.execute("delete from %s where rowid in %s" % (
+                        tbl, ids2str([r[2] for r in group[i:i+500]])))
+            else:
+                for r in group:
+                    cur.execute(r[3])
+            for r in group:
+                if mod and not r[0] % mod:
+                    self.updateProgress()
+        cur.close()
+
     def undo(self):
         "Undo the last action(s). Caller must .reset()"
+        self.flushReviews()
         self._undoredo(self.undoStack, self.redoStack)
         self.refreshSession()
+        self.loadStats()
         runHook("postUndoRedo")
 
     def redo(self):
         "Redo the last action(s). Caller must .reset()"
+        self.flushReviews()
         self._undoredo(self.redoStack, self.undoStack)
         self.refreshSession()
+        self.loadStats()
         runHook("postUndoRedo")
 
     # Dynamic indices
@@ -3572,19 +4388,20 @@ seq > :s and seq <= :e order by seq desc""", s=start, e=end)
             required.append("dueDesc")
         # add/delete
         analyze = False
+        existing = self.s.column0(
+            "select name from sqlite_master where type = 'index'")
         for (k, v) in indices.items():
             n = "ix_cards_%s2" % k
             if k in required:
-                if not self.s.scalar(
-                    "select 1 from sqlite_master where name = :n", n=n):
+                if n not in existing:
                     self.s.statement(
                         "create index %s on cards %s" %
                         (n, v))
                     analyze = True
-            else:
+            elif n in existing:
                 # leave old indices for older clients
                 #self.s.statement("drop index if exists ix_cards_%s" % k)
-                self.s.statement("drop index if exists %s" % n)
+                self.s.statement("drop index %s" % n)
         if analyze:
             self.s.statement("analyze")
 
@@ -3622,8 +4439,18 @@ backupDir = os.path.expanduser("~/.anki/backups")
 
 class DeckStorage(object):
 
-    def Deck(path=None, backup=True, lock=True, pool=True, rebuild=True,  build=True):
-        "Create a new deck or attach to an existing one."
+    def Deck(path=None, backup=True, lock=True, pool=True, rebuild=True,  build=True,
+             wal=False):
+        """Create a new deck or attach to an existing one. If WAL is true,
+the deck is opened in write-ahead log mode, so readSession() connections
+can read it while it's open."""
+        # (phase, seconds) pairs, available as deck.openTimings
+        timings = []
+        last = [time.time()]
+        def phase(name):
+            now = time.time()
+            timings.append((name, now - last[0]))
+            last[0] = now
         create = True
         if path is None:
             sqlpath = None
@@ -3681,10 +4508,19 @@ class DeckStorage(object):
                         deck.progressHandler, 100)
                 except:
                     print "please install pysqlite 2.4 for better progress dialogs"
-            deck.engine.execute("pragma locking_mode = exclusive")
+            deck.walMode = bool(wal and path)
+            deck._readEngine = None
+            if deck.walMode:
+                # other connections need the shared lock to read. the log
+                # is folded back in first, as backups copy the main file
+                deck.engine.execute("pragma journal_mode = wal")
+                deck.engine.execute("pragma wal_checkpoint")
+            else:
+                deck.engine.execute("pragma locking_mode = exclusive")
             deck.s = SessionHelper(s, lock=lock)
             # force a write lock
             deck.s.execute("update decks set modified = modified")
+            phase("open")
             needUnpack = False
             if deck.utcOffset in (-1, -2):
                 # do the rest later
@@ -3704,12 +4540,15 @@ class DeckStorage(object):
                 initTagTables(deck.s)
                 DeckStorage._addViews(deck)
                 DeckStorage._addIndices(deck)
+                DeckStorage._addCardCounts(deck)
                 deck.s.statement("analyze")
                 deck._initVars()
                 deck.updateTagPriorities()
+                phase("create")
             else:
                 if backup:
                     DeckStorage.backup(deck, path)
+                    phase("backup")
                 deck._initVars()
                 try:
                     deck = DeckStorage._upgradeDeck(deck, path,  build=build)
@@ -3717,6 +4556,7 @@ class DeckStorage(object):
                     traceback.print_exc()
                     deck.fixIntegrity()
                     deck = DeckStorage._upgradeDeck(deck, path,  build=build)
+                phase("upgrade")
         except OperationalError, e:
             engine.dispose()
             if (str(e.orig).startswith("database table is locked") or
@@ -3725,10 +4565,11 @@ class DeckStorage(object):
                                       type="inuse")
             else:
                 raise e
+        deck.openTimings = timings
         if not rebuild:
             # minimal startup
-            deck._globalStats = globalStats(deck)
-            deck._dailyStats = dailyStats(deck)
+            deck.loadStats()
+            phase("stats")
             return deck
         if needUnpack:
             deck.startProgress()
@@ -3750,8 +4591,9 @@ update cards set type = type - 3 where type between 0 and 2 and priority = -3"""
         if deck.delay1 > 7:
             deck.delay1 = 0
         # unsuspend buried/rev early - can remove priorities in the future
-        ids = deck.s.column0(
-            "select id from cards where type > 2 or priority between -2 and -1")
+        ids = deck.s.column0("""
+select id from cards where type > 2 union
+select id from cards where priority between -2 and -1""")
         if ids:
             deck.updatePriorities(ids)
             deck.s.statement(
@@ -3759,13 +4601,10 @@ update cards set type = type - 3 where type between 0 and 2 and priority = -3"""
             deck.s.commit()
         # check if deck has been moved, and disable syncing
         deck.checkSyncHash()
-        # determine starting factor for new cards
-        deck.averageFactor = (deck.s.scalar(
-            "select avg(factor) from cards where type = 1")
-                               or Deck.initialFactor)
-        deck.averageFactor = max(deck.averageFactor, Deck.minimumAverage)
+        phase("housekeeping")
         # rebuild queue
         deck.reset()
+        phase("reset")
         # make sure we haven't accidentally bumped the modification time
         assert deck.modified == oldMod
         return deck
@@ -3779,13 +4618,16 @@ update cards set type = type - 3 where type between 0 and 2 and priority = -3"""
             path = "sqlite:///" + path
         if pool:
             # open and lock connection for single use
-            engine = create_engine(path, connect_args={'timeout': 0},
+            engine = create_engine(path,
+                                   connect_args={'timeout': 0,
+                                                 'cached_statements': 200},
                                    strategy="threadlocal")
         else:
             # no pool & concurrent access w/ timeout
             engine = create_engine(path,
                                    poolclass=NullPool,
-                                   connect_args={'timeout': 60})
+                                   connect_args={'timeout': 60,
+                                                 'cached_statements': 200})
         session = sessionmaker(bind=engine,
                                autoflush=False,
                                autocommit=True)
@@ -3924,6 +4766,42 @@ where type = 2 and isDue = 1
 order by priority desc, due desc""")
     _addViews = staticmethod(_addViews)
 
+    def _addCardCounts(deck):
+        """Add the cardCounts table, and the triggers on cards which keep it
+up to date, and fill it in."""
+        deck.s.statement("""
+create table if not exists cardCounts (type integer not null,
+relativeDelay integer not null, priority integer not null,
+band integer not null, count integer not null,
+primary key (type, relativeDelay, priority, band))""")
+        def add(row, n):
+            # add N to the count for ROW, which is 'new' or 'old'. a conflict
+            # clause here would be overridden by the outer statement's
+            key = ("type = %(r)s.type and relativeDelay = %(r)s.relativeDelay "
+                   "and priority = %(r)s.priority and band = %(b)s")
+            return ("""
+insert into cardCounts select %(r)s.type, %(r)s.relativeDelay,
+%(r)s.priority, %(b)s, 0
+where not exists (select 1 from cardCounts where """ + key + """);
+update cardCounts set count = count + %(n)d where """ + key + ";") % {
+                'r': row, 'b': cardBandSQL % {'r': row}, 'n': n}
+        deck.s.statement("""
+create trigger if not exists cardCounts_insert after insert on cards
+begin %s end""" % add("new", 1))
+        deck.s.statement("""
+create trigger if not exists cardCounts_delete after delete on cards
+begin %s end""" % add("old", -1))
+        deck.s.statement("""
+create trigger if not exists cardCounts_update
+after update of type, relativeDelay, priority, interval, reps on cards
+when old.type != new.type or old.relativeDelay != new.relativeDelay
+or old.priority != new.priority or %s != %s
+begin %s %s end""" % (cardBandSQL % {'r': "old"}, cardBandSQL % {'r': "new"},
+                      add("old", -1), add("new", 1)))
+        deck.cardCountsReady = True
+        deck.rebuildCardCounts()
+    _addCardCounts = staticmethod(_addCardCounts)
+
     def _upgradeDeck(deck, path,  build=True):
         "Upgrade deck to the latest version."
         if deck.version < DECK_VERSION:
@@ -4412,6 +5290,10 @@ this message. (ERR-0101)""") % {
             deck.rebuildTypes()
             deck.version = 65
             deck.s.commit()
+        if not deck.s.scalar(
+            "select 1 from sqlite_master where name = 'cardCounts'"):
+            DeckStorage._addCardCounts(deck)
+            deck.s.commit()
         # executing a pragma here is very slow on large decks, so we store
         # our own record
         if not deck.getInt("pageSize") == 4096:
@@ -4436,53 +5318,7 @@ this message. (ERR-0101)""") % {
         """Path must not be unicode."""
         if not numBackups:
             return
-        def escape(path):
-            path = os.path.abspath(path)
-            path = path.replace("\\", "!")
-            path = path.replace("/", "!")
-            path = path.replace(":", "")
-            return path
-        escp = escape(path)
-        # make sure backup dir exists
-        try:
-            os.makedirs(backupDir)
-        except (OSError, IOError):
-            pass
-        # find existing backups
-        gen = re.sub("\.anki$", ".backup-(\d+).anki", re.escape(escp))
-        backups = []
-        for file in os.listdir(backupDir):
-            m = re.match(gen, file)
-            if m:
-                backups.append((int(m.group(1)), file))
-        backups.sort()
-        # check if last backup is the same
-        if backups:
-            latest = os.path.join(backupDir, backups[-1][1])
-            if int(deck.modified) == int(
-                os.stat(latest)[stat.ST_MTIME]):
-                return
-        # check integrity
-        if not deck.s.scalar("pragma integrity_check") == "ok":
-            raise DeckAccessError(_("Deck is corrupt."), type="corrupt")
-        # get next num
-        if not backups:
-            n = 1
-        else:
-            n = backups[-1][0] + 1
-        # do backup
-        newpath = os.path.join(backupDir, os.path.basename(
-            re.sub("\.anki$", ".backup-%s.anki" % n, escp)))
-        shutil.copy2(path, newpath)
-        # set mtimes to be identical
-        if deck.modified:
-            os.utime(newpath, (deck.modified, deck.modified))
-        # remove if over
-        if len(backups) + 1 > numBackups:
-            delete = len(backups) + 1 - numBackups
-            delete = backups[:delete]
-            for file in delete:
-                os.unlink(os.path.join(backupDir, file[1]))
+        backupDeck(deck, path, backupDir, numBackups)
     backup = staticmethod(backup)
 
 def newCardOrderLabels():
@@ -41,6 +41,10 @@ class SyncError(Error):
     "A problem occurred during syncing."
     pass
 
+class JobCancelled(Error):
+    "A background job was cancelled."
+    pass
+
 # facts, models
 class FactInvalidError(Error):
     """A fact was invalid/not unique according to the model.
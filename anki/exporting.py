@@ -8,16 +8,35 @@ Exporting support
 """
 __docformat__ = 'restructuredtext'
 
-import itertools, time, re, os, HTMLParser
+import itertools, time, re, os
 from operator import itemgetter
 from anki import DeckStorage
 from anki.cards import Card
-from anki.sync import SyncClient, SyncServer, copyLocalMedia
 from anki.lang import _
 from anki.utils import findTag, parseTags, stripHTML, ids2str
 from anki.tags import tagIds
 from anki.db import *
 
+# rows fetched and inserted per batch when copying into a new deck
+exportChunkSize = 1000
+
+# opening and closing span tags. field spans have a class of fm<id>
+spanRe = re.compile(r'<span\b( class="fm[^"]*")?[^>]*>|</span>')
+
+def stripFieldSpans(text):
+    "Remove the field spans formatQA() adds, keeping their contents."
+    stack = []
+    def repl(match):
+        if match.group(0)[1] == "/":
+            if stack and stack.pop():
+                return ""
+            return match.group(0)
+        stack.append(match.group(1) is not None)
+        if stack[-1]:
+            return ""
+        return match.group(0)
+    return spanRe.sub(repl, text)
+
 class Exporter(object):
     def __init__(self, deck):
         self.deck = deck
@@ -25,29 +44,16 @@ class Exporter(object):
         self.limitCardIds = []
 
     def exportInto(self, path):
-        self._escapeCount = 0
         file = open(path, "wb")
         self.doExport(file)
         file.close()
 
     def escapeText(self, text, removeFields=False):
         "Escape newlines and tabs, and strip Anki HTML."
-        from BeautifulSoup import BeautifulSoup as BS
         text = text.replace("\n", "<br>")
         text = text.replace("\t", " " * 8)
         if removeFields:
-            # beautifulsoup is slow
-            self._escapeCount += 1
-            if self._escapeCount % 100 == 0:
-                self.deck.updateProgress()
-            try:
-                s = BS(text)
-                all = s('span', {'class': re.compile("fm.*")})
-                for e in all:
-                    e.replaceWith("".join([unicode(x) for x in e.contents]))
-                text = unicode(s)
-            except HTMLParser.HTMLParseError:
-                pass
+            text = stripFieldSpans(text)
         return text
 
     def cardIds(self):
@@ -64,6 +70,41 @@ class Exporter(object):
         self.count = len(cards)
         return cards
 
+    def _stageCardIds(self):
+        """Store the ids of the cards to export as the id set exportCards,
+and return SQL matching them. Caller must drop the set when finished."""
+        if self.limitCardIds:
+            ids = self.limitCardIds
+        elif not self.limitTags:
+            ids = "select id from cards"
+        else:
+            d = tagIds(self.deck.s, self.limitTags, create=False)
+            ids = "select cardId from cardTags where tagId in %s" % (
+                ids2str(d.values()))
+        cids = self.deck.s.idSet("exportCards", ids)
+        self.count = self.deck.s.scalar(
+            "select count() from cards where id in %s" % cids)
+        return cids
+
+    def _chunks(self, sql):
+        """Run SQL on the deck's DB-API connection, yielding lists of rows.
+This shares the session's transaction, and avoids building row objects."""
+        cur = self.deck.s.connection().connection.cursor()
+        cur.execute(sql)
+        while 1:
+            rows = cur.fetchmany(exportChunkSize)
+            if not rows:
+                break
+            yield rows
+        cur.close()
+
+    def _rows(self, sql):
+        "Like _chunks(), but yield single rows and update progress."
+        for rows in self._chunks(sql):
+            for row in rows:
+                yield row
+            self.deck.updateProgress()
+
 class AnkiExporter(Exporter):
 
     key = _("Anki Deck (*.anki)")
@@ -75,8 +116,8 @@ class AnkiExporter(Exporter):
         self.includeMedia = True
 
     def exportInto(self, path):
-        n = 3
-        if not self.includeSchedulingInfo:
+        n = 6
+        if self.includeSchedulingInfo:
             n += 1
         self.deck.startProgress(n)
         self.deck.updateProgress(_("Exporting..."))
@@ -84,61 +125,30 @@ class AnkiExporter(Exporter):
             os.unlink(path)
         except (IOError, OSError):
             pass
-        self.newDeck = DeckStorage.Deck(path)
-        client = SyncClient(self.deck)
-        server = SyncServer(self.newDeck)
-        client.setServer(server)
-        client.localTime = self.deck.modified
-        client.remoteTime = 0
+        # create an empty deck with the current schema, like saveAs()
+        DeckStorage.Deck(path, backup=False).close()
+        self.deck.flushReviews()
         self.deck.s.flush()
-        # set up a custom change list and sync
-        lsum = self.localSummary()
-        rsum = server.summary(0)
-        self.deck.updateProgress()
-        payload = client.genPayload((lsum, rsum))
+        cids = self._stageCardIds()
+        # copy the selected rows across, one select per table. we can't
+        # attach the new deck to our session, as sqlite commits all attached
+        # databases together, and that would save the user's open changes.
+        dst = sqlite.connect(path.encode("utf-8"))
+        try:
+            self._copyDeck(dst, cids)
+            dst.commit()
+        finally:
+            dst.close()
+            self.deck.s.dropIdSet("exportCards")
         self.deck.updateProgress()
-        res = server.applyPayload(payload)
-        if not self.includeSchedulingInfo:
-            self.deck.updateProgress()
-            self.newDeck.s.statement("""
-delete from reviewHistory""")
-            self.newDeck.s.statement("""
-update cards set
-interval = 0,
-lastInterval = 0,
-due = created,
-lastDue = 0,
-factor = 2.5,
-firstAnswered = 0,
-reps = 0,
-successive = 0,
-averageTime = 0,
-reviewTime = 0,
-youngEase0 = 0,
-youngEase1 = 0,
-youngEase2 = 0,
-youngEase3 = 0,
-youngEase4 = 0,
-matureEase0 = 0,
-matureEase1 = 0,
-matureEase2 = 0,
-matureEase3 = 0,
-matureEase4 = 0,
-yesCount = 0,
-noCount = 0,
-spaceUntil = 0,
-type = 2,
-relativeDelay = 2,
-combinedDue = created,
-modified = :now
-""", now=time.time())
-            self.newDeck.s.statement("""
-delete from stats""")
+        self.newDeck = DeckStorage.Deck(path, backup=False)
         # media
         if self.includeMedia:
-            server.deck.mediaPrefix = ""
-            copyLocalMedia(client.deck, server.deck)
+            from anki.sync import copyLocalMedia
+            self.newDeck.mediaPrefix = ""
+            copyLocalMedia(self.deck, self.newDeck)
         # need to save manually
+        self.deck.updateProgress()
         self.newDeck.rebuildCounts()
         self.newDeck.updateAllPriorities()
         self.exportedCards = self.newDeck.cardCount
@@ -147,36 +157,73 @@ delete from stats""")
         self.newDeck.close()
         self.deck.finishProgress()
 
-    def localSummary(self):
-        cardIds = self.cardIds()
-        cStrIds = ids2str(cardIds)
-        cards = self.deck.s.all("""
-select id, modified from cards
-where id in %s""" % cStrIds)
-        facts = self.deck.s.all("""
-select facts.id, facts.modified from cards, facts where
-facts.id = cards.factId and
-cards.id in %s""" % cStrIds)
-        models = self.deck.s.all("""
-select models.id, models.modified from models, facts where
-facts.modelId = models.id and
-facts.id in %s""" % ids2str([f[0] for f in facts]))
-        media = self.deck.s.all("""
-select id, created from media""")
-        return {
-            # cards
-            "cards": cards,
-            "delcards": [],
-            # facts
-            "facts": facts,
-            "delfacts": [],
-            # models
-            "models": models,
-            "delmodels": [],
-            # media
-            "media": media,
-            "delmedia": [],
-            }
+    def _copyDeck(self, dst, cids):
+        cards = "id in %s" % cids
+        facts = "id in (select factId from cards where %s)" % cards
+        models = "id in (select modelId from facts where %s)" % facts
+        if self.includeSchedulingInfo:
+            reset = {}
+        else:
+            reset = self.resetSchedulingColumns()
+        self.deck.updateProgress()
+        self._copyTable(dst, "decks", replace=True, overrides={
+            'syncName': "null",
+            'lastSync': "0"})
+        self._copyTable(dst, "deckVars", replace=True)
+        self._copyTable(dst, "sources")
+        self._copyTable(dst, "models", models)
+        self._copyTable(dst, "fieldModels", "modelId in (select id from "
+                        "models where %s)" % models)
+        self._copyTable(dst, "cardModels", "modelId in (select id from "
+                        "models where %s)" % models)
+        self.deck.updateProgress()
+        self._copyTable(dst, "facts", facts)
+        self._copyTable(dst, "fields", "factId in (select id from facts "
+                        "where %s)" % facts)
+        self._copyTable(dst, "cards", cards, overrides=reset)
+        self.deck.updateProgress()
+        self._copyTable(dst, "cardTags", "cardId in %s" % cids)
+        self._copyTable(dst, "tags", "id in (select tagId from cardTags "
+                        "where cardId in %s)" % cids)
+        self._copyTable(dst, "media")
+        if self.includeSchedulingInfo:
+            self.deck.updateProgress()
+            self._copyTable(dst, "reviewHistory", "cardId in %s" % cids)
+            self._copyTable(dst, "stats")
+
+    def _copyTable(self, dst, table, where="", overrides={}, replace=False):
+        """Copy rows of TABLE matching WHERE into DST, a DB-API connection.
+OVERRIDES maps column names to SQL expressions used instead of the
+column's value. Only columns present in the destination are copied."""
+        cols = [r[1] for r in dst.execute(
+            "pragma table_info(%s)" % table).fetchall()]
+        exprs = [overrides.get(c, '"%s"' % c) for c in cols]
+        sql = "select %s from %s" % (",".join(exprs), table)
+        if where:
+            sql += " where " + where
+        if replace:
+            verb = "insert or replace"
+        else:
+            verb = "insert"
+        ins = "%s into %s (%s) values (%s)" % (
+            verb, table, ",".join(['"%s"' % c for c in cols]),
+            ",".join("?" * len(cols)))
+        for rows in self._chunks(sql):
+            dst.executemany(ins, rows)
+
+    def resetSchedulingColumns(self):
+        "Column overrides which make exported cards new."
+        d = {'type': "2", 'relativeDelay': "2", 'factor': "2.5",
+             'due': "created", 'combinedDue': "created",
+             'modified': "%f" % time.time()}
+        for col in ("interval", "lastInterval", "lastDue", "firstAnswered",
+                    "reps", "successive", "averageTime", "reviewTime",
+                    "yesCount", "noCount", "spaceUntil"):
+            d[col] = "0"
+        for type in ("young", "mature"):
+            for ease in range(5):
+                d["%sEase%d" % (type, ease)] = "0"
+        return d
 
 class TextCardExporter(Exporter):
 
@@ -188,34 +235,26 @@ class TextCardExporter(Exporter):
         self.includeTags = False
 
     def doExport(self, file):
-        ids = self.cardIds()
-        strids = ids2str(ids)
-        self.deck.startProgress((len(ids) + 1) / 50)
+        cids = self._stageCardIds()
+        self.deck.startProgress(self.count / exportChunkSize + 1)
         self.deck.updateProgress(_("Exporting..."))
-        cards = self.deck.s.all("""
-select cards.question, cards.answer, cards.id from cards
+        try:
+            for (q, a, tags) in self._rows("""
+select cards.question, cards.answer, facts.tags from cards, facts
 where cards.id in %s
-order by cards.created""" % strids)
-        self.deck.updateProgress()
-        if self.includeTags:
-            self.cardTags = dict(self.deck.s.all("""
-select cards.id, facts.tags from cards, facts
-where cards.factId = facts.id
-and cards.id in %s
-order by cards.created""" % strids))
-        out = u"\n".join(["%s\t%s%s" % (
-            self.escapeText(c[0], removeFields=True),
-            self.escapeText(c[1], removeFields=True),
-            self.tags(c[2]))
-                          for c in cards])
-        if out:
-            out += "\n"
-        file.write(out.encode("utf-8"))
+and cards.factId = facts.id
+order by cards.created""" % cids):
+                file.write((u"%s\t%s%s\n" % (
+                    self.escapeText(q, removeFields=True),
+                    self.escapeText(a, removeFields=True),
+                    self.tags(tags))).encode("utf-8"))
+        finally:
+            self.deck.s.dropIdSet("exportCards")
         self.deck.finishProgress()
 
-    def tags(self, id):
+    def tags(self, tags):
         if self.includeTags:
-            return "\t" + ", ".join(parseTags(self.cardTags[id]))
+            return "\t" + ", ".join(parseTags(tags))
         return ""
 
 class TextFactExporter(Exporter):
@@ -228,40 +267,31 @@ class TextFactExporter(Exporter):
         self.includeTags = False
 
     def doExport(self, file):
-        cardIds = self.cardIds()
-        self.deck.startProgress()
+        cids = self._stageCardIds()
+        self.deck.startProgress(self.count / exportChunkSize + 1)
         self.deck.updateProgress(_("Exporting..."))
-        facts = self.deck.s.all("""
-select factId, value, facts.created from facts, fields
-where
-facts.id in
-(select distinct factId from cards
-where cards.id in %s)
+        rows = self._rows("""
+select facts.id, fields.value, facts.tags from facts, fields
+where facts.id in (select factId from cards where id in %s)
 and facts.id = fields.factId
-order by factId, ordinal""" % ids2str(cardIds))
-        txt = ""
-        self.deck.updateProgress()
-        if self.includeTags:
-            self.factTags = dict(self.deck.s.all(
-                "select id, tags from facts where id in %s" %
-                ids2str([fact[0] for fact in facts])))
-        groups = itertools.groupby(facts, itemgetter(0))
-        groups = [[x for x in y[1]] for y in groups]
-        groups = [(group[0][2],
-                   "\t".join([self.escapeText(x[1]) for x in group]) +
-                   self.tags(group[0][0]))
-                  for group in groups]
-        self.deck.updateProgress()
-        groups.sort(key=itemgetter(0))
-        out = [ret[1] for ret in groups]
-        self.count = len(out)
-        out = "\n".join(out)
-        file.write(out.encode("utf-8"))
+order by facts.created, facts.id, fields.ordinal""" % cids)
+        self.count = 0
+        try:
+            for (fid, group) in itertools.groupby(rows, itemgetter(0)):
+                group = list(group)
+                line = "\t".join([self.escapeText(x[1]) for x in group])
+                line += self.tags(group[0][2])
+                if self.count:
+                    line = "\n" + line
+                file.write(line.encode("utf-8"))
+                self.count += 1
+        finally:
+            self.deck.s.dropIdSet("exportCards")
         self.deck.finishProgress()
 
-    def tags(self, id):
+    def tags(self, tags):
         if self.includeTags:
-            return "\t" + self.factTags[id]
+            return "\t" + tags
         return ""
 
 # Export modules
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# Copyright: Damien Elmes <anki@ichi2.net>
+# License: GNU GPL, version 3 or later; http://www.gnu.org/copyleft/gpl.html
+
+"""\
+Workload forecasts
+==============================
+
+Simulates the deck's reviews for the coming days, to answer questions like
+"how many reviews a day will 30 new cards a day lead to". All the cards are
+loaded into arrays, and each day the cards which come due are answered at
+once, using the same rules as Deck.nextInterval() with a default answer of
+'good', and a random pass rate. Cards already overdue get the same bonus for
+their delay, and intervals are capped at the deck's maxScheduleTime.
+Requires numpy.
+
+Cards failed are assumed to be relearnt the same day with one more review.
+Spacing of related cards and review limits are ignored.
+"""
+__docformat__ = 'restructuredtext'
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def forecastAvailable():
+    return numpy is not None
+
+class Forecast(object):
+
+    def __init__(self, deck, days=30, newPerDay=None, newCards=None,
+                 youngPassRate=0.85, maturePassRate=0.9, seed=None):
+        """Forecast DAYS ahead. NEWPERDAY defaults to the deck's limit, and
+NEWCARDS, the new cards available, to the deck's new cards."""
+        self.deck = deck
+        self.days = days
+        if newPerDay is None:
+            newPerDay = deck.newCardsPerDay
+        self.newPerDay = newPerDay
+        if newCards is None:
+            newCards = deck.s.scalar(
+                "select count() from cards where type = 2")
+        self.newCards = newCards
+        self.youngPassRate = youngPassRate
+        self.maturePassRate = maturePassRate
+        self.random = numpy.random.RandomState(seed)
+
+    def run(self):
+        """Return a dict of lists with an entry per day: 'reviews' (cards
+due), 'failed' (extra reviews for failed cards), 'new' (new cards shown),
+and 'minutes' (estimated time for all of them)."""
+        d = self.deck
+        rand = self.random
+        rows = d.s.rawAll("""
+select interval, factor, combinedDue, successive, due from cards
+where type between 0 and 1""")
+        newTotal = min(self.newCards, self.newPerDay * self.days)
+        size = len(rows)
+        total = size + newTotal
+        interval = numpy.zeros(total)
+        factor = numpy.zeros(total)
+        successive = numpy.zeros(total)
+        # days overdue at the next review, as Deck._adjustedDelay()
+        late = numpy.zeros(total)
+        # day the card is next due on; today is day 0
+        due = numpy.empty(total)
+        due.fill(numpy.inf)
+        if rows:
+            cards = numpy.array(rows, dtype=float)
+            interval[:size] = cards[:,0]
+            factor[:size] = cards[:,1]
+            due[:size] = numpy.maximum(0, numpy.ceil(
+                (cards[:,2] - d.dueCutoff) / 86400.0))
+            successive[:size] = cards[:,3]
+            late[:size] = numpy.where(
+                cards[:,2] <= d.dueCutoff,
+                (d.dueCutoff - cards[:,4]) / 86400.0, 0)
+        mid = (d.midIntervalMin + d.midIntervalMax) / 2.0
+        def learnt(n):
+            return rand.uniform(d.midIntervalMin, d.midIntervalMax, n)
+        res = {'reviews': [], 'failed': [], 'new': [], 'minutes': []}
+        for day in range(self.days):
+            idx = numpy.nonzero(due <= day)[0]
+            iv = interval[idx]
+            fac = factor[idx]
+            # cards are answered the day they're due, so only those overdue
+            # already are late, and relearnt cards never are
+            delay = numpy.where(successive[idx] > 0, late[idx], 0)
+            late[idx] = 0
+            mature = iv > 21
+            passed = rand.random_sample(len(idx)) < numpy.where(
+                mature, self.maturePassRate, self.youngPassRate)
+            failed = ~passed
+            new = iv.copy()
+            # passed: learning cards get a preset interval
+            learn = passed & (iv == 0)
+            new[learn] = learnt(learn.sum())
+            rev = passed & (iv > 0)
+            # boost initial 2
+            boost = rev & (iv < d.hardIntervalMax) & (iv > 0.166)
+            new[boost] = mid / fac[boost]
+            new[rev] = ((new[rev] + delay[rev] / 2.0) * fac[rev] *
+                        rand.uniform(0.95, 1.05, rev.sum()))
+            # failed: shrink the interval, then relearn
+            new[failed] = iv[failed] * d.delay2
+            lost = failed & (new < d.hardIntervalMin)
+            new[lost] = learnt(lost.sum())
+            if d.maxScheduleTime:
+                new = numpy.minimum(new, d.maxScheduleTime)
+            fac[failed & (successive[idx] > 0)] -= 0.20
+            successive[idx] = numpy.where(passed, successive[idx] + 1, 0)
+            interval[idx] = new
+            factor[idx] = numpy.maximum(1.3, fac)
+            due[idx] = day + numpy.maximum(1, numpy.round(new))
+            # introduce new cards, which are all learnt today
+            n = min(self.newPerDay, total - size)
+            if n:
+                ok = rand.random_sample(n) < self.youngPassRate
+                interval[size:size+n] = learnt(n)
+                factor[size:size+n] = d.averageFactor
+                successive[size:size+n] = ok
+                due[size:size+n] = day + numpy.maximum(
+                    1, numpy.round(interval[size:size+n]))
+                size += n
+                nfailed = n - ok.sum()
+            else:
+                nfailed = 0
+            res['reviews'].append(len(idx))
+            res['failed'].append(int(failed.sum() + nfailed))
+            res['new'].append(n)
+        avg = d._globalStats.averageTime or 10
+        for day in range(self.days):
+            res['minutes'].append((res['reviews'][day] + res['failed'][day] +
+                                   res['new'][day]) * avg / 60.0)
+        return res
@@ -5,14 +5,21 @@
 """\
 Graphs of deck statistics
 ==============================
+
+GraphData buckets the deck's cards and daily statistics in SQL, and returns
+each graph's data as a pair of sorted arrays (buckets, counts). Results are
+cached until the deck is modified. DeckGraphs draws them with matplotlib,
+which is only imported once a figure is requested.
 """
 __docformat__ = 'restructuredtext'
 
-import os, sys, time
-import anki.stats
+import os, sys
 from anki.lang import _
 
-import datetime
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 #colours for graphs
 dueYoungC = "#ffb380"
@@ -32,26 +39,184 @@ addedC = "#b3ff80"
 firstC = "#b380ff"
 intervC = "#80e5ff"
 
-# support frozen distribs
-if sys.platform.startswith("darwin"):
-    try:
-        del os.environ['MATPLOTLIBDATA']
-    except:
-        pass
-
-try:
-    from matplotlib.figure import Figure
-except UnicodeEncodeError:
-    # haven't tracked down the cause of this yet, but reloading fixes it
+# matplotlib is imported when the first figure is made
+_Figure = None
+
+def _importFigure():
+    global _Figure
+    if _Figure:
+        return _Figure
+    # support frozen distribs
+    if sys.platform.startswith("darwin"):
+        try:
+            del os.environ['MATPLOTLIBDATA']
+        except:
+            pass
     try:
         from matplotlib.figure import Figure
-    except ImportError:
-        pass
-except ImportError:
-    pass
+    except UnicodeEncodeError:
+        # haven't tracked down the cause of this yet, but reloading fixes it
+        from matplotlib.figure import Figure
+    _Figure = Figure
+    return Figure
+
+def Figure(*args, **kwargs):
+    return _importFigure()(*args, **kwargs)
 
 def graphsAvailable():
-    return 'matplotlib' in sys.modules
+    try:
+        _importFigure()
+    except ImportError:
+        return False
+    return True
+
+# Graph data
+##########################################################################
+
+# young and mature review cards, by the day they're due on; 0 is today
+dueSQL = """
+select interval > 21, cast((combinedDue - :cutoff) / 86400.0 + 1 as int),
+count() from cards c where type >= 0 and (
+(relativeDelay between 0 and 1 and interval <= 21) or
+(relativeDelay = 1 and interval > 21))
+group by 1, 2"""
+
+intervalSQL = """
+select cast(round(interval) as int), count() from cards c
+where type >= 0 and (
+(relativeDelay between 0 and 1 and interval <= 21) or
+(relativeDelay = 1 and interval > 21))
+group by 1"""
+
+# reviews per day, by days ago (0 is today)
+dayStatsSQL = """
+select cast(julianday(day) - julianday(:today) as int),
+reps, reps-(newEase0+newEase1+newEase2+newEase3+newEase4),
+matureEase0+matureEase1+matureEase2+matureEase3+matureEase4,
+reviewTime / 60.0
+from stats where type = 1 order by day"""
+
+def series(rows):
+    "Return ROWS of (bucket, count) as a pair of arrays, sorted by bucket."
+    rows = sorted(rows)
+    if numpy is not None:
+        if not rows:
+            return (numpy.zeros(0, dtype=int), numpy.zeros(0))
+        a = numpy.array(rows)
+        return (a[:,0].astype(int), a[:,1])
+    if not rows:
+        return ([], [])
+    return tuple(list(c) for c in zip(*rows))
+
+def dense(data, lo, hi):
+    """Return DATA from series() with a count for every bucket from LO to HI,
+missing buckets counting as 0."""
+    (x, y) = data
+    if numpy is not None:
+        counts = numpy.zeros(hi - lo + 1)
+        keep = (x >= lo) & (x <= hi)
+        counts[x[keep] - lo] = y[keep]
+        return (numpy.arange(lo, hi + 1), counts)
+    counts = [0] * (hi - lo + 1)
+    for (b, c) in zip(x, y):
+        if lo <= b <= hi:
+            counts[b - lo] = c
+    return (range(lo, hi + 1), counts)
+
+class GraphData(object):
+
+    def __init__(self, deck, selective=True):
+        """Graph data for DECK. If SELECTIVE, cards are limited to the
+deck's active review tags."""
+        self.deck = deck
+        self.s = deck.s
+        self.selective = selective
+        self._cache = {}
+        self._key = None
+
+    def _cached(self, name, fn, *args):
+        self.deck.flushReviews()
+        key = (self.deck.modified, self.deck.failedCutoff)
+        if key != self._key:
+            self._cache = {}
+            self._key = key
+        k = (name,) + args
+        if k not in self._cache:
+            # in WAL mode, read saved decks on a connection of their own
+            self.s = self.deck.readSession(fresh=True)
+            try:
+                self._cache[k] = fn(*args)
+            finally:
+                self.deck.closeReadSession(self.s)
+                self.s = self.deck.s
+        return self._cache[k]
+
+    def _limit(self, sql):
+        if self.selective:
+            return self.deck._cardLimit("revActive", "revInactive", sql)
+        return sql
+
+    def due(self):
+        "Return {'young', 'mature', 'all'} series of cards by day due."
+        return self._cached("due", self._due)
+
+    def _due(self):
+        young = {}
+        mature = {}
+        all = {}
+        for (isMature, day, count) in self.s.rawAll(
+            self._limit(dueSQL), cutoff=self.deck.failedCutoff):
+            if isMature:
+                mature[day] = count
+            else:
+                young[day] = count
+            all[day] = all.get(day, 0) + count
+        return {'young': series(young.items()),
+                'mature': series(mature.items()),
+                'all': series(all.items())}
+
+    def intervals(self):
+        "Return a series of review cards by interval in days."
+        return self._cached("intervals", lambda: series(
+            self.s.rawAll(self._limit(intervalSQL))))
+
+    def reviews(self):
+        """Return {'new', 'young', 'mature', 'minutes'} series of reviews by
+day, where 0 is today and earlier days are negative. 'new' includes all
+reviews and 'young' all but those of new cards, so they stack."""
+        return self._cached("reviews", self._reviews)
+
+    def _reviews(self):
+        rows = self.s.rawAll(dayStatsSQL,
+                             today=str(self.deck._dailyStats.day))
+        return dict([(name, series([(r[0], r[n]) for r in rows]))
+                     for (n, name) in enumerate(
+            ("new", "young", "mature", "minutes"), 1)])
+
+    def added(self, days=30, attr="created"):
+        """Return a series of cards by the day ATTR ('created' or
+'firstAnswered') falls on, for the last DAYS days."""
+        return self._cached("added", self._added, days, attr)
+
+    def _added(self, days, attr):
+        assert attr in ("created", "firstAnswered")
+        cutoff = self.deck.failedCutoff
+        return series(self.s.rawAll("""
+select cast((%s - :cutoff) / 86400.0 as int), count() from cards
+where %s >= :limit group by 1""" % (attr, attr),
+                                    cutoff=cutoff,
+                                    limit=cutoff - days * 86400))
+
+    def eases(self):
+        """Return {'new', 'young', 'mature'} lists of the number of answers
+with each ease."""
+        gs = self.deck._globalStats
+        return dict([(type, [getattr(gs, type + "Ease%d" % e)
+                             for e in range(5)])
+                     for type in ("new", "young", "mature")])
+
+# Graphs
+##########################################################################
 
 class DeckGraphs(object):
 
@@ -62,72 +227,29 @@ class DeckGraphs(object):
         self.height = height
         self.dpi = dpi
         self.selective = selective
+        self.data = GraphData(deck, selective)
 
     def calcStats (self):
         if not self.stats:
-            days = {}
-            daysYoung = {}
-            daysMature =  {}
-            months = {}
-            next = {}
-            lowestInDay = 0
             self.endOfDay = self.deck.failedCutoff
-            t = time.time()
-            young = """
-select interval, combinedDue from cards c
-where relativeDelay between 0 and 1 and type >= 0 and interval <= 21"""
-            mature = """
-select interval, combinedDue
-from cards c where relativeDelay = 1 and type >= 0 and interval > 21"""
-            if self.selective:
-                young = self.deck._cardLimit("revActive", "revInactive",
-                                             young)
-                mature = self.deck._cardLimit("revActive", "revInactive",
-                                             mature)
-            young = self.deck.s.all(young)
-            mature = self.deck.s.all(mature)
-            for (src, dest) in [(young, daysYoung),
-                                (mature, daysMature)]:
-                for (interval, due) in src:
-                    day=int(round(interval))
-                    days[day] = days.get(day, 0) + 1
-                    indays = int(((due - self.endOfDay) / 86400.0) + 1)
-                    next[indays] = next.get(indays, 0) + 1 # type-agnostic stats
-                    dest[indays] = dest.get(indays, 0) + 1 # type-specific stats
-                    if indays < lowestInDay:
-                        lowestInDay = indays
+            d = self.data
+            def todict(data):
+                return dict(zip(*[list(c) for c in data]))
+            due = d.due()
+            next = todict(due['all'])
             self.stats = {}
             self.stats['next'] = next
-            self.stats['days'] = days
-            self.stats['daysByType'] = {'young': daysYoung,
-                                        'mature': daysMature}
-            self.stats['months'] = months
-            self.stats['lowestInDay'] = lowestInDay
-
-            dayReps = self.deck.s.all("""
-select day,
-       matureEase0+matureEase1+matureEase2+matureEase3+matureEase4 as matureReps,
-       reps-(newEase0+newEase1+newEase2+newEase3+newEase4) as combinedYoungReps,
-       reps as combinedNewReps
-from stats
-where type = 1""")
-
-            dayTimes = self.deck.s.all("""
-select day, reviewTime as reviewTime
-from stats
-where type = 1""")
-
-            todaydt = self.deck._dailyStats.day
-            for dest, source in [("dayRepsNew", "combinedNewReps"),
-                                 ("dayRepsYoung", "combinedYoungReps"),
-                                 ("dayRepsMature", "matureReps")]:
-                self.stats[dest] = dict(
-                    map(lambda dr: (-(todaydt -datetime.date(
-                    *(int(x)for x in dr["day"].split("-")))).days, dr[source]), dayReps))
-
-            self.stats['dayTimes'] = dict(
-                map(lambda dr: (-(todaydt -datetime.date(
-                *(int(x)for x in dr["day"].split("-")))).days, dr["reviewTime"]/60.0), dayTimes))
+            self.stats['days'] = todict(d.intervals())
+            self.stats['daysByType'] = {'young': todict(due['young']),
+                                        'mature': todict(due['mature'])}
+            self.stats['months'] = {}
+            self.stats['lowestInDay'] = min([0] + next.keys())
+            reviews = d.reviews()
+            for (dest, source) in [("dayRepsNew", "new"),
+                                   ("dayRepsYoung", "young"),
+                                   ("dayRepsMature", "mature"),
+                                   ("dayTimes", "minutes")]:
+                self.stats[dest] = todict(reviews[source])
 
     def nextDue(self, days=30):
         self.calcStats()
@@ -242,18 +364,9 @@ where type = 1""")
         return fig
 
     def addedRecently(self, numdays=30, attr='created'):
-        self.calcStats()
-        days = {}
         fig = Figure(figsize=(self.width, self.height), dpi=self.dpi)
-        limit = self.endOfDay - (numdays) * 86400
-        res = self.deck.s.column0("select %s from cards where %s >= %f" %
-                                  (attr, attr, limit))
-        for r in res:
-            d = int((r - self.endOfDay) / 86400.0)
-            days[d] = days.get(d, 0) + 1
-        self.addMissing(days, -numdays+1, 0)
+        intervals = dense(self.data.added(numdays, attr), -numdays+1, 0)
         graph = fig.add_subplot(111)
-        intervals = self.unzip(days.items())
         if attr == 'created':
             colour = addedC
         else:
@@ -370,22 +483,17 @@ where type = 1""")
         n = 0
         colours = [easesNewC, easesYoungC, easesMatureC]
         bars = []
-        gs = anki.stats.globalStats(self.deck)
+        eases = self.data.eases()
         for type in types:
-            total = (getattr(gs, type + "Ease0") +
-                     getattr(gs, type + "Ease1") +
-                     getattr(gs, type + "Ease2") +
-                     getattr(gs, type + "Ease3") +
-                     getattr(gs, type + "Ease4"))
-            setattr(gs, type + "Ease1", getattr(gs, type + "Ease0") +
-                    getattr(gs, type + "Ease1"))
-            setattr(gs, type + "Ease0", -1)
-            for e in range(1, enum):
+            e = list(eases[type])
+            total = sum(e)
+            # ease 0 is counted as 1
+            e[1] += e[0]
+            for i in range(1, enum):
                 try:
-                    arr[e+offset] = (getattr(gs, type + "Ease%d" % e)
-                                     / float(total)) * 100 + 1
+                    arr[i+offset] = (e[i] / float(total)) * 100 + 1
                 except ZeroDivisionError:
-                    arr[e+offset] = 0
+                    arr[i+offset] = 0
             bars.append(graph.bar(range(arrsize), arr, width=1.0,
                                   color=colours[n], align='center'))
             arr = [0] * arrsize
@@ -50,16 +50,18 @@ class CardHistoryEntry(object):
         self.delay = delay
         self.thinkingTime = card.thinkingTime()
 
-    def writeSQL(self, s):
-        s.statement("""
+    insertSQL = """
 insert into reviewHistory
 (cardId, lastInterval, nextInterval, ease, delay, lastFactor,
 nextFactor, reps, thinkingTime, yesCount, noCount, time)
 values (
 :cardId, :lastInterval, :nextInterval, :ease, :delay,
 :lastFactor, :nextFactor, :reps, :thinkingTime, :yesCount, :noCount,
-:time)""",
-                    cardId=self.cardId,
+:time)"""
+
+    def toDict(self):
+        "Return the row to insert, stamped with the current time."
+        return dict(cardId=self.cardId,
                     lastInterval=self.lastInterval,
                     nextInterval=self.nextInterval,
                     ease=self.ease,
@@ -72,4 +74,7 @@ values (
                     noCount=self.noCount,
                     time=time.time())
 
+    def writeSQL(self, s):
+        s.statement(self.insertSQL, **self.toDict())
+
 mapper(CardHistoryEntry, reviewHistoryTable)
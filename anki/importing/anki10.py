@@ -10,7 +10,6 @@ __docformat__ = 'restructuredtext'
 
 from anki import DeckStorage
 from anki.importing import Importer
-from anki.sync import SyncClient, SyncServer, copyLocalMedia
 from anki.lang import _
 from anki.utils import ids2str
 from anki.deck import NEW_CARDS_RANDOM
@@ -22,6 +21,7 @@ class Anki10Importer(Importer):
 
     def doImport(self):
         "Import."
+        from anki.sync import SyncClient, SyncServer, copyLocalMedia
         random = self.deck.newCardOrder == NEW_CARDS_RANDOM
         num = 4
         if random:
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# Copyright: Damien Elmes <anki@ichi2.net>
+# License: GNU GPL, version 3 or later; http://www.gnu.org/copyleft/gpl.html
+
+"""\
+Background jobs
+====================
+
+A job has two parts. Its work runs in a thread of its own, on a read-only
+session from Deck.readSession(), and may take as long as it likes. Its result
+is then handed to its apply function, which makes any changes. As the deck
+has a single writer, apply functions run one at a time, on the deck's thread,
+when Deck.finishJobs() is called.
+
+Jobs report progress through their value, max and label attributes, and
+should call update() regularly, which raises JobCancelled once the job has
+been cancelled.
+"""
+__docformat__ = 'restructuredtext'
+
+import sys, threading
+from anki.errors import JobCancelled
+
+class Job(object):
+
+    def __init__(self, name, work, apply=None):
+        self.name = name
+        self.work = work
+        self.apply = apply
+        self.value = 0
+        self.max = 0
+        self.label = u""
+        self.cancelled = False
+        self.thread = None
+        self._result = None
+        self._error = None
+        self._ready = threading.Event()
+        self._done = threading.Event()
+
+    def update(self, value=None, max=None, label=None):
+        "Record progress. Raise JobCancelled if the job has been cancelled."
+        if value is not None:
+            self.value = value
+        if max is not None:
+            self.max = max
+        if label is not None:
+            self.label = label
+        if self.cancelled:
+            raise JobCancelled()
+
+    def cancel(self):
+        "Stop at the next update(), and don't apply any changes."
+        self.cancelled = True
+
+    def ready(self):
+        "True if the work has finished and the job is waiting to be applied."
+        return self._ready.isSet()
+
+    def done(self):
+        "True if the job has finished, been cancelled or failed."
+        return self._done.isSet()
+
+    def result(self, timeout=None):
+        """Wait for the job to finish and return the result of apply, or the
+work if there was nothing to apply. Raise any error from either."""
+        self._done.wait(timeout)
+        if not self.done():
+            return None
+        if self._error:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._result
+
+    def run(self, s):
+        "Do the work on session S."
+        try:
+            self.update()
+            self._result = self.work(self, s)
+        except:
+            self._error = sys.exc_info()
+        self._ready.set()
+
+    def finish(self):
+        "Apply the work's result. Must be called on the deck's thread."
+        self._ready.wait()
+        if self.cancelled and not self._error:
+            try:
+                raise JobCancelled()
+            except JobCancelled:
+                self._error = sys.exc_info()
+        if not self._error and self.apply:
+            try:
+                self._result = self.apply(self._result)
+            except:
+                self._error = sys.exc_info()
+        self._done.set()
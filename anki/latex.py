@@ -15,7 +15,6 @@ except ImportError:
     pass
     
 from anki.utils import genID, checksum, call
-from anki.hooks import addHook
 from htmlentitydefs import entitydefs
 from anki.lang import _
 
@@ -27,7 +26,8 @@ regexps = {
     "math": re.compile(r"\[\$\$\](.+?)\[/\$\$\]", re.DOTALL | re.IGNORECASE),
     }
 
-tmpdir = tempfile.mkdtemp(prefix="anki")
+# created when first needed
+tmpdir = None
 
 # add standard tex install location to osx
 if sys.platform == "darwin":
@@ -73,7 +73,14 @@ def mungeLatex(deck, latex):
     latex = latex.encode("utf-8")
     return latex
 
+def getTmpDir():
+    global tmpdir
+    if not tmpdir:
+        tmpdir = tempfile.mkdtemp(prefix="anki")
+    return tmpdir
+
 def buildImg(deck, latex):
+    tmpdir = getTmpDir()
     log = open(os.path.join(tmpdir, "latex_log.txt"), "w+")
     texpath = os.path.join(tmpdir, "tmp.tex")
     texfile = file(texpath, "w")
@@ -136,8 +143,6 @@ def imgLink(deck, latex, build=True):
     else:
         return latex
 
+# called by the formatQA hook, which anki.deck sets up
 def formatQA(html, type, cid, mid, fact, tags, cm, deck, build=True):
     return renderLatex(deck, html,  build=build)
-
-# setup q/a filter
-addHook("formatQA", formatQA)
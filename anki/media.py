@@ -8,7 +8,7 @@ Media support
 """
 __docformat__ = 'restructuredtext'
 
-import os, shutil, re, urllib2, time, tempfile, unicodedata, urllib
+import os, shutil, re, time, tempfile, unicodedata, urllib
 from anki.db import *
 from anki.utils import checksum, genID
 from anki.lang import _
@@ -152,16 +152,34 @@ def rebuildMediaDir(deck, delete=False, dirty=True):
     if not mdir:
         return (0, 0)
     deck.startProgress(title=_("Check Media DB"))
-    # set all ref counts to 0
-    deck.s.statement("update media set size = 0")
-    # look through cards for media references
+    ret = applyMediaScan(deck, scanMediaDir(deck.s, mdir), delete, dirty)
+    deck.finishProgress()
+    return ret
+
+def rebuildMediaDirJob(deck, delete=False, dirty=True):
+    """Run rebuildMediaDir() as a background job, which reads the cards and
+media files in its own thread. See Deck.startJob()."""
+    mdir = deck.mediaDir()
+    def work(job, s):
+        if mdir:
+            return scanMediaDir(s, mdir, job)
+    def apply(scan):
+        if not scan:
+            return (0, 0)
+        return applyMediaScan(deck, scan, delete, dirty)
+    return deck.startJob(_("Check Media DB"), work, apply)
+
+def scanMediaDir(s, mdir, job=None):
+    """Find the media referenced by cards in session S, and the files in MDIR.
+Return (refs, unused, sums): reference counts, unreferenced files, and the
+checksum of each referenced file (empty if missing). Changes nothing."""
     refs = {}
     normrefs = {}
-    def norm(s):
-        if isinstance(s, unicode):
-            return unicodedata.normalize('NFD', s)
-        return s
-    for (question, answer) in deck.s.all(
+    def norm(name):
+        if isinstance(name, unicode):
+            return unicodedata.normalize('NFD', name)
+        return name
+    for (question, answer) in s.all(
         "select question, answer from cards"):
         for txt in (question, answer):
             for f in mediaFiles(txt):
@@ -170,9 +188,6 @@ def rebuildMediaDir(deck, delete=False, dirty=True):
                 else:
                     refs[f] = 1
                     normrefs[norm(f)] = True
-    # update ref counts
-    for (file, count) in refs.items():
-        updateMediaCount(deck, file, count)
     # find unused media
     unused = []
     for file in os.listdir(mdir):
@@ -183,26 +198,48 @@ def rebuildMediaDir(deck, delete=False, dirty=True):
         nfile = norm(file)
         if nfile not in normrefs:
             unused.append(file)
+    # checksum the rest
+    sums = {}
+    for (n, file) in enumerate(refs.keys()):
+        if job:
+            job.update(n, len(refs))
+        path = os.path.join(mdir, file)
+        if os.path.exists(path):
+            sums[file] = unicode(checksum(open(path, "rb").read()))
+        else:
+            sums[file] = u""
+    return (refs, unused, sums)
+
+def applyMediaScan(deck, scan, delete=False, dirty=True):
+    "Update the media table from scanMediaDir(). Return (missing, unused)."
+    (refs, unused, sums) = scan
+    mdir = deck.mediaDir()
+    # set all ref counts to 0
+    deck.s.statement("update media set size = 0")
+    # update ref counts
+    for (file, count) in refs.items():
+        updateMediaCount(deck, file, count)
     # optionally delete
     if delete:
         for f in unused:
             path = os.path.join(mdir, f)
-            os.unlink(path)
+            if os.path.exists(path):
+                os.unlink(path)
     # remove entries in db for unused media
     removeUnusedMedia(deck)
     # check md5s are up to date
     update = []
     for (file, created, md5) in deck.s.all(
         "select filename, created, originalPath from media"):
-        path = os.path.join(mdir, file)
-        if not os.path.exists(path):
-            if md5:
-                update.append({'f':file, 'sum':u"", 'c':time.time()})
-        else:
-            sum = unicode(
-                checksum(open(os.path.join(mdir, file), "rb").read()))
-            if md5 != sum:
-                update.append({'f':file, 'sum':sum, 'c':time.time()})
+        sum = sums.get(file)
+        if sum is None:
+            path = os.path.join(mdir, file)
+            if os.path.exists(path):
+                sum = unicode(checksum(open(path, "rb").read()))
+            else:
+                sum = u""
+        if md5 != sum:
+            update.append({'f':file, 'sum':sum, 'c':time.time()})
     if update:
         deck.s.statements("""
 update media set originalPath = :sum, created = :c where filename = :f""",
@@ -211,7 +248,6 @@ update media set originalPath = :sum, created = :c where filename = :f""",
     if dirty:
         deck.flushMod()
     nohave = deck.s.column0("select filename from media where originalPath = ''")
-    deck.finishProgress()
     return (nohave, unused)
 
 # Download missing
@@ -223,33 +259,52 @@ def downloadMissing(deck):
         return None
     mdir = deck.mediaDir(create=True)
     deck.startProgress()
+    ret = fetchMissing(deck.s, mdir, urlbase,
+                       lambda n, max, label: deck.updateProgress(label=label))
+    deck.finishProgress()
+    return ret
+
+def downloadMissingJob(deck):
+    """Run downloadMissing() as a background job, which downloads the files
+in its own thread. See Deck.startJob()."""
+    urlbase = deck.getVar("mediaURL")
+    mdir = urlbase and deck.mediaDir(create=True)
+    def work(job, s):
+        if urlbase:
+            return fetchMissing(s, mdir, urlbase, job.update)
+    return deck.startJob(_("Download Missing Media"), work)
+
+def fetchMissing(s, mdir, urlbase, update):
+    """Download the files in the media table of session S which are missing
+from MDIR, calling UPDATE(value, max, label) after each. Return as
+downloadMissing()."""
+    import urllib2
     missing = 0
     grabbed = 0
-    for c, (f, sum) in enumerate(deck.s.all(
-        "select filename, originalPath from media")):
+    files = s.all("select filename, originalPath from media")
+    for c, (f, sum) in enumerate(files):
         path = os.path.join(mdir, f)
         if not os.path.exists(path):
             try:
                 rpath = urlbase + f
                 url = urllib2.urlopen(rpath)
-                open(f, "wb").write(url.read())
+                open(path, "wb").write(url.read())
                 grabbed += 1
             except:
                 if sum:
                     # the file is supposed to exist
-                    deck.finishProgress()
                     return (False, rpath)
                 else:
                     # ignore and keep going
                     missing += 1
-        deck.updateProgress(label=_("File %d...") % (grabbed+missing))
-    deck.finishProgress()
+        update(c + 1, len(files), _("File %d...") % (grabbed+missing))
     return (True, grabbed, missing)
 
 # Convert remote links to local ones
 ##########################################################################
 
 def downloadRemote(deck):
+    import urllib2
     mdir = deck.mediaDir(create=True)
     refs = {}
     deck.startProgress()
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# Copyright: Damien Elmes <anki@ichi2.net>
+# License: GNU GPL, version 3 or later; http://www.gnu.org/copyleft/gpl.html
+
+"""\
+SQL profiling
+==============================
+
+A Profiler attached to a SessionHelper records each query run through it:
+the statement with literals replaced by '?', the function which ran it,
+the time taken and the rows returned. Statements are grouped by the
+operation they ran in (answering a card, a reset, a sync, an import), which
+is found by looking for known functions further up the stack.
+
+sqlite commits the open transaction before running 'explain', so query
+plans for the slowest statements are fetched when the session next commits,
+before any new changes are made.
+
+Use Deck.startProfiling() to profile a deck's main session.
+"""
+__docformat__ = 'restructuredtext'
+
+import re, sys, simplejson
+
+# (pattern matching 'Class.method', operation); the outermost match wins
+scopes = (
+    (r"^Deck\._answer(Cram)?Card$", "answerCard"),
+    (r"^Deck\.reset$", "reset"),
+    (r"^Deck\.getCard$", "getCard"),
+    (r"Sync", "sync"),
+    (r"\.doImport$", "import"),
+    )
+
+# frames in these files are skipped when finding the caller
+_skipFiles = ("db.py", "profiler.py")
+
+class Profiler(object):
+
+    # how many statements to fetch query plans for
+    explainSlowest = 10
+
+    def __init__(self):
+        self.stats = {}
+        self._explained = set()
+
+    def record(self, sql, args, elapsed, rows):
+        "Record a statement which took ELAPSED seconds and returned ROWS."
+        (site, scope) = self._caller()
+        key = (scope, normalise(sql), site)
+        s = self.stats.get(key)
+        if not s:
+            s = self.stats[key] = {
+                'scope': scope, 'sql': key[1], 'site': site,
+                'count': 0, 'time': 0.0, 'max': 0.0, 'rows': 0,
+                'plan': None}
+        s['count'] += 1
+        s['time'] += elapsed
+        s['rows'] += rows
+        if elapsed >= s['max']:
+            s['max'] = elapsed
+            s['_slowest'] = (sql, args)
+
+    def slowest(self, n=None):
+        "Return the statement stats, slowest in total first."
+        stats = sorted(self.stats.values(),
+                       key=lambda s: s['time'], reverse=True)
+        if n:
+            stats = stats[:n]
+        return stats
+
+    def byScope(self):
+        "Return {scope: {'count', 'time', 'rows'}} for each operation."
+        res = {}
+        for s in self.stats.values():
+            r = res.setdefault(s['scope'], {'count': 0, 'time': 0.0,
+                                            'rows': 0})
+            for k in r:
+                r[k] += s[k]
+        return res
+
+    def explain(self, con):
+        """Fetch plans for the slowest statements without one, using the
+DB-API connection CON, which must not have changes pending."""
+        for s in self.slowest(self.explainSlowest):
+            if s['sql'] in self._explained:
+                continue
+            self._explained.add(s['sql'])
+            (sql, args) = s['_slowest']
+            if isinstance(args, (list, tuple)):
+                args = args and args[0] or {}
+            try:
+                s['plan'] = [r[-1] for r in con.execute(
+                    "explain query plan " + sql, args).fetchall()]
+            except Exception, e:
+                s['plan'] = ["error: %s" % e]
+
+    def toJSON(self):
+        "Return the scopes and statements as JSON."
+        stats = []
+        for s in self.slowest():
+            s = s.copy()
+            del s['_slowest']
+            stats.append(s)
+        return simplejson.dumps({'scopes': self.byScope(),
+                                 'statements': stats})
+
+    def report(self, n=20):
+        "Return the N slowest statements as text."
+        lines = []
+        for s in self.slowest(n):
+            lines.append("%8.1fms %6d calls %8d rows  %s  %s" % (
+                s['time'] * 1000, s['count'], s['rows'], s['scope'] or "-",
+                s['site']))
+            lines.append("    " + s['sql'][:200])
+            for p in s['plan'] or []:
+                lines.append("    > " + p)
+        return "\n".join(lines)
+
+    def clear(self):
+        self.stats = {}
+        self._explained = set()
+
+    def _caller(self):
+        "Return the function which ran the query, and the operation."
+        f = sys._getframe(1)
+        site = None
+        scope = None
+        while f:
+            name = _frameName(f)
+            if site is None:
+                if not f.f_code.co_filename.endswith(_skipFiles):
+                    site = name
+            for (pat, op) in scopes:
+                if re.search(pat, name):
+                    scope = op
+                    break
+            f = f.f_back
+        return (site, scope)
+
+def _frameName(f):
+    obj = f.f_locals.get('self')
+    if obj is not None:
+        return "%s.%s" % (obj.__class__.__name__, f.f_code.co_name)
+    return "%s.%s" % (f.f_globals.get('__name__'), f.f_code.co_name)
+
+_literals = re.compile(r"'(?:[^']|'')*'|\b-?\d+(?:\.\d+)?\b")
+_lists = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+
+def normalise(sql):
+    "Collapse whitespace and replace literals and id lists with '?'."
+    sql = " ".join(sql.split())
+    sql = _literals.sub("?", sql)
+    return _lists.sub("(?)", sql)
@@ -61,12 +61,17 @@ if sys.platform == "win32":
     except:
         # python2.7+
         si.dwFlags |= subprocess._subprocess.STARTF_USESHOWWINDOW
-    # tmp dir for non-hashed media
-    tmpdir = unicode(
-        tempfile.mkdtemp(prefix="anki"), sys.getfilesystemencoding())
 else:
     si = None
 
+def getTmpDir():
+    "Return the tmp dir for non-hashed media on windows, creating it."
+    global tmpdir
+    if not tmpdir:
+        tmpdir = unicode(
+            tempfile.mkdtemp(prefix="anki"), sys.getfilesystemencoding())
+    return tmpdir
+
 if sys.platform.startswith("darwin"):
     # make sure lame, which is installed in /usr/local/bin, is in the path
     os.environ['PATH'] += ":" + "/usr/local/bin"
@@ -206,12 +211,12 @@ def queueMplayer(path):
     ensureMplayerThreads()
     while mplayerEvt.isSet():
         time.sleep(0.1)
-    if tmpdir and os.path.exists(path):
+    if sys.platform == "win32" and os.path.exists(path):
         # mplayer on windows doesn't like the encoding, so we create a
         # temporary file instead. oddly, foreign characters in the dirname
         # don't seem to matter.
         (fd, name) = tempfile.mkstemp(suffix=os.path.splitext(path)[1],
-                                      dir=tmpdir)
+                                      dir=getTmpDir())
         f = os.fdopen(fd, "wb")
         f.write(open(path, "rb").read())
         f.close()
@@ -254,16 +259,12 @@ atexit.register(onExit)
 # PyAudio recording
 ##########################################################################
 
-try:
-    import pyaudio
-    import wave
-
-    PYAU_FORMAT = pyaudio.paInt16
-    PYAU_CHANNELS = 1
-    PYAU_RATE = 44100
-    PYAU_INPUT_INDEX = None
-except:
-    pass
+# pyaudio is imported when recording starts; the format defaults to
+# pyaudio.paInt16
+PYAU_FORMAT = None
+PYAU_CHANNELS = 1
+PYAU_RATE = 44100
+PYAU_INPUT_INDEX = None
 
 class _Recorder(object):
 
@@ -290,12 +291,16 @@ class PyAudioThreadedRecorder(threading.Thread):
         self.finish = False
 
     def run(self):
+        global PYAU_FORMAT
         chunk = 1024
         try:
-            p = pyaudio.PyAudio()
-        except NameError:
+            import pyaudio, wave
+        except ImportError:
             raise Exception(
                 "Pyaudio not installed (recording not supported on OSX10.3)")
+        if PYAU_FORMAT is None:
+            PYAU_FORMAT = pyaudio.paInt16
+        p = pyaudio.PyAudio()
         stream = p.open(format=PYAU_FORMAT,
                         channels=PYAU_CHANNELS,
                         rate=PYAU_RATE,
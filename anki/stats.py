@@ -75,7 +75,7 @@ class Stats(object):
         self.matureEase4 = 0
 
     def fromDB(self, s, id):
-        r = s.first("select * from stats where id = :id", id=id)
+        r = s.rawFirst("select * from stats where id = :id", id=id)
         (self.id,
          self.type,
          self.day,
@@ -114,9 +114,7 @@ matureEase3, matureEase4) values (:type, :day, 0, 0, 0, 0, 0, 0, 0, 0, 0,
             "select id from stats where type = :type and day = :day",
             type=type, day=day)
 
-    def toDB(self, s):
-        assert self.id
-        s.execute("""update stats set
+    updateSQL = """update stats set
 type=:type,
 day=:day,
 reps=:reps,
@@ -137,7 +135,34 @@ matureEase1=:matureEase1,
 matureEase2=:matureEase2,
 matureEase3=:matureEase3,
 matureEase4=:matureEase4
-where id = :id""", self.__dict__)
+where id = :id"""
+
+    def toDB(self, s):
+        assert self.id
+        s.execute(self.updateSQL, self.__dict__)
+
+    # answers are saved as increments to these columns, so the row needn't
+    # be reread or rewritten. averageTime is recalculated from the totals
+    # when 'average' is set
+    deltaColumns = (
+        "reps", "reviewTime", "newEase0", "newEase1", "newEase2", "newEase3",
+        "newEase4", "youngEase0", "youngEase1", "youngEase2", "youngEase3",
+        "youngEase4", "matureEase0", "matureEase1", "matureEase2",
+        "matureEase3", "matureEase4")
+
+    deltaSQL = """update stats set %s,
+averageTime = (case when :average
+then (reviewTime + :reviewTime) / (reps + :reps)
+else averageTime end)
+where id = :id""" % ",\n".join(["%s = %s + :%s" % (c, c, c)
+                                for c in deltaColumns])
+
+    def addDelta(self, delta):
+        "Apply DELTA to the values in memory."
+        for c in self.deltaColumns:
+            setattr(self, c, getattr(self, c) + delta[c])
+        if delta['average']:
+            self.averageTime = self.reviewTime / float(self.reps)
 
 mapper(Stats, statsTable)
 
@@ -145,24 +170,45 @@ def genToday(deck):
     return datetime.datetime.utcfromtimestamp(
         time.time() - deck.utcOffset).date()
 
-def updateAllStats(s, gs, ds, card, ease, oldState):
-    "Update global and daily statistics."
-    updateStats(s, gs, card, ease, oldState)
-    updateStats(s, ds, card, ease, oldState)
+def updateAllStats(s, gs, ds, card, ease, oldState, write=True):
+    """Update global and daily statistics, and return the changes. If WRITE
+is false, the caller is responsible for saving them with Stats.deltaSQL."""
+    return [updateStats(s, gs, card, ease, oldState, write),
+            updateStats(s, ds, card, ease, oldState, write)]
 
-def updateStats(s, stats, card, ease, oldState):
-    stats.reps += 1
+def updateStats(s, stats, card, ease, oldState, write=True):
+    delta = dict.fromkeys(Stats.deltaColumns, 0)
+    delta['id'] = stats.id
+    delta['reps'] = 1
     delay = card.totalTime()
     if delay >= 60:
-        stats.reviewTime += 60
+        delta['reviewTime'] = 60
+        delta['average'] = False
     else:
-        stats.reviewTime += delay
-        stats.averageTime = (
-            stats.reviewTime / float(stats.reps))
+        delta['reviewTime'] = delay
+        delta['average'] = True
     # update eases
-    attr = oldState + "Ease%d" % ease
-    setattr(stats, attr, getattr(stats, attr) + 1)
-    stats.toDB(s)
+    delta[oldState + "Ease%d" % ease] = 1
+    stats.addDelta(delta)
+    if write:
+        s.statement(Stats.deltaSQL, **delta)
+    return delta
+
+def mergeDeltas(deltas):
+    """Combine DELTAS to the same row, for fewer statements. Only runs which
+agree on 'average' are combined, so the stored averageTime ends up as
+addDelta() left it in memory."""
+    rows = []
+    last = {}
+    for d in deltas:
+        r = last.get(d['id'])
+        if not r or r['average'] != d['average']:
+            r = last[d['id']] = d.copy()
+            rows.append(r)
+            continue
+        for c in Stats.deltaColumns:
+            r[c] += d[c]
+    return rows
 
 def globalStats(deck):
     s = deck.s
@@ -308,9 +354,20 @@ class DeckStats(object):
 
     def __init__(self, deck):
         self.deck = deck
+        self.s = deck.s
+        deck.flushReviews()
 
     def report(self):
         "Return an HTML string with a report."
+        # in WAL mode, read saved decks on a connection of their own
+        self.s = self.deck.readSession(fresh=True)
+        try:
+            return self._report()
+        finally:
+            self.deck.closeReadSession(self.s)
+            self.s = self.deck.s
+
+    def _report(self):
         fmtPerc = anki.utils.fmtPercentage
         fmtFloat = anki.utils.fmtFloat
         if self.deck.isEmpty():
@@ -462,11 +519,11 @@ class DeckStats(object):
             html += "</table>"
 
             html += "<br><br><b>" + _("Card Ease") + "</b><br>"
-            html += _("Lowest factor: %.2f") % d.s.scalar(
+            html += _("Lowest factor: %.2f") % self.s.scalar(
                 "select min(factor) from cards") + "<br>"
-            html += _("Average factor: %.2f") % d.s.scalar(
+            html += _("Average factor: %.2f") % self.s.scalar(
                 "select avg(factor) from cards") + "<br>"
-            html += _("Highest factor: %.2f") % d.s.scalar(
+            html += _("Highest factor: %.2f") % self.s.scalar(
                 "select max(factor) from cards") + "<br>"
 
             html = runFilter("deckStats", html)
@@ -476,7 +533,7 @@ class DeckStats(object):
         now = datetime.datetime.today()
         x = now + datetime.timedelta(start)
         y = now + datetime.timedelta(finish)
-        return self.deck.s.scalar(
+        return self.s.scalar(
             "select count() from stats where "
             "day >= :x and day <= :y and reps > 0",
             x=x, y=y)
@@ -485,12 +542,12 @@ class DeckStats(object):
         now = datetime.datetime.today()
         x = time.mktime((now + datetime.timedelta(start)).timetuple())
         y = time.mktime((now + datetime.timedelta(finish)).timetuple())
-        return self.deck.s.scalar(
+        return self.s.scalar(
             "select count() from reviewHistory where time >= :x and time <= :y",
             x=x, y=y)
 
     def getAverageInterval(self):
-        return self.deck.s.scalar(
+        return self.s.scalar(
             "select sum(interval) / count(interval) from cards "
             "where cards.reps > 0") or 0
 
@@ -529,32 +586,32 @@ class DeckStats(object):
         return (time.time() - self.deck.created) / 86400.0
 
     def getSumInverseRoundInterval(self):
-        return self.deck.s.scalar(
+        return self.s.scalar(
             "select sum(1/round(max(interval, 1)+0.5)) from cards "
             "where cards.reps > 0 "
             "and priority > 0") or 0
 
     def getWorkloadPeriod(self, period):
         cutoff = time.time() + 86400 * period
-        return (self.deck.s.scalar("""
+        return (self.s.scalar("""
 select count(id) from cards
 where combinedDue < :cutoff
 and priority > 0 and relativeDelay in (0,1)""", cutoff=cutoff) or 0) / float(period)
 
     def getPastWorkloadPeriod(self, period):
         cutoff = time.time() - 86400 * period
-        return (self.deck.s.scalar("""
+        return (self.s.scalar("""
 select count(*) from reviewHistory
 where time > :cutoff""", cutoff=cutoff) or 0) / float(period)
 
     def getNewPeriod(self, period):
         cutoff = time.time() - 86400 * period
-        return (self.deck.s.scalar("""
+        return (self.s.scalar("""
 select count(id) from cards
 where created > :cutoff""", cutoff=cutoff) or 0)
 
     def getFirstPeriod(self, period):
         cutoff = time.time() - 86400 * period
-        return (self.deck.s.scalar("""
+        return (self.s.scalar("""
 select count(*) from reviewHistory
 where reps = 1 and time > :cutoff""", cutoff=cutoff) or 0)
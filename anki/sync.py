@@ -267,6 +267,7 @@ class SyncTools(object):
         # client may have selected an earlier sync time
         self.deck.lastSync = lastSync
         # ensure we're flushed first
+        self.deck.flushReviews()
         self.deck.s.flush()
         return {
             # cards
@@ -469,8 +470,8 @@ class SyncTools(object):
             modified = time.time()
         else:
             modified = "modified"
-        factIds = ids2str(ids)
-        return {
+        factIds = self.deck.s.idSet("syncFacts", ids)
+        ret = {
             'facts': self.realLists(self.deck.s.all("""
 select id, modelId, created, %s, tags, spaceUntil, lastCardId from facts
 where id in %s""" % (modified, factIds))),
@@ -478,6 +479,8 @@ where id in %s""" % (modified, factIds))),
 select id, factId, fieldModelId, ordinal, value from fields
 where factId in %s""" % factIds))
             }
+        self.deck.s.dropIdSet("syncFacts")
+        return ret
 
     def updateFacts(self, factsdict):
         facts = factsdict['facts']
@@ -508,9 +511,8 @@ values
             'value': f[4]
             } for f in fields]
         # delete local fields since ids may have changed
-        self.deck.s.execute(
-            "delete from fields where factId in %s" %
-            ids2str([f[0] for f in facts]))
+        ids = self.deck.s.idSet("syncFacts", [f[0] for f in facts])
+        self.deck.s.statement("delete from fields where factId in %s" % ids)
         # then update
         self.deck.s.execute("""
 insert into fields
@@ -518,8 +520,8 @@ insert into fields
 values
 (:id, :factId, :fieldModelId, :ordinal, :value)""", dlist)
         self.deck.s.statement(
-            "delete from factsDeleted where factId in %s" %
-            ids2str([f[0] for f in facts]))
+            "delete from factsDeleted where factId in %s" % ids)
+        self.deck.s.dropIdSet("syncFacts")
 
     def deleteFacts(self, ids):
         self.deck.deleteFacts(ids)
@@ -528,14 +530,16 @@ values
     ##########################################################################
 
     def getCards(self, ids):
-        return self.realLists(self.deck.s.all("""
+        cards = self.realLists(self.deck.s.all("""
 select id, factId, cardModelId, created, modified, tags, ordinal,
 priority, interval, lastInterval, due, lastDue, factor,
 firstAnswered, reps, successive, averageTime, reviewTime, youngEase0,
 youngEase1, youngEase2, youngEase3, youngEase4, matureEase0,
 matureEase1, matureEase2, matureEase3, matureEase4, yesCount, noCount,
 question, answer, lastFactor, spaceUntil, type, combinedDue, relativeDelay
-from cards where id in %s""" % ids2str(ids)))
+from cards where id in %s""" % self.deck.s.idSet("syncCards", ids)))
+        self.deck.s.dropIdSet("syncCards")
+        return cards
 
     def updateCards(self, cards):
         if not cards:
@@ -587,6 +591,10 @@ from cards where id in %s""" % ids2str(ids)))
                   'combinedDue': c[35],
                   'rd': getType(c)
                   } for c in cards]
+        # delete first, as replacing skips the delete triggers which keep the
+        # card counts
+        ids = self.deck.s.idSet("syncCards", [c[0] for c in cards])
+        self.deck.s.statement("delete from cards where id in %s" % ids)
         self.deck.s.execute("""
 insert or replace into cards
 (id, factId, cardModelId, created, modified, tags, ordinal,
@@ -605,8 +613,8 @@ values
 :noCount, :question, :answer, :lastFactor, :spaceUntil,
 :type, :combinedDue, :rd, 0)""", dlist)
         self.deck.s.statement(
-            "delete from cardsDeleted where cardId in %s" %
-            ids2str([c[0] for c in cards]))
+            "delete from cardsDeleted where cardId in %s" % ids)
+        self.deck.s.dropIdSet("syncCards")
 
     def deleteCards(self, ids):
         self.deck.deleteCards(ids)
@@ -688,6 +696,8 @@ insert or replace into deckVars
                 stat.create(self.deck.s, 1, record['day'])
             self.applyDict(stat, record)
             stat.toDB(self.deck.s)
+        # today's stats may have changed
+        self.deck.loadStats()
 
     def bundleHistory(self):
         return self.realLists(self.deck.s.all("""
@@ -847,9 +857,11 @@ where media.id in %s""" % sids, now=time.time())
 
     def getOneWayCards(self, ids):
         "The minimum information necessary to generate one way cards."
-        return self.deck.s.all(
+        cards = self.deck.s.all(
             "select id, factId, cardModelId, ordinal, created from cards "
-            "where id in %s" % ids2str(ids))
+            "where id in %s" % self.deck.s.idSet("syncCards", ids))
+        self.deck.s.dropIdSet("syncCards")
+        return cards
 
     def updateOneWayCards(self, cards):
         if not cards:
@@ -880,7 +892,9 @@ select cards.id, models.id
 from cards, facts, models
 where cards.factId = facts.id
 and facts.modelId = models.id
-and cards.id in %s""" % ids2str([c[0] for c in cards])))
+and cards.id in %s""" % self.deck.s.idSet(
+            "syncCards", [c[0] for c in cards])))
+        self.deck.s.dropIdSet("syncCards")
         self.deck.s.flush()
         self.deck.updateCardQACache(
             [(c[0], c[2], c[1], models[c[0]]) for c in cards])
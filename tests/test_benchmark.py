@@ -0,0 +1,31 @@
+# coding: utf-8
+
+import os, tempfile, shutil
+from anki.benchmark import run, buildDeck, recordedAnswers, generateAnswers, \
+     replay, report
+
+def test_benchmark():
+    results = run(facts=20, reviews=10, media=2, models=2)
+    assert [r['scheduler'] for r in results] == [
+        "standard", "cram", "reviewEarly"]
+    for r in results:
+        assert 0 < r['answers'] <= 10
+        assert r['getCard']['p50'] <= r['getCard']['p99']
+        assert r['queriesPerAnswer'] > 0
+    assert len(report(results).splitlines()) == 4
+
+def test_recordedAnswers():
+    dir = tempfile.mkdtemp(prefix="anki")
+    try:
+        path = os.path.join(dir, "test.anki")
+        deck = buildDeck(path, facts=10, reviewed=0)
+        assert deck.s.scalar("select count() from cards where type = 2") == 10
+        res = replay(deck, generateAnswers(5))
+        assert res['answers'] == 5
+        deck.save()
+        deck.close()
+        answers = recordedAnswers(path)
+        assert len(answers) == 5
+        assert recordedAnswers(path, 2) == answers[:2]
+    finally:
+        shutil.rmtree(dir)
@@ -1,6 +1,6 @@
 # coding: utf-8
 
-import nose, os, re
+import nose, os, re, time, simplejson, datetime
 from tests.shared import assertException
 
 from anki.errors import *
@@ -8,7 +8,9 @@ from anki import DeckStorage
 from anki.db import *
 from anki.models import FieldModel, Model, CardModel
 from anki.stdmodels import BasicModel
-from anki.utils import stripHTML
+import anki.cards
+from anki.hooks import addHook, removeHook
+from anki.utils import stripHTML, ids2str
 
 newPath = None
 newModified = None
@@ -42,6 +44,8 @@ def test_attachNew():
 def test_attachOld():
     deck = DeckStorage.Deck(newPath, backup=False)
     assert deck.modified == newModified
+    assert [p[0] for p in deck.openTimings] == [
+        "open", "upgrade", "housekeeping", "reset"]
     deck.close()
 
 def test_attachReadOnly():
@@ -75,8 +79,12 @@ def test_saveAs():
     deck.addFact(f)
     assert deck.cardCount == 1
     # save in new deck
+    schema = deck.s.column0("select name from sqlite_master order by name")
     newDeck = deck.saveAs(path)
     assert newDeck.cardCount == 1
+    # the schema, including indices and views, should come across intact
+    assert newDeck.s.column0(
+        "select name from sqlite_master order by name") == schema
     # delete card
     id = newDeck.s.scalar("select id from cards")
     newDeck.deleteCard(id)
@@ -89,6 +97,388 @@ def test_saveAs():
     assert newDeck.cardCount == 1
     newDeck.close()
 
+def test_backup():
+    import tempfile, shutil, anki.deck, anki.backup
+    from anki.backup import listBackups, restoreBackup
+    oldDir = anki.deck.backupDir
+    oldChunkSize = anki.backup.chunkSize
+    path = "/tmp/test_backup.anki"
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+    try:
+        anki.deck.backupDir = tempfile.mkdtemp()
+        # use small chunks so a test deck spans many of them
+        anki.backup.chunkSize = 4096
+        deck = DeckStorage.Deck(path)
+        deck.addModel(BasicModel())
+        deck.save()
+        deck.close()
+        original = open(path, "rb").read()
+        # opening backs up the deck as it was on disk
+        deck = DeckStorage.Deck(path)
+        f = deck.newFact()
+        f['Front'] = u"foo"; f['Back'] = u"bar"
+        deck.addFact(f)
+        # backups are skipped when the modified time is unchanged
+        deck.setModified(deck.modified + 10)
+        deck.save()
+        deck.close()
+        deck = DeckStorage.Deck(path)
+        deck.setModified(deck.modified + 10)
+        deck.save()
+        deck.close()
+        chunkDir = os.path.join(anki.deck.backupDir, "chunks")
+        nchunks = len(os.listdir(chunkDir))
+        # a small change only adds the chunks that changed
+        deck = DeckStorage.Deck(path)
+        deck.close()
+        backups = listBackups(path, anki.deck.backupDir)
+        assert len(backups) == 3
+        assert len(os.listdir(chunkDir)) - nchunks < 5
+        # and any point can be restored
+        restoreBackup(backups[0][1], path + ".restored")
+        assert open(path + ".restored", "rb").read() == original
+        deck = DeckStorage.Deck(path + ".restored", backup=False)
+        assert deck.cardCount == 0
+        deck.close()
+        os.unlink(path + ".restored")
+        # a lock left behind by a crash doesn't stop backups for long
+        lock = os.path.join(anki.deck.backupDir, "lock")
+        open(lock, "w").close()
+        old = time.time() - anki.backup.lockTimeout - 1
+        os.utime(lock, (old, old))
+        deck = DeckStorage.Deck(path)
+        deck.setModified(deck.modified + 10)
+        deck.save()
+        deck.close()
+        DeckStorage.Deck(path).close()
+        assert not os.path.exists(lock)
+        assert len(listBackups(path, anki.deck.backupDir)) == 4
+    finally:
+        shutil.rmtree(anki.deck.backupDir)
+        anki.deck.backupDir = oldDir
+        anki.backup.chunkSize = oldChunkSize
+
+def test_idSet():
+    deck = DeckStorage.Deck()
+    # short lists are inlined
+    assert deck.s.idSet("test", [1, 2]) == "(1,2)"
+    assert deck.s.scalar("select count() from idSets") == 0
+    # long lists and queries are staged
+    ids = range(1, deck.s.idSetInline + 2)
+    sql = deck.s.idSet("test", ids)
+    assert deck.s.column0("select id from idSets where id in %s "
+                          "order by id" % sql) == ids
+    sql = deck.s.idSet("test2", "select id from idSets where id < 3")
+    assert deck.s.column0("select id from idSets where name = 'test2' "
+                          "and id in %s order by id" % sql) == [1, 2]
+    deck.s.dropIdSet("test", "test2")
+    assert deck.s.scalar("select count() from idSets") == 0
+    # without a pool, a commit can move the session to a new connection
+    path = "/tmp/test_idSet.anki"
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+    deck = DeckStorage.Deck(path, pool=False)
+    deck.s.commit()
+    sql = deck.s.idSet("test", ids)
+    assert deck.s.scalar("select count() from idSets") == len(ids)
+    deck.close()
+
+def test_rawQueries():
+    deck = DeckStorage.Deck()
+    deck.addModel(BasicModel())
+    f = deck.newFact()
+    f['Front'] = u"foo"; f['Back'] = u"bar"
+    deck.addFact(f)
+    sql = "select id, question from cards where factId = :id"
+    res = []
+    for raw in (False, True):
+        deck.s.rawQueries = raw
+        res.append((deck.s.scalar(sql, id=f.id),
+                    deck.s.rawFirst(sql, id=f.id),
+                    deck.s.rawAll(sql, id=f.id),
+                    deck.s.column0(sql, id=f.id)))
+    assert res[0] == res[1]
+    assert res[0][1] == tuple(deck.s.first(sql, id=f.id))
+    # all() and first() rows can still be read by name
+    assert deck.s.first(sql, id=f.id)['question'] == res[0][1][1]
+    assert deck.s.all(sql, id=f.id)[0].id == f.cards[0].id
+    # errors are the same on both paths
+    assertException(OperationalError,
+                    lambda: deck.s.scalar("select foo from cards"))
+
+def test_readSession():
+    path = "/tmp/test_readSession.anki"
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+    deck = DeckStorage.Deck(path, wal=True)
+    deck.addModel(BasicModel())
+    f = deck.newFact()
+    f['Front'] = u"foo"; f['Back'] = u"bar"
+    deck.addFact(f)
+    deck.save()
+    # readers see the last save while the deck is locked for writing
+    f = deck.newFact()
+    f['Front'] = u"foo2"; f['Back'] = u"bar"
+    deck.addFact(f)
+    s = deck.readSession()
+    assert s is not deck.s
+    assert s.scalar("select count() from cards") == 1
+    # and can't make changes
+    assertException(OperationalError,
+                    lambda: s.statement("delete from cards"))
+    deck.closeReadSession(s)
+    # readers which need unsaved changes get the main session until a save
+    assert deck.readSession(fresh=True) is deck.s
+    deck.save()
+    s = deck.readSession(fresh=True)
+    assert s is not deck.s
+    assert s.scalar("select count() from cards") == 2
+    deck.closeReadSession(s)
+    deck.close()
+    # the file is left in the normal journal mode
+    deck = DeckStorage.Deck(path)
+    assert deck.s.scalar("pragma journal_mode") == "delete"
+    assert deck.readSession() is deck.s
+    deck.close()
+
+def test_jobs():
+    path = "/tmp/test_jobs.anki"
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+    deck = DeckStorage.Deck(path, wal=True)
+    deck.addModel(BasicModel())
+    f = deck.newFact()
+    f['Front'] = u"foo"; f['Back'] = u"bar"
+    deck.addFact(f)
+    deck.save()
+    # work runs in its own thread, changes are applied by finishJobs()
+    job = deck.checkIntegrityJob()
+    assert job.thread
+    assert deck.finishJobs(wait=True) == 0
+    assert job.done() and job.result() == "ok"
+    # a problem found in the background is fixed on the deck's thread
+    deck.s.statement("delete from fields where factId = :id", id=f.id)
+    deck.s.commit()
+    job = deck.checkIntegrityJob()
+    deck.finishJobs(wait=True)
+    assert job.result() != "ok"
+    assert not sum(deck.integrityReport().values())
+    # priorities are worked out in the background from the new settings
+    f = deck.newFact()
+    f['Front'] = u"baz"; f['Back'] = u"qux"; f.tags = u"hi"
+    deck.addFact(f)
+    deck.save()
+    deck.highPriority = u"hi"
+    job = deck.updateAllPrioritiesJob()
+    deck.finishJobs(wait=True)
+    job.result()
+    assert deck.s.scalar(
+        "select priority from cards where factId = :id", id=f.id) == 4
+    assert deck.s.scalar("select priority from tags where tag = 'hi'") == 4
+    # cancelled jobs stop at their next update and apply nothing
+    applied = []
+    def work(job, s):
+        while 1:
+            job.update(label=u"waiting")
+    job = deck.startJob(u"test", work, applied.append)
+    job.cancel()
+    deck.finishJobs(wait=True)
+    assertException(JobCancelled, job.result)
+    assert not applied
+    deck.close()
+
+def test_profiler():
+    deck = DeckStorage.Deck()
+    deck.addModel(BasicModel())
+    f = deck.newFact()
+    f['Front'] = u"foo"; f['Back'] = u"bar"
+    deck.addFact(f)
+    p = deck.startProfiling()
+    deck.reset()
+    deck.answerCard(deck.getCard(), 3)
+    deck.s.column0("select id from cards where id in (1, 2, 3)")
+    stats = p.slowest()
+    assert stats
+    scopes = p.byScope()
+    assert scopes['reset']['count'] and scopes['answerCard']['count']
+    # literals are normalised, and the caller is recorded
+    s = [s for s in stats if s['sql'].startswith("select id from cards")][0]
+    assert s['sql'] == "select id from cards where id in (?)"
+    assert s['site'] == "tests.test_deck.test_profiler"
+    # plans are fetched on commit
+    deck.s.commit()
+    assert p.slowest(1)[0]['plan']
+    assert simplejson.loads(p.toJSON())['statements']
+    assert deck.stopProfiling() is p
+    n = len(p.stats)
+    deck.reset()
+    assert len(p.stats) == n
+
+def test_cardRecord():
+    deck = DeckStorage.Deck()
+    deck.addModel(BasicModel())
+    for i in range(2):
+        f = deck.newFact()
+        f['Front'] = u"foo%d" % i; f['Back'] = u"bar"
+        deck.addFact(f)
+    deck.reset()
+    card = deck.getCard(orm=False)
+    assert isinstance(card, anki.cards.CardRecord)
+    assert not hasattr(card, "__dict__")
+    # question and answer are read on demand
+    assert card._lazy is None
+    assert u"foo" in card.htmlQuestion()
+    assert card.fact['Back'] == u"bar"
+    deck.answerCard(card, 3)
+    # the same as the orm path
+    card2 = deck.getCard()
+    deck.answerCard(card2, 3)
+    deck.s.flush()
+    cols = "reps, yesCount, type, interval > 0, successive, youngEase3"
+    assert (deck.s.first("select %s from cards where id = :id" % cols,
+                         id=card.id) ==
+            deck.s.first("select %s from cards where id = :id" % cols,
+                         id=card2.id))
+    assert deck.s.scalar("select count() from reviewHistory") == 0
+    deck.flushReviews()
+    assert deck.s.scalar("select count() from reviewHistory") == 2
+    # only changed columns are written
+    card = deck.cardFromId(card.id)
+    card.question = u"changed"
+    card.toDB(deck.s)
+    assert deck.s.scalar("select question from cards where id = :id",
+                         id=card.id) == u"changed"
+    p = deck.startProfiling()
+    card.toDB(deck.s)
+    assert not p.stats
+
+def test_answerCards():
+    deck = DeckStorage.Deck()
+    deck.addModel(BasicModel())
+    for i in range(10):
+        f = deck.newFact()
+        f['Front'] = u"foo%d" % i; f['Back'] = u"bar"
+        deck.addFact(f)
+    deck.initUndo()
+    deck.newCardsPerDay = 6
+    deck.reset()
+    cards = deck.getCards(8)
+    assert len(cards) == 6
+    assert len(set([c.id for c in cards])) == 6
+    ids = [c.id for c in cards]
+    old = time.time() - 86400 * 10
+    deck.answerCards([(ids[0], 1, 5, old), (ids[0], 3, 5, old + 60),
+                      (ids[1], 4)] + [(id, 3, 2.5) for id in ids[2:]])
+    assert deck.s.scalar("select count() from reviewHistory") == 7
+    assert deck.s.column0("select time from reviewHistory where cardId = :id "
+                          "order by time", id=ids[0]) == [old, old + 60]
+    assert deck.s.scalar("select thinkingTime from reviewHistory "
+                         "where cardId = :id", id=ids[1]) == 0
+    (reps, noCount, first, due) = deck.s.first(
+        "select reps, noCount, firstAnswered, due from cards where id = :id",
+        id=ids[0])
+    assert (reps, noCount, first) == (2, 1, old)
+    # scheduled from the time of the answer
+    assert due < time.time()
+    assert deck._globalStats.reps == 7
+    assert deck.s.scalar("select count() from cards where reps > 0") == 6
+    # the queues were rebuilt, and the batch is one undo step
+    assert deck.newCountToday == 0
+    deck.undo()
+    assert deck.s.scalar("select count() from cards where reps > 0") == 0
+    assert deck.s.scalar("select count() from reviewHistory") == 0
+    # unknown ids are rejected before an undo step is opened
+    assertException(Exception, lambda: deck.answerCards([(ids[0], 3), (1, 3)]))
+    assert not deck.undoOpen
+    assert deck.s.scalar("select count() from cards where reps > 0") == 0
+    # a slow last answer leaves the average as the quick ones set it
+    deck.answerCards([(ids[0], 3, 5), (ids[1], 3, 90)])
+    for stats in (deck._globalStats, deck._dailyStats):
+        assert round(stats.averageTime) == 5
+        assert deck.s.scalar("select averageTime from stats where id = :id",
+                             id=stats.id) == stats.averageTime
+
+def test_statsCache():
+    deck = DeckStorage.Deck()
+    deck.addModel(BasicModel())
+    for i in range(3):
+        f = deck.newFact()
+        f['Front'] = u"foo%d" % i; f['Back'] = u"bar"
+        deck.addFact(f)
+    deck.initUndo()
+    deck.reset()
+    # stats are only reread on a new day
+    p = deck.startProfiling()
+    deck.reset()
+    assert not [st for st in p.slowest() if "from stats" in st['sql']]
+    deck.stopProfiling()
+    for ease in (1, 3):
+        deck.answerCard(deck.getCard(), ease)
+    deck.flushReviews()
+    for stats in (deck._globalStats, deck._dailyStats):
+        assert deck.s.first(
+            "select reps, newEase1, newEase3, reviewTime, averageTime "
+            "from stats where id = :id", id=stats.id) == (
+            2, 1, 1, stats.reviewTime, stats.averageTime)
+        assert stats.averageTime
+    # undo rereads them
+    deck.undo()
+    assert deck._dailyStats.reps == 1
+    # as does a new day
+    deck._dailyStats.day -= datetime.timedelta(days=1)
+    deck.reset()
+    assert deck._dailyStats.reps == 1
+
+def test_cardCounts():
+    deck = DeckStorage.Deck()
+    deck.addModel(BasicModel())
+    for i in range(4):
+        f = deck.newFact()
+        f['Front'] = u"foo%d" % i; f['Back'] = u"bar"
+        deck.addFact(f)
+    deck.initUndo()
+    deck.reset()
+    def check(cards, new, young, mature, seen):
+        assert not deck.checkCardCounts()
+        assert deck.cardCount == cards
+        assert deck.newCountAll() == new
+        assert deck.youngCardCount() == young
+        assert deck.matureCardCount() == mature
+        assert deck.seenCardCount() == seen
+    check(4, 4, 0, 0, 0)
+    deck.answerCard(deck.getCard(), 3)
+    check(4, 3, 1, 0, 1)
+    ids = deck.s.column0("select id from cards where reps = 0")
+    deck.s.statement("update cards set interval = 30, reps = 5 "
+                     "where id = :id", id=ids[0])
+    deck.suspendCards(ids[1:2])
+    deck.rebuildCounts()
+    check(4, 3, 1, 1, 1)
+    # undoing the answer updates them too
+    deck.undo()
+    check(4, 4, 0, 1, 0)
+    deck.deleteCards(ids[:1])
+    deck.rebuildCounts()
+    check(3, 3, 0, 0, 0)
+    # drift is reported and repaired
+    deck.s.statement("update cardCounts set count = count + 1")
+    assert deck.integrityReport()['cardCounts']
+    deck.lastSync = 5
+    assert deck.fixIntegrity() == "Rebuilt card counts"
+    # without forcing a full sync
+    assert deck.lastSync == 5
+    deck.reset()
+    check(3, 3, 0, 0, 0)
+
 def test_factAddDelete():
     deck = DeckStorage.Deck()
     deck.addModel(BasicModel())
@@ -125,9 +515,223 @@ def test_factAddDelete():
     assert e.data['type'] == 'fieldNotUnique'
     # try delete the first card
     id1 = f.cards[0].id; id2 = f.cards[1].id
+    f.tags = u"foo"
+    deck.updateFactTags([f.id])
     deck.deleteCard(id1)
-    # and the second should clear the fact
+    assert deck.s.scalar("select count() from facts") == 1
+    assert deck.s.scalar("select 1 from tags where tag = 'foo'")
+    # and the second should clear the fact and its unused tags
     deck.deleteCard(id2)
+    assert deck.s.scalar("select count() from facts") == 0
+    assert deck.s.scalar("select count() from factsDeleted") == 1
+    assert deck.s.scalar("select count() from cardsDeleted") == 2
+    assert not deck.s.scalar("select 1 from tags where tag = 'foo'")
+
+def test_undo():
+    deck = DeckStorage.Deck()
+    deck.addModel(BasicModel())
+    deck.initUndo()
+    deck.setUndoStart("add")
+    for i in range(3):
+        f = deck.newFact()
+        f['Front'] = u"foo%d" % i; f['Back'] = u"bar"
+        deck.addFact(f)
+    deck.setUndoEnd("add")
+    assert deck.s.scalar("select count() from cards") == 3
+    # updates only log the columns which changed
+    deck.setUndoStart("edit")
+    deck.s.statement("update cards set interval = 5")
+    deck.setUndoEnd("edit")
+    for sql in deck.s.column0(
+        "select sql from undoLog where seq > :s and tbl = 'cards'",
+        s=deck.undoStack[-1][1]):
+        assert sql.startswith("update cards set interval=0.0 where")
+    deck.undo()
+    assert deck.s.scalar("select max(interval) from cards") == 0
+    deck.undo()
+    assert deck.s.scalar("select count() from cards") == 0
+    assert deck.s.scalar("select count() from fields") == 0
+    deck.redo()
+    assert deck.s.scalar("select count() from cards") == 3
+    # old steps are dropped when over the limit
+    deck.undoLimit = 1
+    deck.setUndoStart("edit")
+    deck.s.statement("update cards set interval = 5")
+    deck.setUndoEnd("edit")
+    assert deck.undoName() == "edit"
+    assert len(deck.undoStack) == 1
+
+def test_pendingReviews():
+    deck = DeckStorage.Deck()
+    deck.addModel(BasicModel())
+    for i in range(4):
+        f = deck.newFact()
+        f['Front'] = u"foo%d" % i; f['Back'] = u"bar"
+        deck.addFact(f)
+    deck.initUndo()
+    deck.reset()
+    deck.pendingReviewLimit = 3
+    def reps():
+        deck.flushReviews()
+        return (deck.s.scalar("select count() from reviewHistory"),
+                deck.s.scalar("select reps from stats where type = 0"))
+    for i in range(4):
+        deck.answerCard(deck.getCard(), 3)
+    # the first three were written together, the last is still buffered
+    assert deck.s.scalar("select count() from reviewHistory") == 3
+    assert len(deck._pendingReviews) == 1
+    # each answer is still undone with its own history and stats
+    deck.undo()
+    assert reps() == (3, 3)
+    deck.undo()
+    assert reps() == (2, 2)
+    deck.redo()
+    assert reps() == (3, 3)
+    deck.undo(); deck.undo(); deck.undo()
+    assert reps() == (0, 0)
+    assert deck.s.scalar("select max(reps) from cards") == 0
+    # answers flushed while another answer's step is open stay with their
+    # own step
+    deck.reset()
+    deck.answerCard(deck.getCard(), 3)
+    flush = lambda *args: deck.flushReviews()
+    addHook("cardAnswered", flush)
+    deck.answerCard(deck.getCard(), 3)
+    removeHook("cardAnswered", flush)
+    deck.undo()
+    assert reps() == (1, 1)
+    deck.redo()
+    assert reps() == (2, 2)
+    deck.undo(); deck.undo()
+    assert reps() == (0, 0)
+    # a rollback discards buffered answers
+    deck.reset()
+    deck.answerCard(deck.getCard(), 3)
+    deck.rollback()
+    assert reps() == (0, 0)
+    # other steps flush first, whatever they're called
+    deck.reset()
+    deck.answerCard(deck.getCard(), 3)
+    deck.setUndoStart(u"Answer Card")
+    assert not deck._pendingReviews
+    deck.setUndoEnd(u"Answer Card")
+
+def test_undoBulk():
+    deck = DeckStorage.Deck()
+    deck.addModel(BasicModel())
+    for i in range(4):
+        f = deck.newFact()
+        f['Front'] = u"foo%d" % i; f['Back'] = u"bar"
+        deck.addFact(f)
+    deck.initUndo()
+    deck.undoBulkRows = 2
+    ids = deck.s.column0("select id from cards")[:3]
+    deck.setUndoStart("delete")
+    deck.s.statement("update cards set interval = 5")
+    start = deck.undoStack[-1][1]
+    deck.deleteCards(ids)
+    deck.setUndoEnd("delete")
+    # the bulk change is snapshotted rather than logged, and only the rows
+    # it touched are copied
+    assert not deck.s.scalar(
+        "select count() from undoLog where seq > :s and tbl = 'fields'",
+        s=start)
+    assert deck.s.scalar("select count() from undoSnapshot_cards") == 3
+    assert deck.s.scalar("select count() from undoSnapshot_fields") == 6
+    # the ids are stored once, rather than in each condition
+    assert deck.s.scalar("select count() from undoIds") == 6
+    assert not [e for e in deck.undoStack[-1][3] if str(ids[0]) in e[4]]
+    assert deck.s.scalar("select count() from cards") == 1
+    deck.undo()
+    assert deck.s.scalar("select count() from cards") == 4
+    assert deck.s.scalar("select count() from fields") == 8
+    assert deck.s.scalar("select max(interval) from cards") == 0
+    deck.redo()
+    assert deck.s.scalar("select count() from cards") == 1
+    deck.undo()
+    assert deck.s.scalar("select count() from cards") == 4
+    # the triggers are back
+    deck.setUndoStart("edit")
+    deck.s.statement("delete from fields")
+    deck.setUndoEnd("edit")
+    deck.undo()
+    assert deck.s.scalar("select count() from fields") == 8
+    # snapshot rows count towards the undo limit
+    deck.undoLimit = 10
+    deck.setUndoStart("edit")
+    deck.s.statement("update cards set interval = 1")
+    deck.setUndoEnd("edit")
+    deck.setUndoStart("delete")
+    deck.deleteCards(ids)
+    deck.setUndoEnd("delete")
+    assert len([u for u in deck.undoStack if u]) == 1
+    assert deck.s.scalar("select count() from undoIds") == 6
+    # logging resumes even if the change fails
+    def fail(ids):
+        raise Exception()
+    deck.deleteFacts = fail
+    deck.undo()
+    ids = deck.s.column0("select id from cards")
+    assert len(ids) == 4
+    assertException(Exception, lambda: deck.deleteCards(ids))
+    assert not deck.undoSuspended
+    assert not deck.s.scalar("select count() from undoSuspended")
+
+def test_fixIntegrity():
+    deck = DeckStorage.Deck()
+    deck.addModel(BasicModel())
+    f = deck.newFact()
+    f['Front'] = u"<p>foo</p>"; f['Back'] = u"bar"
+    deck.addFact(f)
+    f = deck.newFact()
+    f['Front'] = u"baz"; f['Back'] = u"qux"
+    deck.addFact(f)
+    deck.s.statement("update cards set modified = 1")
+    # a clean deck only touches the cards whose content changed
+    assert deck.fixIntegrity() == "ok"
+    assert deck.s.scalar("select count() from cards where modified = 1") == 1
+    # problems are reported without being fixed
+    deck.s.statement("""
+insert into fields (id, factId, fieldModelId, ordinal, value)
+values (1, 1, 1, 0, '')""")
+    report = deck.integrityReport()
+    assert report['danglingFields'] == 1
+    assert deck.s.scalar("select count() from fields where id = 1")
+    assert deck.fixIntegrity() != "ok"
+    assert not [v for v in deck.integrityReport().values() if v]
+
+def test_reschedule():
+    deck = DeckStorage.Deck()
+    deck.addModel(BasicModel())
+    for i in range(20):
+        f = deck.newFact()
+        f['Front'] = u"f%d" % i; f['Back'] = u"b"
+        deck.addFact(f)
+    ids = deck.s.column0("select id from cards")
+    deck.rescheduleCards(ids, 2, 4)
+    for (ivl, due, mod) in deck.s.all(
+        "select interval, due, modified from cards"):
+        assert 2 <= ivl <= 4
+        assert abs(due - mod - ivl * 86400) < 1
+    assert deck.s.scalar("select count() from idSets") == 0
+    # balanced over days already holding 3, 0 and 1 reviews
+    now = time.time()
+    deck.rescheduleCards(ids[:4], 0, 2.9, balance=True)
+    deck.s.statement("update cards set combinedDue = :t + 86400 * (case "
+                     "when id in %s then 0 else 2 end) + 60 where id in %s" %
+                     (ids2str(ids[:3]), ids2str(ids[:4])), t=now)
+    deck.rescheduleCards(ids[4:], 0, 2.9, balance=True)
+    days = deck.s.column0(
+        "select cast((combinedDue - :t) / 86400 as int) from cards "
+        "where id in %s" % ids2str(ids[4:]), t=now)
+    assert [days.count(d) for d in range(3)] == [4, 7, 5]
+    # resetting and randomizing keep a fact's cards together
+    deck.newCardOrder = 0
+    deck.resetCards(ids)
+    assert deck.s.scalar("select count() from cards where type = 2") == 20
+    assert deck.s.scalar(
+        "select count() from cards where due = created") < 20
+    assert deck.s.scalar("select count() from idSets") == 0
 
 def test_modelAddDelete():
     deck = DeckStorage.Deck()
@@ -233,6 +837,17 @@ select question, answer from cards where factId = :id""",
                           id=f.id)
     assert stripHTML(q) == u"e"
     assert stripHTML(a) == u"r"
+    # swap templates within a model
+    ids = deck.s.column0("""
+select id from cards where factId = :id order by ordinal""", id=f2.id)
+    cmap = {m1.cardModels[0]: m1.cardModels[1],
+            m1.cardModels[1]: m1.cardModels[0]}
+    deck.changeModel([f2.id], m1, {}, cmap)
+    assert deck.s.column0("""
+select id from cards where factId = :id order by ordinal""",
+                          id=f2.id) == list(reversed(ids))
+    assert stripHTML(deck.s.scalar(
+        "select question from cards where id = :id", id=ids[0])) == u"m2"
 
 def test_findCards():
     deck = DeckStorage.Deck()
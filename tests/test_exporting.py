@@ -43,14 +43,67 @@ def test_export_anki():
     d2 = DeckStorage.Deck(newname, backup=False)
     assert d2.cardCount == 2
 
+def test_export_anki_unsaved():
+    path = "/tmp/test_export_anki_unsaved.anki"
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+    d = DeckStorage.Deck(path)
+    d.addModel(BasicModel())
+    f = d.newFact()
+    f['Front'] = u"foo"; f['Back'] = u"bar"
+    d.addFact(f)
+    d.save()
+    f = d.newFact()
+    f['Front'] = u"baz"; f['Back'] = u"qux"
+    d.addFact(f)
+    newname = unicode(tempfile.mkstemp(prefix="ankitest")[1])
+    os.unlink(newname)
+    AnkiExporter(d).exportInto(newname)
+    d2 = DeckStorage.Deck(newname, backup=False)
+    assert d2.factCount == 2
+    d2.close()
+    # exporting doesn't save the open changes
+    d.close()
+    d = DeckStorage.Deck(path, backup=False)
+    assert d.factCount == 1
+    d.close()
+
+@nose.with_setup(setup1)
+def test_export_anki_scheduling():
+    deck.reset()
+    deck.answerCard(deck.getCard(), 4)
+    e = AnkiExporter(deck)
+    newname = unicode(tempfile.mkstemp(prefix="ankitest")[1])
+    os.unlink(newname)
+    e.exportInto(newname)
+    d2 = DeckStorage.Deck(newname, backup=False)
+    assert d2.s.scalar("select max(reps) from cards") == 0
+    assert d2.s.scalar("select count() from cards where type = 2") == 4
+    assert not d2.s.scalar("select count() from reviewHistory")
+    d2.close()
+    # and again, keeping scheduling info
+    e.includeSchedulingInfo = True
+    os.unlink(newname)
+    e.exportInto(newname)
+    d2 = DeckStorage.Deck(newname, backup=False)
+    assert d2.s.scalar("select max(reps) from cards") == 1
+    assert d2.s.scalar("select count() from reviewHistory") == 1
+    d2.close()
+
 @nose.with_setup(setup1)
 def test_export_textcard():
     e = TextCardExporter(deck)
     f = unicode(tempfile.mkstemp(prefix="ankitest")[1])
     os.unlink(f)
     e.exportInto(f)
+    lines = open(f).read().splitlines()
+    assert len(lines) == 4
+    assert "fm" not in lines[0]
     e.includeTags = True
     e.exportInto(f)
+    assert "tag, tag2" in open(f).read()
 
 @nose.with_setup(setup1)
 def test_export_textfact():
@@ -58,5 +111,13 @@ def test_export_textfact():
     f = unicode(tempfile.mkstemp(prefix="ankitest")[1])
     os.unlink(f)
     e.exportInto(f)
+    assert open(f).read() == "foo\tbar\nbaz\tqux"
     e.includeTags = True
     e.exportInto(f)
+    assert open(f).read().splitlines()[0] == "foo\tbar\ttag, tag2"
+
+def test_stripFieldSpans():
+    assert stripFieldSpans(
+        '<span class="fm1">a <span style="x">b</span> c</span>') == (
+        'a <span style="x">b</span> c')
+    assert stripFieldSpans('<span>a</span></span>') == '<span>a</span></span>'
@@ -0,0 +1,43 @@
+# coding: utf-8
+
+import nose
+from anki import DeckStorage
+from anki.stdmodels import BasicModel
+from anki.forecast import Forecast, forecastAvailable
+
+def test_forecast():
+    if not forecastAvailable():
+        raise nose.SkipTest("numpy not installed")
+    deck = DeckStorage.Deck()
+    deck.addModel(BasicModel())
+    for i in range(10):
+        f = deck.newFact()
+        f['Front'] = u"foo%d" % i; f['Back'] = u"bar"
+        deck.addFact(f)
+    deck.reset()
+    for i in range(5):
+        deck.answerCard(deck.getCard(), 3)
+    res = Forecast(deck, days=30, newPerDay=2, seed=1).run()
+    assert len(res['reviews']) == 30
+    # the remaining five new cards are shown two a day
+    assert res['new'][:4] == [2, 2, 1, 0]
+    # nothing answered today is due again today
+    assert res['reviews'][0] == 0
+    assert sum(res['reviews'])
+    # more new cards mean more reviews
+    more = Forecast(deck, days=30, newPerDay=20, newCards=500, seed=1).run()
+    assert sum(more['reviews']) > sum(res['reviews'])
+    # intervals are capped at maxScheduleTime
+    deck.maxScheduleTime = 2
+    capped = Forecast(deck, days=30, newPerDay=2, seed=1).run()
+    assert sum(capped['reviews']) > sum(res['reviews'])
+    deck.maxScheduleTime = 36500
+    # overdue cards get a longer interval for their delay
+    past = deck.dueCutoff - 100 * 86400
+    deck.s.statement("update cards set interval = 10, factor = 2.5, "
+                     "successive = 1, due = :t, combinedDue = :t "
+                     "where type = 1", t=past)
+    late = Forecast(deck, days=30, newPerDay=0, youngPassRate=1,
+                    maturePassRate=1, seed=1).run()
+    assert late['reviews'][0] == 5
+    assert sum(late['reviews']) == 5
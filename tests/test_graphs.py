@@ -0,0 +1,56 @@
+# coding: utf-8
+
+import time
+from anki import DeckStorage
+from anki.stdmodels import BasicModel
+import anki.graphs
+from anki.graphs import GraphData, dense
+
+def test_graphData():
+    deck = DeckStorage.Deck()
+    deck.addModel(BasicModel())
+    for i in range(20):
+        f = deck.newFact()
+        f['Front'] = u"foo%d" % i; f['Back'] = u"bar"
+        deck.addFact(f)
+    deck.reset()
+    for ease in (1, 3, 3, 4, 2):
+        deck.answerCard(deck.getCard(), ease)
+    ids = deck.s.column0("select id from cards where reps = 0")
+    deck.rescheduleCards(ids[:10], 1, 60)
+    deck.s.statement("update cards set combinedDue = combinedDue - 20 * 86400 "
+                     "where id in (%d, %d)" % tuple(ids[:2]))
+    # the buckets match counting the cards one by one
+    due = {}
+    intervals = {}
+    for (interval, combinedDue) in deck.s.all("""
+select interval, combinedDue from cards where type >= 0 and
+relativeDelay between 0 and 1"""):
+        d = int((combinedDue - deck.failedCutoff) / 86400.0 + 1)
+        due[d] = due.get(d, 0) + 1
+        i = int(round(interval))
+        intervals[i] = intervals.get(i, 0) + 1
+    # with and without numpy
+    numpy = anki.graphs.numpy
+    try:
+        for n in (numpy, None):
+            anki.graphs.numpy = n
+            data = GraphData(deck)
+            d = data.due()
+            assert dict(zip(*d['all'])) == due
+            assert sum(d['young'][1]) + sum(d['mature'][1]) == 15
+            assert dict(zip(*data.intervals())) == intervals
+            reviews = data.reviews()
+            assert list(reviews['new'][0]) == [0]
+            assert list(reviews['new'][1]) == [5]
+            assert list(reviews['young'][1]) == [0]
+            assert list(dense(data.added(), -29, 0)[1]) == [0] * 29 + [20]
+            assert data.eases()['new'] == [0, 1, 1, 2, 1]
+    finally:
+        anki.graphs.numpy = numpy
+    # results are cached until the deck changes
+    data = GraphData(deck)
+    d = data.due()
+    assert data.due() is d
+    deck.setModified()
+    assert data.due() is not d
@@ -0,0 +1,46 @@
+# coding: utf-8
+
+import os, sys, subprocess, simplejson
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# seconds allowed for 'import anki', and for opening a new deck after it
+importBudget = 0.05
+openBudget = 2.0
+
+# optional or rarely needed modules which opening a deck shouldn't import
+deferred = ("matplotlib", "pkg_resources", "urllib2", "anki.sync",
+            "anki.latex", "anki.graphs", "anki.sound", "anki.importing",
+            "anki.exporting")
+
+script = """
+import sys, time, simplejson
+t = time.time()
+import anki
+imported = time.time() - t
+loaded = [m for m in sys.modules if m.startswith("sqlalchemy")]
+deck = anki.DeckStorage.Deck(sys.argv[1])
+opened = time.time() - t - imported
+deck.close()
+print simplejson.dumps([imported, opened, loaded,
+                        [m for m in sys.modules if sys.modules[m]]])
+"""
+
+def test_importTime():
+    path = "/tmp/test_importTime.anki"
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+    env = dict(os.environ)
+    env['PYTHONPATH'] = root
+    out = subprocess.Popen([sys.executable, "-c", script, path], env=env,
+                           stdout=subprocess.PIPE).communicate()[0]
+    (imported, opened, sqlalchemy, modules) = simplejson.loads(
+        out.strip().splitlines()[-1])
+    os.unlink(path)
+    # importing anki doesn't load the deck code or sqlalchemy
+    assert not sqlalchemy
+    assert imported < importBudget
+    assert opened < openBudget
+    assert not [m for m in deferred if m in modules]
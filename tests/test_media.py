@@ -104,3 +104,24 @@ def test_db():
     deck.updateCardsFromModel(deck.currentModel)
     assert deck.s.scalar("select count() from media") == 2
     assert deck.s.scalar("select sum(size) from media") == 1
+
+def test_downloadMissing():
+    deck = DeckStorage.Deck()
+    deck.addModel(BasicModel())
+    src = tempfile.mkdtemp(prefix="anki")
+    open(os.path.join(src, "foo.jpg"), "w").write("hello")
+    f = deck.newFact()
+    f['Front'] = u"<img src='foo.jpg'>"
+    f['Back'] = u""
+    deck.addFact(f)
+    deck.setVar("mediaURL", u"file://" + src + "/")
+    # files are saved in the media folder
+    assert m.downloadMissing(deck) == (True, 1, 0)
+    path = os.path.join(deck.mediaDir(), "foo.jpg")
+    assert open(path).read() == "hello"
+    # the same, as a job
+    os.unlink(path)
+    job = m.downloadMissingJob(deck)
+    deck.finishJobs(wait=True)
+    assert job.result() == (True, 1, 0)
+    assert open(path).read() == "hello"